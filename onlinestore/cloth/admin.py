@@ -1,4 +1,4 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from .models import (
     Role, User, EmailVerification,
@@ -6,9 +6,10 @@ from .models import (
     Product, ProductVariant, ProductImage,
     Wishlist, Cart, CartItem,
     OrderStatus, DeliveryMethod, Order, OrderItem,
-    TransactionStatus, Transaction,
-    Review,
+    TransactionStatus, Transaction, Refund, RefundItem,
+    Review, ProductRecommendation, SearchQuery,
 )
+from .payments import RefundService
 
 
 # =========================================================
@@ -101,11 +102,13 @@ class ProductImageInline(admin.TabularInline):
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('name', 'category', 'price', 'is_active', 'is_new', 'is_bestseller', 'created_at')
+    list_display = ('name', 'category', 'price', 'is_active', 'is_new', 'is_bestseller', 'popularity_score', 'view_count', 'created_at')
     list_filter = ('is_active', 'is_new', 'is_bestseller', 'category', 'gender')
     search_fields = ('name', 'description')
     prepopulated_fields = {'slug': ('name',)}
-    list_editable = ('is_active', 'is_new', 'is_bestseller')
+    list_editable = ('is_active',)
+    # Выставляются командой rank_products, просмотры считает cloth.view_counter
+    readonly_fields = ('is_new', 'is_bestseller', 'popularity_score', 'view_count')
     date_hierarchy = 'created_at'
     inlines = [ProductVariantInline, ProductImageInline]
 
@@ -206,6 +209,17 @@ class TransactionStatusAdmin(admin.ModelAdmin):
     list_display = ('name',)
 
 
+class RefundInline(admin.TabularInline):
+    model = Refund
+    extra = 0
+    fields = ('external_id', 'amount', 'status', 'stock_returned', 'created_by', 'created_at')
+    readonly_fields = fields
+    show_change_link = True
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
 @admin.register(Transaction)
 class TransactionAdmin(admin.ModelAdmin):
     list_display = ('external_id', 'order', 'amount', 'payment_system', 'status', 'created_at')
@@ -213,6 +227,61 @@ class TransactionAdmin(admin.ModelAdmin):
     search_fields = ('external_id', 'order__order_number')
     date_hierarchy = 'created_at'
     readonly_fields = ('created_at', 'updated_at')
+    inlines = [RefundInline]
+    actions = ['refund_transactions']
+
+    def refund_transactions(self, request, queryset):
+        """Полный возврат остатка по выбранным транзакциям (запросы к ЮKassa идут параллельно)"""
+        service = RefundService()
+        refunds = []
+        errors = []
+        for transaction in queryset.select_related('order', 'status'):
+            try:
+                refunds.append(service.create_refund(transaction, user=request.user, reason='Массовый возврат'))
+            except ValueError as e:
+                errors.append(str(e))
+
+        service.submit_refunds(refunds)
+
+        succeeded = sum(1 for refund in refunds if refund.status == 'succeeded')
+        pending = sum(1 for refund in refunds if refund.status == 'pending')
+        self.message_user(request, f'Возвратов создано: {len(refunds)}, успешно: {succeeded}, в обработке: {pending}.')
+        for error in errors:
+            self.message_user(request, error, level=messages.WARNING)
+    refund_transactions.short_description = 'Вернуть деньги по выбранным транзакциям'
+
+
+class RefundItemInline(admin.TabularInline):
+    model = RefundItem
+    extra = 0
+    readonly_fields = ('order_item', 'quantity', 'amount')
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+@admin.register(Refund)
+class RefundAdmin(admin.ModelAdmin):
+    list_display = ('external_id', 'transaction', 'amount', 'status', 'stock_returned', 'created_by', 'created_at')
+    list_filter = ('status', 'stock_returned', 'created_at')
+    search_fields = ('external_id', 'transaction__external_id', 'transaction__order__order_number')
+    date_hierarchy = 'created_at'
+    readonly_fields = ('transaction', 'amount', 'status', 'external_id', 'idempotence_key',
+                       'stock_returned', 'created_by', 'created_at', 'updated_at')
+    inlines = [RefundItemInline]
+    actions = ['resubmit_refunds']
+
+    def has_add_permission(self, request):
+        return False
+
+    def resubmit_refunds(self, request, queryset):
+        """Повторная отправка зависших возвратов с теми же ключами идемпотентности"""
+        refunds = RefundService().submit_refunds(
+            list(queryset.filter(status='pending').select_related('transaction'))
+        )
+        succeeded = sum(1 for refund in refunds if refund.status == 'succeeded')
+        self.message_user(request, f'Отправлено возвратов: {len(refunds)}, успешно: {succeeded}.')
+    resubmit_refunds.short_description = 'Отправить повторно ожидающие возвраты'
 
 
 # =========================================================
@@ -231,3 +300,42 @@ class ReviewAdmin(admin.ModelAdmin):
         updated = queryset.update(is_moderated=True, moderated_by=request.user)
         self.message_user(request, f'{updated} отзывов одобрено.')
     approve_reviews.short_description = 'Одобрить выбранные отзывы'
+
+
+# =========================================================
+# RECOMMENDATIONS
+# =========================================================
+
+@admin.register(ProductRecommendation)
+class ProductRecommendationAdmin(admin.ModelAdmin):
+    """Только просмотр: таблица пересчитывается командой build_recommendations"""
+    list_display = ('product', 'rank', 'recommended', 'score', 'source', 'created_at')
+    list_filter = ('source',)
+    search_fields = ('product__name', 'recommended__name')
+    list_select_related = ('product', 'recommended')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
+# =========================================================
+# SEARCH ANALYTICS
+# =========================================================
+
+@admin.register(SearchQuery)
+class SearchQueryAdmin(admin.ModelAdmin):
+    """Только просмотр: строки пишет буфер cloth.search_log, сводка -- команда search_report"""
+    list_display = ('created_at', 'kind', 'query', 'results', 'duration_ms', 'clicked_product')
+    list_filter = ('kind', 'created_at')
+    search_fields = ('query',)
+    list_select_related = ('clicked_product',)
+    date_hierarchy = 'created_at'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,427 @@
+"""
+JSON API каталога для мобильного клиента (только чтение), /api/v1/
+
+  GET /api/v1/categories/              -- активные категории
+  GET /api/v1/products/                -- товары с фильтрами каталога
+                                          (category, size, color, min_price,
+                                          max_price, q, sort)
+  GET /api/v1/products/<slug>/         -- товар с изображениями и матрицей
+                                          вариантов размер x цвет
+  GET /api/v1/variants/availability/   -- остатки и цены вариантов по списку id
+                                          (ids=1,2,3), одним запросом
+
+Параметр fields выбирает поля ответа (fields=id,name,price): из базы
+читаются только нужные столбцы через values(), объекты моделей не
+создаются, ответ собирается сериализаторами этого модуля.
+
+Список товаров листается курсором (next_cursor -> ?cursor=...): курсор
+хранит значение поля сортировки и id последнего товара страницы, поэтому
+следующая страница -- условие по индексу, а не OFFSET. Выдача поиска
+упорядочена по релевантности, её курсор хранит смещение.
+
+Каждый ответ получает ETag (md5 тела): повторный запрос с If-None-Match
+получает 304 без тела. Списки для анонимных запросов кэшируются как
+страницы каталога (cloth.cache.cache_anonymous_page).
+
+Остатки вариантов не кэшируются на сервере (версия каталога не меняется при
+списании со склада), а отдаются с max-age в несколько секунд: страницы
+каталога и товара запрашивают их одним запросом на страницу, и прокси или
+браузер отвечают на повторы сами.
+"""
+from decimal import Decimal, InvalidOperation
+from functools import wraps
+from datetime import timedelta
+import base64
+import binascii
+import datetime
+import hashlib
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db.models import Count, IntegerField, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.http import JsonResponse
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response
+
+from .cache import cache_anonymous_page
+from .db_router import replica_reads
+from .models import Category, OrderItem, Product, ProductImage, ProductVariant
+from .views import catalog_default_sort, filter_catalog
+
+DEFAULT_LIMIT = 24
+MAX_LIMIT = 100
+# Вариантов в одном запросе остатков и сколько секунд ответ можно не перепроверять
+MAX_AVAILABILITY_IDS = 300
+AVAILABILITY_MAX_AGE = 5
+
+# Поле ответа -> столбец values(); None -- вычисляемое поле
+PRODUCT_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'slug': 'slug',
+    'url': None,
+    'price': 'price',
+    'category': 'category__slug',
+    'gender': 'gender__name',
+    'material': 'material',
+    'description': 'description',
+    'care_instructions': 'care_instructions',
+    'is_new': 'is_new',
+    'is_bestseller': 'is_bestseller',
+    'popularity': 'popularity_score',
+    'created_at': 'created_at',
+    'updated_at': 'updated_at',
+    'image': None,
+}
+# Только в карточке товара: отдельные запросы к изображениям и вариантам
+PRODUCT_DETAIL_FIELDS = {**PRODUCT_FIELDS, 'images': None, 'variants': None}
+DEFAULT_PRODUCT_FIELDS = ('id', 'name', 'slug', 'url', 'price', 'category', 'is_new', 'is_bestseller', 'image')
+DEFAULT_DETAIL_FIELDS = tuple(field for field in PRODUCT_DETAIL_FIELDS if field != 'image')
+
+CATEGORY_FIELDS = {
+    'id': 'id',
+    'name': 'name',
+    'slug': 'slug',
+    'description': 'description',
+    'image': 'image',
+    # Аннотация: имя products занято обратной связью модели
+    'products': 'product_count',
+}
+DEFAULT_CATEGORY_FIELDS = ('id', 'name', 'slug', 'products')
+
+# sort -> (поле, по убыванию); второй ключ курсора -- id в том же направлении
+SORTS = {
+    '-created_at': ('created_at', True),
+    'created_at': ('created_at', False),
+    'price': ('price', False),
+    '-price': ('price', True),
+    'name': ('name', False),
+    '-name': ('name', True),
+    'popular': ('popularity_score', True),
+}
+
+
+class ApiError(Exception):
+    """Ошибка запроса: ответ {"error": ...} с кодом status"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def api_view(max_age):
+    """
+    Обёртка view API: только GET, ошибки -- JSON, ETag и условный GET
+
+    Args:
+        max_age: сколько секунд клиент может не перепроверять ответ
+                 (0 -- перепроверять каждый раз, обычно получая 304)
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return JsonResponse({'error': 'method not allowed'}, status=405)
+            try:
+                response = view_func(request, *args, **kwargs)
+            except ApiError as e:
+                return JsonResponse({'error': str(e)}, status=e.status)
+
+            etag = '"%s"' % hashlib.md5(response.content).hexdigest()
+            not_modified = get_conditional_response(request, etag=etag)
+            if not_modified is not None:
+                response = not_modified
+            response['ETag'] = etag
+            response['Cache-Control'] = f'public, max-age={max_age}' if max_age else 'public, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+
+def json_response(data):
+    """Компактный JSON без экранирования кириллицы"""
+    return JsonResponse(data, json_dumps_params={'ensure_ascii': False, 'separators': (',', ':')})
+
+
+def serialize_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def parse_fields(params, allowed, default):
+    """Запрошенные поля (fields=a,b,c) в порядке запроса"""
+    raw = params.get('fields')
+    if not raw:
+        return list(default)
+    fields = list(dict.fromkeys(field.strip() for field in raw.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ApiError(f"Неизвестные поля: {', '.join(unknown)}")
+    return fields
+
+
+def parse_limit(params):
+    try:
+        limit = int(params.get('limit', DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError('limit должен быть числом')
+    return min(max(limit, 1), MAX_LIMIT)
+
+
+def parse_ids(params):
+    """id вариантов из ids=1,2,3 (можно повторять параметр), без повторов"""
+    raw = [part.strip() for value in params.getlist('ids') for part in value.split(',') if part.strip()]
+    if not raw:
+        raise ApiError('Не указаны ids')
+    try:
+        ids = list(dict.fromkeys(int(part) for part in raw))
+    except ValueError:
+        raise ApiError('ids должны быть числами')
+    if len(ids) > MAX_AVAILABILITY_IDS:
+        raise ApiError(f'Не больше {MAX_AVAILABILITY_IDS} ids в запросе')
+    return ids
+
+
+def encode_cursor(data):
+    return base64.urlsafe_b64encode(json.dumps(data, separators=(',', ':')).encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, sort):
+    """Курсор из next_cursor; он действителен только для той же сортировки"""
+    if not cursor:
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ApiError('Неверный курсор')
+    if not isinstance(data, dict) or data.get('sort') != sort:
+        raise ApiError('Курсор выдан для другой сортировки')
+    return data
+
+
+def product_columns(fields):
+    """Столбцы values() для полей ответа (id нужен всегда: курсор и изображения)"""
+    columns = {'id'}
+    for field in fields:
+        if PRODUCT_DETAIL_FIELDS[field]:
+            columns.add(PRODUCT_DETAIL_FIELDS[field])
+        elif field == 'url':
+            columns.add('slug')
+    return sorted(columns)
+
+
+def main_images(request, product_ids):
+    """{product_id: абсолютный URL главного изображения} одним запросом"""
+    images = {}
+    rows = (
+        ProductImage.objects.filter(product_id__in=product_ids)
+        .order_by('product_id', '-is_main', 'order', 'id').values_list('product_id', 'image')
+    )
+    for product_id, image in rows:
+        if product_id not in images:
+            images[product_id] = request.build_absolute_uri(settings.MEDIA_URL + image)
+    return images
+
+
+def serialize_products(request, rows, fields):
+    """Строки values() -> словари ответа с полями fields"""
+    images = main_images(request, [row['id'] for row in rows]) if 'image' in fields else {}
+    result = []
+    for row in rows:
+        item = {}
+        for field in fields:
+            column = PRODUCT_DETAIL_FIELDS[field]
+            if column:
+                item[field] = serialize_value(row[column])
+            elif field == 'url':
+                item[field] = request.build_absolute_uri(reverse('product_detail', args=[row['slug']]))
+            elif field == 'image':
+                item[field] = images.get(row['id'])
+        result.append(item)
+    return result
+
+
+def variant_matrix(product_id):
+    """
+    Варианты товара и матрица размер x цвет
+
+    Returns:
+        dict: {'sizes': [...], 'colors': [{'name', 'hex'}], 'variants': [...],
+               'matrix': [[id варианта или None по цветам] по размерам]}
+    """
+    rows = list(
+        ProductVariant.objects.filter(product_id=product_id)
+        .order_by('size__order', 'size__name', 'color__name', 'id')
+        .values('id', 'sku', 'price', 'stock_quantity', 'size__name', 'color__name', 'color__hex_code')
+    )
+    sizes = list(dict.fromkeys(row['size__name'] for row in rows))
+    colors = list(dict.fromkeys((row['color__name'], row['color__hex_code']) for row in rows))
+    cells = {(row['size__name'], (row['color__name'], row['color__hex_code'])): row['id'] for row in rows}
+    return {
+        'sizes': sizes,
+        'colors': [{'name': name, 'hex': hex_code} for name, hex_code in colors],
+        'variants': [
+            {
+                'id': row['id'],
+                'sku': row['sku'],
+                'size': row['size__name'],
+                'color': row['color__name'],
+                'price': serialize_value(row['price']),
+                'stock': row['stock_quantity'],
+            }
+            for row in rows
+        ],
+        'matrix': [[cells.get((size, color)) for color in colors] for size in sizes],
+    }
+
+
+def variant_availability(variant_ids):
+    """
+    Доступное количество и цена вариантов активных товаров одним запросом
+
+    Склад списывается только после оплаты, поэтому неоплаченные заказы
+    (статус created) не старше STOCK_RESERVATION_MINUTES держат свои
+    количества: они вычитаются из stock_quantity подзапросом по позициям
+    заказов (индекс по variant_id).
+
+    Returns:
+        dict: {variant_id: {'available': int, 'price': Decimal}}; неизвестных
+              и снятых с продажи вариантов в ответе нет
+    """
+    reserved = (
+        OrderItem.objects.filter(
+            variant=OuterRef('pk'),
+            order__status__name='created',
+            order__created_at__gte=timezone.now() - timedelta(minutes=settings.STOCK_RESERVATION_MINUTES),
+        )
+        .values('variant').annotate(total=Sum('quantity')).values('total')
+    )
+    rows = (
+        ProductVariant.objects.filter(id__in=variant_ids, product__is_active=True)
+        .annotate(reserved=Coalesce(Subquery(reserved, output_field=IntegerField()), 0))
+        .values_list('id', 'stock_quantity', 'reserved', 'price')
+    )
+    return {
+        variant_id: {'available': max(stock - reserved, 0), 'price': price}
+        for variant_id, stock, reserved, price in rows
+    }
+
+
+@api_view(max_age=300)
+@cache_anonymous_page()
+@replica_reads
+def categories(request):
+    """Активные категории"""
+    fields = parse_fields(request.GET, CATEGORY_FIELDS, DEFAULT_CATEGORY_FIELDS)
+    queryset = Category.objects.filter(is_active=True).order_by('order', 'name')
+    if 'products' in fields:
+        queryset = queryset.annotate(product_count=Count('products', filter=Q(products__is_active=True)))
+
+    data = []
+    for row in queryset.values(*[CATEGORY_FIELDS[field] for field in fields]):
+        item = {field: row[CATEGORY_FIELDS[field]] for field in fields}
+        if item.get('image'):
+            item['image'] = request.build_absolute_uri(settings.MEDIA_URL + item['image'])
+        data.append(item)
+    return json_response({'data': data})
+
+
+@api_view(max_age=60)
+@cache_anonymous_page(lists=('size', 'color'), defaults={'sort': catalog_default_sort})
+@replica_reads
+def products(request):
+    """Товары с фильтрами каталога, по курсору"""
+    params = request.GET
+    fields = parse_fields(params, PRODUCT_FIELDS, DEFAULT_PRODUCT_FIELDS)
+    limit = parse_limit(params)
+    for name in ('min_price', 'max_price'):
+        if params.get(name):
+            try:
+                Decimal(params[name])
+            except InvalidOperation:
+                raise ApiError(f'{name} должен быть числом')
+
+    queryset, relevance = filter_catalog(Product.objects.filter(is_active=True), params)
+    sort = params.get('sort') or catalog_default_sort(params)
+    if sort == 'relevance' and relevance is None:
+        sort = '-created_at'
+    cursor = decode_cursor(params.get('cursor'), sort)
+    columns = product_columns(fields)
+
+    if sort == 'relevance':
+        # Порядок релевантности не задаётся столбцом -- курсор хранит смещение
+        offset = cursor.get('offset', 0) if cursor else 0
+        if not isinstance(offset, int) or offset < 0:
+            raise ApiError('Неверный курсор')
+        rows = list(queryset.order_by(relevance, '-id').values(*columns).distinct()[offset:offset + limit + 1])
+        next_cursor = {'sort': sort, 'offset': offset + limit}
+    elif sort in SORTS:
+        field, descending = SORTS[sort]
+        if cursor:
+            try:
+                value, last_id = cursor['after']
+                value = Product._meta.get_field(field).to_python(value)
+                last_id = int(last_id)
+            except (KeyError, TypeError, ValueError, ValidationError):
+                raise ApiError('Неверный курсор')
+            lookup = 'lt' if descending else 'gt'
+            queryset = queryset.filter(
+                Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'id__{lookup}': last_id})
+            )
+        prefix = '-' if descending else ''
+        rows = list(
+            queryset.order_by(f'{prefix}{field}', f'{prefix}id')
+            .values(*sorted(set(columns) | {field})).distinct()[:limit + 1]
+        )
+        next_cursor = {'sort': sort, 'after': [serialize_value(rows[limit - 1][field]), rows[limit - 1]['id']]} \
+            if len(rows) > limit else None
+    else:
+        raise ApiError(f'Неизвестная сортировка: {sort}')
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return json_response({
+        'data': serialize_products(request, rows, fields),
+        'next_cursor': encode_cursor(next_cursor) if has_more else None,
+    })
+
+
+@api_view(max_age=0)
+@replica_reads
+def product_detail(request, slug):
+    """Товар с изображениями и матрицей вариантов (остатки -- на момент запроса)"""
+    fields = parse_fields(request.GET, PRODUCT_DETAIL_FIELDS, DEFAULT_DETAIL_FIELDS)
+    row = Product.objects.filter(is_active=True, slug=slug).values(*product_columns(fields)).first()
+    if row is None:
+        raise ApiError('Товар не найден', status=404)
+
+    data = serialize_products(request, [row], fields)[0]
+    if 'images' in fields:
+        data['images'] = [
+            {'url': request.build_absolute_uri(settings.MEDIA_URL + image), 'is_main': is_main,
+             'width': width, 'height': height}
+            for image, is_main, width, height in (
+                ProductImage.objects.filter(product_id=row['id']).order_by('-is_main', 'order', 'id')
+                .values_list('image', 'is_main', 'width', 'height')
+            )
+        ]
+    if 'variants' in fields:
+        data['variants'] = variant_matrix(row['id'])
+    return json_response({'data': data})
+
+
+@api_view(max_age=AVAILABILITY_MAX_AGE)
+@replica_reads
+def availability(request):
+    """Остатки и цены вариантов: {"data": {"<id>": {"available", "price"}}}"""
+    items = variant_availability(parse_ids(request.GET))
+    return json_response({'data': {
+        str(variant_id): {'available': item['available'], 'price': serialize_value(item['price'])}
+        for variant_id, item in items.items()
+    }})
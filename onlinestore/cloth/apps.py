@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class ClothConfig(AppConfig):
     name = 'cloth'
+
+    def ready(self):
+        from . import signals  # noqa: F401
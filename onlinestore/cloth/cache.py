@@ -0,0 +1,271 @@
+"""
+Кэширование каталога: HTML карточек товаров и страниц для анонимных посетителей
+
+Карточка (components/product_card.html) не зависит от пользователя:
+состояние избранного накладывается в браузере (applyWishlistState в main.js),
+поэтому один и тот же фрагмент отдаётся всем на главной, в каталоге и в избранном.
+
+Ключ фрагмента -- id товара и штамп версии. Штамп меняется при сохранении
+или удалении Product, ProductVariant и ProductImage (cloth.signals), после чего
+старый фрагмент просто перестаёт запрашиваться и вытесняется по таймауту.
+Штамп -- время в наносекундах, а не счётчик: если ключ версии вытеснен
+из кэша, новый штамп не совпадёт ни с одним ранее сохранённым фрагментом.
+
+Страницы главной и каталога для анонимных посетителей кэшируются целиком
+(cache_anonymous_page) и сбрасываются общей версией каталога.
+"""
+from functools import lru_cache, wraps
+from urllib.parse import urlencode
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.contrib.messages import get_messages
+from django.db.models import prefetch_related_objects
+from django.http import HttpResponse
+from django.template.loader import get_template, render_to_string
+
+from . import metrics
+from .middleware import minify_html_content
+
+logger = logging.getLogger(__name__)
+
+CARD_TEMPLATE = 'components/product_card.html'
+CARD_VERSION_KEY = 'product_card_version:{}'
+# Общая версия всех карточек (меняется при изменении справочника цветов)
+CARD_GLOBAL_VERSION_KEY = 'product_card_version'
+CARD_FRAGMENT_KEY = 'product_card:{}:{}:{}:{}'
+# Версия каталога: меняется при любом изменении товаров, вариантов, категорий и изображений
+CATALOG_VERSION_KEY = 'catalog_version'
+PAGE_KEY = 'page_cache:{}:{}'
+PAGE_LOCK_KEY = 'page_cache_lock:{}:{}'
+# Заголовки ответа, которые сохраняются вместе со страницей (число найденных товаров -- для журнала поиска)
+CACHED_HEADERS = ('X-Search-Results',)
+
+
+def _new_version():
+    return time.time_ns()
+
+
+@lru_cache(maxsize=None)
+def template_version(template_name):
+    """Хэш исходника шаблона: после деплоя с новой разметкой старые кэши не используются"""
+    source = get_template(template_name).template.source
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()[:8]
+
+
+def bump_card_versions(product_ids):
+    """Сбросить кэш карточек указанных товаров"""
+    versions = {CARD_VERSION_KEY.format(product_id): _new_version() for product_id in set(product_ids)}
+    if versions:
+        cache.set_many(versions, timeout=None)
+
+
+def bump_all_card_versions():
+    """Сбросить кэш всех карточек"""
+    cache.set(CARD_GLOBAL_VERSION_KEY, _new_version(), timeout=None)
+
+
+def bump_catalog_version():
+    """Сбросить кэш страниц каталога"""
+    cache.set(CATALOG_VERSION_KEY, _new_version(), timeout=None)
+
+
+def get_catalog_version():
+    """Текущая версия каталога (создаётся, если ключ вытеснен из кэша)"""
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, _new_version(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def invalidate_products(product_ids):
+    """Товары изменились: сбросить их карточки и кэш страниц каталога"""
+    bump_card_versions(product_ids)
+    bump_catalog_version()
+
+
+def get_card_versions(product_ids):
+    """
+    Текущие штампы версий карточек одним обращением к кэшу
+
+    Returns:
+        tuple: (общая версия, {product_id: версия})
+    """
+    keys = {CARD_VERSION_KEY.format(product_id): product_id for product_id in product_ids}
+    found = cache.get_many([CARD_GLOBAL_VERSION_KEY, *keys])
+
+    missing = {}
+    global_version = found.pop(CARD_GLOBAL_VERSION_KEY, None)
+    if global_version is None:
+        global_version = missing[CARD_GLOBAL_VERSION_KEY] = _new_version()
+
+    versions = {}
+    for key, product_id in keys.items():
+        if key not in found:
+            found[key] = missing[key] = _new_version()
+        versions[product_id] = found[key]
+    if missing:
+        cache.set_many(missing, timeout=None)
+    return global_version, versions
+
+
+def _card_context(product):
+    """
+    Данные карточки из предзагруженных images и variants__color
+
+    Порядок совпадает с get_main_image() и variants.first():
+    изображения -- по ProductImage.Meta.ordering, варианты -- по id.
+    """
+    images = list(product.images.all())
+    variants = sorted(product.variants.all(), key=lambda variant: variant.pk)
+    return {
+        'product': product,
+        'main_image': images[0] if images else None,
+        'first_variant': variants[0] if variants else None,
+    }
+
+
+def render_product_cards(products):
+    """
+    HTML карточек товаров в исходном порядке
+
+    Из кэша берутся все готовые фрагменты сразу (get_many); изображения
+    и варианты подгружаются только для товаров, которых в кэше нет.
+    """
+    products = list(products)
+    if not products:
+        return []
+
+    global_version, versions = get_card_versions([product.id for product in products])
+    keys = {
+        product.id: CARD_FRAGMENT_KEY.format(
+            product.id, versions[product.id], global_version, template_version(CARD_TEMPLATE)
+        )
+        for product in products
+    }
+    fragments = cache.get_many(list(keys.values()))
+
+    misses = [product for product in products if keys[product.id] not in fragments]
+    for product in products:
+        metrics.record_cache('product_card', keys[product.id] in fragments)
+
+    if misses:
+        prefetch_related_objects(misses, 'images', 'variants__color')
+        rendered = {keys[product.id]: render_to_string(CARD_TEMPLATE, _card_context(product)) for product in misses}
+        cache.set_many(rendered, timeout=settings.PRODUCT_CARD_CACHE_TIMEOUT)
+        fragments.update(rendered)
+        logger.debug(f"Rendered {len(misses)} of {len(products)} product cards")
+
+    return [fragments[keys[product.id]] for product in products]
+
+
+def normalize_query(query, lists=(), defaults=None):
+    """
+    Канонический вид GET-параметров для ключа кэша
+
+    Пустые значения отбрасываются, параметры-списки (size, color) сортируются,
+    отсутствующие параметры из defaults подставляются: ?sort=-created_at
+    и пустая строка запроса дают одну и ту же страницу. Значение по умолчанию
+    может быть функцией от GET-параметров.
+    """
+    params = {}
+    for key in sorted(query):
+        values = [value for value in query.getlist(key) if value]
+        if not values:
+            continue
+        params[key] = sorted(set(values)) if key in lists else values[-1:]
+    for key, value in (defaults or {}).items():
+        if key not in params:
+            params[key] = [value(query) if callable(value) else value]
+    return urlencode([(key, value) for key in sorted(params) for value in params[key]])
+
+
+def page_cache_keys(view_name, query):
+    """Ключи записи и блокировки перестроения страницы"""
+    digest = hashlib.md5(query.encode('utf-8')).hexdigest()
+    return PAGE_KEY.format(view_name, digest), PAGE_LOCK_KEY.format(view_name, digest)
+
+
+def cache_anonymous_page(lists=(), defaults=None):
+    """
+    Кэш страницы целиком для анонимных GET-запросов
+
+    Ключ -- имя view и нормализованная строка запроса (normalize_query).
+    Запись свежа PAGE_CACHE_TIMEOUT секунд и пока не сменилась версия каталога.
+    Устаревшая запись (stale-while-revalidate) ещё PAGE_CACHE_STALE_TIMEOUT
+    секунд отдаётся всем, кроме одного запроса, который взял блокировку
+    и перестраивает страницу: при сбросе кэша под нагрузкой рендеринг
+    не выполняется параллельно сотней процессов.
+
+    PAGE_CACHE_TIMEOUT = 0 отключает кэш страниц.
+
+    Сохраняется уже минифицированный HTML, чтобы не минифицировать его
+    на каждом попадании (ResponseCompressionMiddleware пропускает такие ответы).
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            if (not settings.PAGE_CACHE_TIMEOUT or request.method not in ('GET', 'HEAD')
+                    or request.user.is_authenticated or len(get_messages(request))):
+                return view_func(request, *args, **kwargs)
+
+            key, lock_key = page_cache_keys(view_func.__name__, normalize_query(request.GET, lists, defaults))
+            found = cache.get_many([key, CATALOG_VERSION_KEY])
+            version = found.get(CATALOG_VERSION_KEY)
+            if version is None:
+                version = _new_version()
+                cache.set(CATALOG_VERSION_KEY, version, timeout=None)
+
+            entry = found.get(key)
+            if entry and entry['version'] == version and entry['fresh_until'] > time.time():
+                metrics.record_cache('page', True)
+                return _cached_response(entry, 'hit')
+
+            locked = False
+            if entry:
+                locked = cache.add(lock_key, 1, timeout=settings.PAGE_CACHE_LOCK_TIMEOUT)
+                if not locked:
+                    # Страницу уже перестраивает другой запрос
+                    metrics.record_cache('page', True)
+                    return _cached_response(entry, 'stale')
+
+            metrics.record_cache('page', False)
+            try:
+                response = view_func(request, *args, **kwargs)
+                if response.status_code == 200 and not response.streaming and not response.cookies:
+                    entry = _make_entry(response, version)
+                    cache.set(key, entry, timeout=settings.PAGE_CACHE_TIMEOUT + settings.PAGE_CACHE_STALE_TIMEOUT)
+                    response = _cached_response(entry, 'miss')
+            finally:
+                if locked:
+                    cache.delete(lock_key)
+            return response
+        return wrapper
+    return decorator
+
+
+def _make_entry(response, version):
+    content = response.content
+    content_type = response.get('Content-Type', '')
+    minified = settings.HTML_MINIFY and content_type.startswith('text/html')
+    if minified:
+        content = minify_html_content(content, response.charset or 'utf-8')
+    return {
+        'content': content,
+        'content_type': content_type,
+        'headers': {header: response[header] for header in CACHED_HEADERS if header in response},
+        'minified': minified,
+        'version': version,
+        'fresh_until': time.time() + settings.PAGE_CACHE_TIMEOUT,
+    }
+
+
+def _cached_response(entry, status):
+    response = HttpResponse(entry['content'], content_type=entry['content_type'], headers=entry.get('headers'))
+    response.html_minified = entry['minified']
+    response['X-Page-Cache'] = status
+    return response
@@ -0,0 +1,88 @@
+"""
+Чтение с реплик PostgreSQL
+
+Реплики перечисляются в settings.REPLICA_DATABASES. На реплику уходят
+только чтения внутри view, помеченных @replica_reads (главная, каталог,
+страница товара, панель администратора); всё остальное -- на основную базу.
+
+Согласованность "прочитал то, что записал":
+  - после первой записи в запросе все следующие чтения идут на основную базу;
+  - внутри transaction.atomic(), открытой во view, чтения тоже идут на неё;
+  - ответ на POST (и другие небезопасные методы) ставит cookie на
+    REPLICA_PIN_SECONDS, и следующие запросы этого посетителя читают
+    с основной базы, пока реплика догоняет (ReplicaPinningMiddleware).
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import random
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Реплика, выбранная для текущего запроса, и глубина transaction.atomic()
+# на основной базе при входе во view (None -- читать с основной базы)
+_replica = ContextVar('replica_alias', default=None)
+# Запрос привязан к основной базе: была запись или cookie после POST
+_pinned = ContextVar('pinned_to_primary', default=False)
+
+PIN_COOKIE = 'primary_pin'
+
+# Сессии, пользователи и корзина меняются постоянно и не терпят отставания реплики
+PRIMARY_ONLY_MODELS = {'sessions.session', 'cloth.user', 'cloth.cart', 'cloth.cartitem'}
+
+
+def replica_reads(view_func):
+    """Разрешить view читать с реплики (одна реплика на весь запрос)"""
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        replicas = settings.REPLICA_DATABASES
+        if not replicas or request.method not in ('GET', 'HEAD'):
+            return view_func(request, *args, **kwargs)
+        depth = len(connections[DEFAULT_DB_ALIAS].atomic_blocks)
+        token = _replica.set((random.choice(replicas), depth))
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            _replica.reset(token)
+    return wrapper
+
+
+def pin_to_primary():
+    """До конца запроса читать только с основной базы"""
+    _pinned.set(True)
+
+
+@contextmanager
+def primary_pinning(pinned):
+    """Рамки одного запроса: привязка к основной базе не переживает запрос"""
+    token = _pinned.set(pinned)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+class ReplicaRouter:
+    """Роутер: запись всегда в default, чтение -- см. описание модуля"""
+
+    def db_for_read(self, model, **hints):
+        current = _replica.get()
+        if current is None or _pinned.get() or model._meta.label_lower in PRIMARY_ONLY_MODELS:
+            return DEFAULT_DB_ALIAS
+        replica, depth = current
+        # Транзакция, открытая самим view, читает основную базу
+        if len(connections[DEFAULT_DB_ALIAS].atomic_blocks) > depth:
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # На репликах те же данные, что и в основной базе
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return None
@@ -0,0 +1,411 @@
+"""
+Sitemap и товарный фид (YML) на диске
+
+Файлы строятся командой build_feeds в FEEDS_DIR и отдаются как есть
+(nginx или view feed_file):
+  - sitemap.xml -- индекс sitemap;
+  - sitemap-pages.xml -- главная, каталог и категории;
+  - sitemap-products-N.xml -- товары с id из диапазона
+    [N * CHUNK_SIZE, (N + 1) * CHUNK_SIZE);
+  - products.yml -- фид для маркетплейсов: предложение на каждый вариант
+    товара с ценой, остатком, размером, цветом и изображениями.
+
+Товары читаются по диапазонам id итератором values(), поэтому в памяти
+одновременно не больше одного диапазона. XML пишется потоково
+(XMLGenerator) во временный файл, который затем атомарно подменяет
+прежний (os.replace): читатели никогда не видят недописанный файл.
+
+Пересборка инкрементальная. Для каждого диапазона одним агрегирующим
+запросом на таблицу считается подпись: число строк и максимальный
+updated_at товаров, вариантов (плюс сумма остатков: они меняются через
+update() без updated_at) и изображений. Переписываются только диапазоны,
+подпись которых изменилась с прошлого запуска (state.json). Фид собирается
+из сохранённых фрагментов диапазонов (parts/offers-N.xml) простым
+копированием, перестраиваются только изменившиеся фрагменты.
+"""
+from contextlib import contextmanager
+from xml.sax.saxutils import XMLGenerator
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+
+from django.conf import settings
+from django.db.models import Count, F, Max, Sum
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Category, Product, ProductImage, ProductVariant
+
+logger = logging.getLogger(__name__)
+
+# Товаров в одном файле sitemap (протокол допускает до 50 000 адресов)
+CHUNK_SIZE = 10000
+SITEMAP_NS = 'http://www.sitemaps.org/schemas/sitemap/0.9'
+INDEX_NAME = 'sitemap.xml'
+PAGES_NAME = 'sitemap-pages.xml'
+FEED_NAME = 'products.yml'
+STATE_NAME = 'state.json'
+PARTS_DIR = 'parts'
+# Файлы, которые можно отдавать посетителям (фрагменты фида и state.json -- нет)
+PUBLIC_NAME = re.compile(r'^(sitemap\.xml|sitemap-pages\.xml|sitemap-products-\d+\.xml|products\.yml)$')
+
+
+def products_sitemap_name(chunk):
+    return f'sitemap-products-{chunk}.xml'
+
+
+def offers_part_name(chunk):
+    return os.path.join(PARTS_DIR, f'offers-{chunk}.xml')
+
+
+def is_public_file(name):
+    return bool(PUBLIC_NAME.match(name))
+
+
+@contextmanager
+def atomic_write(path):
+    """Текстовый файл, который появляется под именем path только целиком"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as out:
+            yield out
+        # mkstemp создаёт файл 0600, а отдаёт его веб-сервер
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class XMLWriter:
+    """Потоковая запись XML поверх XMLGenerator"""
+
+    def __init__(self, out):
+        self.xml = XMLGenerator(out, encoding='utf-8', short_empty_elements=True)
+
+    def declaration(self):
+        self.xml.startDocument()
+
+    def start(self, name, attrs=None):
+        self.xml.startElement(name, {key: str(value) for key, value in (attrs or {}).items()})
+
+    def end(self, name):
+        self.xml.endElement(name)
+
+    def element(self, name, text='', attrs=None):
+        self.start(name, attrs)
+        self.xml.characters(str(text))
+        self.end(name)
+
+    def newline(self):
+        self.xml.ignorableWhitespace('\n')
+
+    def finish(self):
+        self.xml.endDocument()
+
+
+def absolute_url(path):
+    return settings.SITE_URL.rstrip('/') + path
+
+
+def _isoformat(value):
+    return timezone.localtime(value).isoformat(timespec='seconds')
+
+
+# ---------------------------------------------------------
+# Подписи диапазонов
+# ---------------------------------------------------------
+
+def _chunk_stats(queryset, id_field, chunk_size, **aggregates):
+    """{номер диапазона: {агрегат: значение}} одним GROUP BY"""
+    rows = (
+        queryset.annotate(chunk=F(id_field) / chunk_size)
+        .values('chunk').annotate(**aggregates).order_by()
+    )
+    return {row.pop('chunk'): row for row in rows}
+
+
+def chunk_signatures(chunk_size=CHUNK_SIZE):
+    """
+    Подписи диапазонов для sitemap и фида
+
+    Returns:
+        tuple: ({chunk: подпись sitemap}, {chunk: подпись фида}, {chunk: max updated_at товаров})
+    """
+    products = _chunk_stats(
+        Product.objects.filter(is_active=True), 'id', chunk_size,
+        count=Count('id'), updated=Max('updated_at'),
+    )
+    variants = _chunk_stats(
+        ProductVariant.objects.filter(product__is_active=True), 'product_id', chunk_size,
+        count=Count('id'), updated=Max('updated_at'), stock=Sum('stock_quantity'),
+    )
+    images = _chunk_stats(
+        ProductImage.objects.filter(product__is_active=True), 'product_id', chunk_size,
+        count=Count('id'), updated=Max('updated_at'),
+    )
+
+    sitemap, feed, lastmod = {}, {}, {}
+    for chunk, row in products.items():
+        sitemap[chunk] = f"{row['count']}|{row['updated']}"
+        parts = [sitemap[chunk]] + [
+            '|'.join(str(value) for value in stats.get(chunk, {}).values())
+            for stats in (variants, images)
+        ]
+        feed[chunk] = hashlib.md5('/'.join(parts).encode('utf-8')).hexdigest()
+        lastmod[chunk] = row['updated']
+    return sitemap, feed, lastmod
+
+
+def _global_signature(chunk_size):
+    """Всё, от чего зависят сразу все файлы: адрес сайта и размер диапазона"""
+    return f'{settings.SITE_URL}|{settings.MEDIA_URL}|{chunk_size}'
+
+
+# ---------------------------------------------------------
+# Sitemap
+# ---------------------------------------------------------
+
+def _chunk_products(chunk, chunk_size, *fields):
+    """Активные товары диапазона по возрастанию id, без загрузки всего диапазона в память"""
+    return (
+        Product.objects.filter(is_active=True, id__gte=chunk * chunk_size, id__lt=(chunk + 1) * chunk_size)
+        .order_by('id').values_list(*fields).iterator(chunk_size=2000)
+    )
+
+
+def write_products_sitemap(path, chunk, chunk_size=CHUNK_SIZE):
+    """Sitemap товаров одного диапазона id; возвращает число адресов"""
+    count = 0
+    with atomic_write(path) as out:
+        xml = XMLWriter(out)
+        xml.declaration()
+        xml.start('urlset', {'xmlns': SITEMAP_NS})
+        for slug, updated_at in _chunk_products(chunk, chunk_size, 'slug', 'updated_at'):
+            xml.newline()
+            xml.start('url')
+            xml.element('loc', absolute_url(reverse('product_detail', args=[slug])))
+            xml.element('lastmod', _isoformat(updated_at))
+            xml.end('url')
+            count += 1
+        xml.newline()
+        xml.end('urlset')
+        xml.finish()
+    return count
+
+
+def write_pages_sitemap(path):
+    """Главная, каталог и страницы категорий"""
+    catalog = reverse('catalog')
+    with atomic_write(path) as out:
+        xml = XMLWriter(out)
+        xml.declaration()
+        xml.start('urlset', {'xmlns': SITEMAP_NS})
+        urls = [reverse('home'), catalog] + [
+            f'{catalog}?category={slug}'
+            for slug in Category.objects.filter(is_active=True).order_by('order', 'name').values_list('slug', flat=True)
+        ]
+        for url in urls:
+            xml.newline()
+            xml.start('url')
+            xml.element('loc', absolute_url(url))
+            xml.end('url')
+        xml.newline()
+        xml.end('urlset')
+        xml.finish()
+
+
+def write_sitemap_index(path, lastmod):
+    """Индекс: файл страниц и файлы диапазонов с датой последнего изменения"""
+    with atomic_write(path) as out:
+        xml = XMLWriter(out)
+        xml.declaration()
+        xml.start('sitemapindex', {'xmlns': SITEMAP_NS})
+        entries = [(PAGES_NAME, None)] + [(products_sitemap_name(chunk), lastmod[chunk]) for chunk in sorted(lastmod)]
+        for name, updated in entries:
+            xml.newline()
+            xml.start('sitemap')
+            xml.element('loc', absolute_url(reverse('feed_file', args=[name])))
+            if updated is not None:
+                xml.element('lastmod', _isoformat(updated))
+            xml.end('sitemap')
+        xml.newline()
+        xml.end('sitemapindex')
+        xml.finish()
+
+
+# ---------------------------------------------------------
+# Товарный фид
+# ---------------------------------------------------------
+
+def write_offers_part(path, chunk, chunk_size=CHUNK_SIZE):
+    """
+    Фрагмент <offers> одного диапазона: предложение на каждый вариант
+
+    Варианты и изображения диапазона читаются двумя запросами и группируются
+    по товару; товары идут итератором.
+
+    Returns:
+        int: число предложений
+    """
+    low, high = chunk * chunk_size, (chunk + 1) * chunk_size
+    variants = {}
+    for row in (
+        ProductVariant.objects.filter(product_id__gte=low, product_id__lt=high, product__is_active=True)
+        .order_by('product_id', 'id')
+        .values_list('product_id', 'id', 'sku', 'price', 'stock_quantity', 'size__name', 'color__name')
+        .iterator(chunk_size=2000)
+    ):
+        variants.setdefault(row[0], []).append(row[1:])
+    pictures = {}
+    for product_id, image in (
+        ProductImage.objects.filter(product_id__gte=low, product_id__lt=high, product__is_active=True)
+        .order_by('product_id', '-is_main', 'order', 'id').values_list('product_id', 'image')
+        .iterator(chunk_size=2000)
+    ):
+        pictures.setdefault(product_id, []).append(absolute_url(settings.MEDIA_URL + image))
+
+    count = 0
+    with atomic_write(path) as out:
+        xml = XMLWriter(out)
+        products = _chunk_products(chunk, chunk_size, 'id', 'name', 'slug', 'description', 'category_id', 'material')
+        for product_id, name, slug, description, category_id, material in products:
+            url = absolute_url(reverse('product_detail', args=[slug]))
+            for variant_id, sku, price, stock, size, color in variants.get(product_id, []):
+                xml.newline()
+                xml.start('offer', {'id': variant_id, 'group_id': product_id,
+                                    'available': 'true' if stock > 0 else 'false'})
+                xml.element('name', name)
+                xml.element('url', url)
+                xml.element('price', price)
+                xml.element('currencyId', 'RUR')
+                if category_id:
+                    xml.element('categoryId', category_id)
+                for picture in pictures.get(product_id, [])[:10]:
+                    xml.element('picture', picture)
+                xml.element('vendorCode', sku)
+                xml.element('count', stock)
+                if description:
+                    xml.element('description', description)
+                for param, value in (('Размер', size), ('Цвет', color), ('Материал', material)):
+                    if value:
+                        xml.element('param', value, {'name': param})
+                xml.end('offer')
+                count += 1
+        xml.finish()
+    return count
+
+
+def write_feed(path, parts):
+    """Фид целиком: шапка магазина и категории, затем готовые фрагменты предложений"""
+    with atomic_write(path) as out:
+        xml = XMLWriter(out)
+        xml.declaration()
+        xml.start('yml_catalog', {'date': timezone.localtime().strftime('%Y-%m-%d %H:%M')})
+        xml.start('shop')
+        xml.element('name', settings.FEED_SHOP_NAME)
+        xml.element('company', settings.FEED_COMPANY_NAME)
+        xml.element('url', absolute_url('/'))
+        xml.start('currencies')
+        xml.element('currency', attrs={'id': 'RUR', 'rate': '1'})
+        xml.end('currencies')
+        xml.newline()
+        xml.start('categories')
+        for category_id, name in Category.objects.filter(is_active=True).order_by('id').values_list('id', 'name'):
+            xml.newline()
+            xml.element('category', name, {'id': category_id})
+        xml.newline()
+        xml.end('categories')
+        xml.newline()
+        xml.start('offers')
+        # Закрывает открывающий тег <offers> перед копированием фрагментов
+        xml.newline()
+        for part in parts:
+            with open(part, encoding='utf-8') as source:
+                shutil.copyfileobj(source, out)
+        xml.newline()
+        xml.end('offers')
+        xml.end('shop')
+        xml.end('yml_catalog')
+        xml.newline()
+        xml.finish()
+
+
+# ---------------------------------------------------------
+# Сборка
+# ---------------------------------------------------------
+
+def _load_state(path):
+    try:
+        with open(path, encoding='utf-8') as source:
+            return json.load(source)
+    except (OSError, ValueError):
+        return {}
+
+
+def build_feeds(full=False, chunk_size=CHUNK_SIZE):
+    """
+    Пересобрать sitemap и фид в FEEDS_DIR
+
+    Args:
+        full: переписать все диапазоны, даже неизменившиеся
+        chunk_size: товаров (по id) в одном диапазоне
+
+    Returns:
+        dict: {'chunks', 'sitemaps_written', 'parts_written', 'removed', 'urls', 'offers'};
+              urls и offers -- в переписанных диапазонах
+    """
+    root = str(settings.FEEDS_DIR)
+    state_path = os.path.join(root, STATE_NAME)
+    state = _load_state(state_path)
+    signature = _global_signature(chunk_size)
+    if full or state.get('global') != signature:
+        state = {}
+
+    sitemap_signatures, feed_signatures, lastmod = chunk_signatures(chunk_size)
+    # В JSON ключи -- строки
+    old_sitemaps, old_parts = state.get('sitemap', {}), state.get('feed', {})
+    stats = {'chunks': len(lastmod), 'sitemaps_written': 0, 'parts_written': 0, 'removed': 0, 'urls': 0, 'offers': 0}
+
+    for chunk in sorted(lastmod):
+        sitemap_path = os.path.join(root, products_sitemap_name(chunk))
+        if old_sitemaps.get(str(chunk)) != sitemap_signatures[chunk] or not os.path.exists(sitemap_path):
+            stats['urls'] += write_products_sitemap(sitemap_path, chunk, chunk_size)
+            stats['sitemaps_written'] += 1
+        part_path = os.path.join(root, offers_part_name(chunk))
+        if old_parts.get(str(chunk)) != feed_signatures[chunk] or not os.path.exists(part_path):
+            stats['offers'] += write_offers_part(part_path, chunk, chunk_size)
+            stats['parts_written'] += 1
+
+    # Диапазоны, в которых не осталось активных товаров
+    stale = {int(chunk) for chunk in set(old_sitemaps) | set(old_parts)} - set(lastmod)
+    for chunk in stale:
+        for name in (products_sitemap_name(chunk), offers_part_name(chunk)):
+            try:
+                os.remove(os.path.join(root, name))
+                stats['removed'] += 1
+            except FileNotFoundError:
+                pass
+
+    # Индекс, страницы и сборка фида -- небольшие файлы, переписываются всегда
+    write_pages_sitemap(os.path.join(root, PAGES_NAME))
+    write_sitemap_index(os.path.join(root, INDEX_NAME), lastmod)
+    write_feed(os.path.join(root, FEED_NAME), [os.path.join(root, offers_part_name(chunk)) for chunk in sorted(lastmod)])
+
+    with atomic_write(state_path) as out:
+        json.dump({
+            'global': signature,
+            'sitemap': {str(chunk): value for chunk, value in sitemap_signatures.items()},
+            'feed': {str(chunk): value for chunk, value in feed_signatures.items()},
+        }, out)
+
+    logger.info(f"Feeds built: {stats}")
+    return stats
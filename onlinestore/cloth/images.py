@@ -0,0 +1,376 @@
+"""
+Миниатюры изображений товаров
+
+Для каждого загруженного изображения строятся уменьшенные копии
+фиксированной ширины (RENDITIONS) в WebP и JPEG. Файлы лежат рядом
+с оригиналом, в имени -- хэш содержимого оригинала, поэтому URL меняется
+только при замене картинки и их можно кэшировать бессрочно.
+
+Кроме того, ResizeCache строит копию любого изображения из MEDIA_ROOT
+одного из разрешённых размеров (IMAGE_RESIZE_SIZES) по первому запросу
+(/img/<w>x<h>/<path>) и хранит её в ограниченном по объёму дисковом кэше.
+"""
+import base64
+import hashlib
+import io
+import logging
+import os
+import posixpath
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+# Ширина миниатюр по местам использования
+RENDITIONS = {
+    'cart': 160,
+    'card': 400,
+    'detail': 800,
+    'zoom': 1600,
+}
+
+# Формат: (расширение, формат Pillow, параметры сохранения)
+FORMATS = {
+    'webp': ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    'jpeg': ('jpg', 'JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+}
+
+HASH_LENGTH = 12
+
+# Превью-заглушка (LQIP): крошечная JPEG-копия, встраиваемая в HTML как data URI
+PLACEHOLDER_WIDTH = 16
+PLACEHOLDER_QUALITY = 40
+
+
+def content_hash(data):
+    """Короткий хэш содержимого файла"""
+    return hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+
+
+def rendition_name(original_name, digest, rendition, fmt):
+    """
+    Имя файла миниатюры рядом с оригиналом
+
+    products/shirt.png -> products/shirt.3fa1c2d4e5b6.card.webp
+    """
+    directory, filename = posixpath.split(original_name)
+    stem = filename.rsplit('.', 1)[0]
+    extension = FORMATS[fmt][0]
+    return posixpath.join(directory, f"{stem}.{digest}.{rendition}.{extension}")
+
+
+def _encode(image, fmt):
+    _, pil_format, options = FORMATS[fmt]
+    if pil_format == 'JPEG' and image.mode != 'RGB':
+        # У JPEG нет прозрачности: подкладываем белый фон
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A') if 'A' in image.getbands() else None)
+        image = background
+    buffer = io.BytesIO()
+    image.save(buffer, pil_format, **options)
+    return buffer.getvalue()
+
+
+def build_placeholder(image):
+    """Data URI превью шириной PLACEHOLDER_WIDTH (~300-600 байт)"""
+    height = max(1, round(image.height * PLACEHOLDER_WIDTH / image.width))
+    preview = image.resize((PLACEHOLDER_WIDTH, height), Image.BILINEAR)
+    if preview.mode != 'RGB':
+        background = Image.new('RGB', preview.size, (255, 255, 255))
+        background.paste(preview, mask=preview.getchannel('A') if 'A' in preview.getbands() else None)
+        preview = background
+    buffer = io.BytesIO()
+    preview.save(buffer, 'JPEG', quality=PLACEHOLDER_QUALITY)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def build_renditions(original_name, storage=None):
+    """
+    Построить миниатюры для файла из хранилища
+
+    Уже существующие файлы не пересоздаются, поэтому функция безопасна
+    для повторного запуска. Не увеличивает изображения: если оригинал
+    уже, чем миниатюра, используется его собственная ширина.
+
+    Args:
+        original_name: имя файла в хранилище (ProductImage.image.name)
+        storage: хранилище, по умолчанию default_storage
+
+    Returns:
+        dict: {'hash': ..., 'width': ..., 'height': ..., 'placeholder': data URI,
+               'sizes': {'card': {'width': 400, 'webp': name, 'jpeg': name}, ...}}
+    """
+    storage = storage or default_storage
+    with storage.open(original_name, 'rb') as source:
+        data = source.read()
+    digest = content_hash(data)
+
+    with Image.open(io.BytesIO(data)) as opened:
+        original = ImageOps.exif_transpose(opened)
+        original = original.convert('RGBA' if 'A' in original.getbands() else 'RGB')
+
+    result = {
+        'hash': digest,
+        'width': original.width,
+        'height': original.height,
+        'placeholder': build_placeholder(original),
+        'sizes': {},
+    }
+    for rendition, target_width in RENDITIONS.items():
+        width = min(target_width, original.width)
+        height = max(1, round(original.height * width / original.width))
+        resized = None
+        entry = {'width': width}
+        for fmt in FORMATS:
+            name = rendition_name(original_name, digest, rendition, fmt)
+            if not storage.exists(name):
+                if resized is None:
+                    resized = original.resize((width, height), Image.LANCZOS) if width != original.width else original
+                name = storage.save(name, ContentFile(_encode(resized, fmt)))
+            entry[fmt] = name
+        result['sizes'][rendition] = entry
+    return result
+
+
+def setup_worker():
+    """
+    Инициализация процесса-воркера generate_renditions
+
+    При spawn/forkserver процесс стартует без настроенного Django; модуль
+    не импортирует модели, поэтому его можно загрузить до django.setup().
+    """
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+
+def delete_renditions(renditions, storage=None):
+    """Удалить файлы миниатюр, описанные в ProductImage.renditions"""
+    storage = storage or default_storage
+    for entry in renditions.get('sizes', {}).values():
+        for fmt in FORMATS:
+            name = entry.get(fmt)
+            if name:
+                try:
+                    storage.delete(name)
+                except OSError as e:
+                    logger.warning(f"Failed to delete rendition {name}: {e}")
+
+
+# =========================================================
+# RESIZE ON DEMAND
+# =========================================================
+
+# Формат результата по формату оригинала: (формат Pillow, content type, расширение)
+RESIZE_FORMATS = {
+    'JPEG': ('JPEG', 'image/jpeg', 'jpg'),
+    'PNG': ('PNG', 'image/png', 'png'),
+    'WEBP': ('WEBP', 'image/webp', 'webp'),
+}
+RESIZE_EXTENSIONS = {'.jpg': 'JPEG', '.jpeg': 'JPEG', '.png': 'PNG', '.webp': 'WEBP'}
+
+
+class ResizeCache:
+    """
+    Дисковый кэш уменьшенных изображений с вытеснением LRU
+
+    Ключ -- хэш пути, mtime и размера оригинала, целевого размера и формата,
+    поэтому при замене оригинала старые копии просто перестают запрашиваться
+    и со временем вытесняются. Время последнего обращения хранится в mtime
+    файла (os.utime при каждом попадании).
+
+    Одновременные промахи по одному ключу объединяются: внутри процесса --
+    через блокировку, между процессами -- через lock-файл, созданный с O_EXCL.
+    Остальные запросы ждут готовый файл, а не ресайзят картинку заново.
+    """
+
+    LOCK_STRIPES = 64
+    LOCK_TIMEOUT = 10
+    STALE_LOCK_SECONDS = 30
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = str(cache_dir)
+        self.max_bytes = max_bytes
+        self._locks = [threading.Lock() for _ in range(self.LOCK_STRIPES)]
+        self._size_lock = threading.Lock()
+        self._size = None
+
+    def key(self, source_path, width, height, fmt):
+        stat = os.stat(source_path)
+        raw = f"{source_path}:{stat.st_mtime_ns}:{stat.st_size}:{width}x{height}:{fmt}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def path_for(self, key, fmt):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.{RESIZE_FORMATS[fmt][2]}")
+
+    def get_or_create(self, source_path, width, height, fmt, key=None):
+        """
+        Путь к готовой копии (создаётся при первом обращении)
+
+        Returns:
+            tuple: (путь к файлу, было ли попадание в кэш)
+        """
+        key = key or self.key(source_path, width, height, fmt)
+        path = self.path_for(key, fmt)
+        if self._touch(path):
+            return path, True
+
+        with self._locks[int(key[:8], 16) % self.LOCK_STRIPES]:
+            if self._touch(path):
+                return path, True
+            lock_fd = self._acquire_file_lock(path)
+            try:
+                # Пока ждали, файл мог построить другой процесс
+                if self._touch(path):
+                    return path, True
+                data = resize_image(source_path, width, height, fmt)
+                self._write(path, data)
+            finally:
+                if lock_fd is not None:
+                    os.close(lock_fd)
+                    try:
+                        os.remove(path + '.lock')
+                    except OSError:
+                        pass
+
+        self._account(len(data))
+        return path, False
+
+    @staticmethod
+    def _touch(path):
+        """Отметить обращение к файлу; False, если файла нет"""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _acquire_file_lock(self, path):
+        """Межпроцессная блокировка; None, если не дождались (строим без неё)"""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lock_path = path + '.lock'
+        deadline = time.monotonic() + self.LOCK_TIMEOUT
+        while True:
+            try:
+                return os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if os.path.exists(path):
+                    return None
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > self.STALE_LOCK_SECONDS:
+                        # Процесс, создавший lock, упал
+                        os.remove(lock_path)
+                        continue
+                except OSError:
+                    continue
+                if time.monotonic() > deadline:
+                    logger.warning(f"Timed out waiting for {lock_path}")
+                    return None
+                time.sleep(0.05)
+
+    @staticmethod
+    def _write(path, data):
+        """Атомарная запись: читатели никогда не видят недописанный файл"""
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _account(self, added_bytes):
+        with self._size_lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._scan())
+            else:
+                self._size += added_bytes
+            if self._size > self.max_bytes:
+                self._size = self._evict()
+
+    def _scan(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(('.lock', '.tmp')):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        """
+        Удалить давно не запрошенные файлы до 90% лимита
+
+        Счётчик размера у каждого процесса свой и приблизительный,
+        поэтому при вытеснении размер всегда пересчитывается по диску.
+
+        Returns:
+            int: размер кэша после вытеснения
+        """
+        entries = sorted(self._scan(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        removed = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        logger.info(f"Image cache eviction: removed {removed} files, {total} bytes left")
+        return total
+
+
+def resize_image(source_path, width, height, fmt):
+    """
+    Уменьшить изображение, вписав его в прямоугольник width x height
+
+    Пропорции сохраняются, изображение не увеличивается. Размер 0 по одной
+    из сторон означает "без ограничения".
+
+    Returns:
+        bytes: закодированное изображение в формате fmt
+    """
+    with Image.open(source_path) as opened:
+        image = ImageOps.exif_transpose(opened)
+        box = (width or image.width, height or image.height)
+        image.thumbnail(box, Image.LANCZOS)
+        if fmt == 'JPEG' and image.mode not in ('RGB', 'L'):
+            background = Image.new('RGB', image.size, (255, 255, 255))
+            background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+            image = background
+        elif fmt != 'JPEG' and image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA')
+        buffer = io.BytesIO()
+        options = FORMATS['webp'][2] if fmt == 'WEBP' else FORMATS['jpeg'][2] if fmt == 'JPEG' else {'optimize': True}
+        image.save(buffer, fmt, **options)
+        return buffer.getvalue()
+
+
+_resize_cache = None
+
+
+def get_resize_cache():
+    """Кэш ресайза процесса (создаётся при первом обращении)"""
+    global _resize_cache
+    if _resize_cache is None or _resize_cache.cache_dir != str(settings.IMAGE_CACHE_DIR):
+        _resize_cache = ResizeCache(settings.IMAGE_CACHE_DIR, settings.IMAGE_CACHE_MAX_BYTES)
+    return _resize_cache
@@ -1,11 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+
 from django.core.management.base import BaseCommand
 from django.conf import settings
+from django.db import transaction
+
+from ...cache import invalidate_products
+from ...images import build_renditions, content_hash, delete_renditions
 from ...models import Product, ProductImage
-from pathlib import Path
+
+# Точное сопоставление файлов с товарами
+PRODUCT_MAPPING = {
+    'bazafutbolka.png': 'Базовая футболка',
+    'oversaiz.png': 'Оверсайз футболка',
+    'letneeplatie.png': 'Летнее платье',
+    'rubaskaplatie.png': 'Платье-рубашка',
+    'djinskurtka.png': 'Джинсовая куртка',
+    'vetrovka.png': 'Легкая ветровка',
+    'sviterblack.png': 'Вязаный свитер',
+    'beliedjemper.png': 'Тонкий джемпер',
+    'rubashkakrasnai.png': 'Классическая рубашка',
+    'rubashkalen.png': 'Льняная рубашка',
+    'bruki.png': 'Классические брюки',
+    'chinos.png': 'Чиносы',
+    'ybkakarandash.png': 'Юбка-карандаш',
+    'ybkaplise.png': 'Юбка плиссе',
+    'djinskras.png': 'Классические джинсы',
+    'djinssvisokoi.png': 'Джинсы с высокой талией',
+    'bezshapka1.png': 'Шапка',
+    'bezshapka2.png': 'Шарф',
+}
+
+
+def hash_file(path):
+    """Хэш содержимого файла (тот же, что хранится в ProductImage.renditions)"""
+    with open(path, 'rb') as f:
+        return content_hash(f.read())
+
+
+class ProductNameIndex:
+    """
+    Поиск товара по названию в памяти
+
+    В отличие от прежнего name__icontains(...).first(), точное совпадение
+    без учёта регистра важнее подстроки: файл для "Шапка" достанется товару
+    "Шапка", даже если раньше создан "Шапка-ушанка". Без точного совпадения --
+    первый товар, в названии которого есть подстрока, в порядке Product.Meta.ordering.
+    """
+
+    def __init__(self):
+        self.products = list(Product.objects.values_list('id', 'name'))
+        self.exact = {}
+        for product_id, name in self.products:
+            self.exact.setdefault(name.lower(), (product_id, name))
+
+    def find(self, name):
+        name = name.lower()
+        if name in self.exact:
+            return self.exact[name]
+        for product_id, product_name in self.products:
+            if name in product_name.lower():
+                return product_id, product_name
+        return None
 
 
 class Command(BaseCommand):
-    help = 'Привязывает фотографии к товарам'
+    """
+    Инкрементальная синхронизация файлов из PRODUCT_MAPPING с ProductImage
+
+    Прежняя версия удаляла все ProductImage и создавала записи заново.
+    Теперь команда меняет только записи на файлы из PRODUCT_MAPPING:
+    картинки, загруженные через админку, остаются. Удаляются повторные
+    записи на один файл и записи на файлы, которых нет на диске или для
+    которых не нашёлся товар.
+    """
+
+    help = ('Привязывает фотографии к товарам (инкрементальная синхронизация). '
+            'Записи на файлы вне PRODUCT_MAPPING не удаляются')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Только показать запланированные изменения')
+        parser.add_argument('--workers', type=int, default=8,
+                            help='Количество потоков для хэширования файлов')
 
     def handle(self, *args, **options):
         self.stdout.write(self.style.WARNING('\n' + '=' * 60))
@@ -18,78 +94,131 @@ class Command(BaseCommand):
             self.stdout.write(self.style.ERROR(f'Папка {media_path} не найдена!'))
             return
 
-        # Показываем файлы в папке
-        self.stdout.write('\n📁 Файлы в папке:')
-        files = []
-        for file in media_path.glob('*.png'):
-            files.append(file.name)
-            self.stdout.write(f'  - {file.name}')
+        files = sorted(name for name in PRODUCT_MAPPING if (media_path / name).is_file())
+        for name in sorted(set(PRODUCT_MAPPING) - set(files)):
+            self.stdout.write(self.style.WARNING(f'  ? {name} - файл отсутствует'))
+
+        # Хэшируем файлы параллельно: чтение с диска не держит GIL
+        self.stdout.write(f'\n📁 Хэширование файлов: {len(files)}')
+        with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+            hashes = dict(zip(files, executor.map(hash_file, [media_path / name for name in files])))
+
+        index = ProductNameIndex()
+        existing = {}
+        duplicates = []
+        for image in ProductImage.objects.filter(
+            image__in=[f'products/{name}' for name in PRODUCT_MAPPING]
+        ).only('id', 'product_id', 'image', 'is_main', 'renditions').order_by('id'):
+            if image.image.name in existing:
+                duplicates.append(image)
+            else:
+                existing[image.image.name] = image
+
+        plan = self.build_plan(files, hashes, index, existing, duplicates)
+        self.report(plan)
 
-        if not files:
-            self.stdout.write(self.style.ERROR('  Папка пуста!'))
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('\n🔍 Пробный запуск: изменения не применены'))
             return
 
-        # Удаляем старые записи из БД
-        self.stdout.write('\n🗑️ Удаление старых записей...')
-        old_count = ProductImage.objects.count()
-        ProductImage.objects.all().delete()
-        self.stdout.write(f'  Удалено записей: {old_count}')
-
-        # Точное сопоставление файлов с товарами
-        product_mapping = {
-            'bazafutbolka.png': 'Базовая футболка',
-            'oversaiz.png': 'Оверсайз футболка',
-            'letneeplatie.png': 'Летнее платье',
-            'rubaskaplatie.png': 'Платье-рубашка',
-            'djinskurtka.png': 'Джинсовая куртка',
-            'vetrovka.png': 'Легкая ветровка',
-            'sviterblack.png': 'Вязаный свитер',
-            'beliedjemper.png': 'Тонкий джемпер',
-            'rubashkakrasnai.png': 'Классическая рубашка',
-            'rubashkalen.png': 'Льняная рубашка',
-            'bruki.png': 'Классические брюки',
-            'chinos.png': 'Чиносы',
-            'ybkakarandash.png': 'Юбка-карандаш',
-            'ybkaplise.png': 'Юбка плиссе',
-            'djinskras.png': 'Классические джинсы',
-            'djinssvisokoi.png': 'Джинсы с высокой талией',
-            'bezshapka1.png': 'Шапка',
-            'bezshapka2.png': 'Шарф',
-        }
-
-        # Привязываем файлы к товарам
-        self.stdout.write('\n🔗 Привязка к товарам...')
-
-        assigned = 0
-        not_found = []
-
-        for filename, product_name in product_mapping.items():
-            if filename not in files:
-                self.stdout.write(self.style.WARNING(f'  ? {filename} - файл отсутствует'))
+        self.apply(plan, options['workers'])
+        self.stdout.write(self.style.SUCCESS('\n' + '=' * 60))
+        self.stdout.write(self.style.SUCCESS(
+            f"✅ Добавлено: {len(plan['create'])}, перепривязано: {len(plan['move'])}, "
+            f"обновлено: {len(plan['refresh'])}, удалено: {len(plan['delete'])}"
+        ))
+        self.stdout.write(self.style.SUCCESS('=' * 60 + '\n'))
+
+    def build_plan(self, files, hashes, index, existing, duplicates):
+        """Сравнение файлов с записями: что добавить, перепривязать, обновить и удалить"""
+        plan = {'create': [], 'move': [], 'refresh': [], 'delete': list(duplicates), 'not_found': []}
+
+        for name in files:
+            image_name = f'products/{name}'
+            image = existing.pop(image_name, None)
+            match = index.find(PRODUCT_MAPPING[name])
+            if match is None:
+                plan['not_found'].append(f'{name} (искали: {PRODUCT_MAPPING[name]})')
+                if image:
+                    plan['delete'].append(image)
                 continue
 
-            # Ищем товар по точному названию
-            product = Product.objects.filter(name__icontains=product_name).first()
-
-            if product:
-                ProductImage.objects.create(
-                    product=product,
-                    image=f'products/{filename}',
-                    is_main=True
-                )
-                self.stdout.write(self.style.SUCCESS(f'  ✓ {filename} -> "{product.name}"'))
-                assigned += 1
-            else:
-                not_found.append(f'{filename} (искали: {product_name})')
-                self.stdout.write(self.style.WARNING(f'  ? {filename} - товар "{product_name}" не найден'))
-
-        self.stdout.write('')
-        self.stdout.write(self.style.SUCCESS('=' * 60))
-        self.stdout.write(self.style.SUCCESS(f'✅ Привязано изображений: {assigned}'))
-
-        if not_found:
+            product_id, product_name = match
+            if image is None:
+                plan['create'].append((image_name, product_id, product_name))
+                continue
+            if image.product_id != product_id:
+                plan['move'].append((image, product_id, product_name))
+            if image.renditions.get('hash') != hashes[name]:
+                # Файл заменили (или миниатюры ещё не строились)
+                plan['refresh'].append(image)
+
+        # Записи на файлы, которых больше нет
+        plan['delete'].extend(existing.values())
+        return plan
+
+    def report(self, plan):
+        self.stdout.write('\n📋 План изменений:')
+        for image_name, _, product_name in plan['create']:
+            self.stdout.write(self.style.SUCCESS(f'  + {image_name} -> "{product_name}"'))
+        for image, _, product_name in plan['move']:
+            self.stdout.write(f'  ~ {image.image.name} -> "{product_name}"')
+        for image in plan['refresh']:
+            self.stdout.write(f'  ↻ {image.image.name} (изменилось содержимое)')
+        for image in plan['delete']:
+            self.stdout.write(self.style.ERROR(f'  - {image.image.name} (id={image.id})'))
+        if not any(plan[key] for key in ('create', 'move', 'refresh', 'delete')):
+            self.stdout.write('  Изменений нет')
+
+        if plan['not_found']:
             self.stdout.write(self.style.WARNING('\n⚠ Товары не найдены для:'))
-            for item in not_found:
+            for item in plan['not_found']:
                 self.stdout.write(f'  {item}')
 
-        self.stdout.write(self.style.SUCCESS('=' * 60 + '\n'))
\ No newline at end of file
+    def apply(self, plan, workers):
+        # Товары, чьи карточки изменятся (включая тех, от кого картинку забрали)
+        changed_products = {image.product_id for image in plan['delete'] + plan['refresh']}
+        changed_products.update(image.product_id for image, _, _ in plan['move'])
+        changed_products.update(product_id for _, product_id, _ in plan['move'] + plan['create'])
+
+        with transaction.atomic():
+            if plan['delete']:
+                ProductImage.objects.filter(id__in=[image.id for image in plan['delete']]).delete()
+
+            for image, product_id, _ in plan['move']:
+                image.product_id = product_id
+            if plan['move']:
+                ProductImage.objects.bulk_update([image for image, _, _ in plan['move']], ['product'])
+
+            # Новая картинка становится главной, только если у товара её ещё нет
+            with_main = set(ProductImage.objects.filter(
+                product_id__in=[product_id for _, product_id, _ in plan['create']], is_main=True
+            ).values_list('product_id', flat=True))
+            created = []
+            for image_name, product_id, _ in plan['create']:
+                created.append(ProductImage(product_id=product_id, image=image_name, is_main=product_id not in with_main))
+                with_main.add(product_id)
+            created = ProductImage.objects.bulk_create(created)
+
+        # Миниатюры удалённых записей, если на тот же файл не ссылается оставшаяся запись
+        still_used = set(ProductImage.objects.filter(
+            image__in=[image.image.name for image in plan['delete']]
+        ).values_list('image', flat=True))
+        for image in plan['delete']:
+            if image.renditions and image.image.name not in still_used:
+                delete_renditions(image.renditions)
+        for image in plan['refresh']:
+            if image.renditions:
+                delete_renditions(image.renditions)
+
+        # Миниатюры для новых и изменившихся файлов
+        to_render = created + plan['refresh']
+        if to_render:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = executor.map(build_renditions, [image.image.name for image in to_render])
+                for image, renditions in zip(to_render, results):
+                    image.apply_image_data(renditions)
+            ProductImage.objects.bulk_update(to_render, ProductImage.IMAGE_DATA_FIELDS)
+
+        # Массовые операции не отправляют сигналы -- сбрасываем кэш карточек и каталога явно
+        invalidate_products(changed_products)
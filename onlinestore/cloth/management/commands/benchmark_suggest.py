@@ -0,0 +1,67 @@
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...suggest import SuggestIndex, catalog_entries
+
+ADJECTIVES = ['льняная', 'хлопковая', 'шерстяная', 'классическая', 'оверсайз', 'летняя', 'linen', 'slim']
+NOUNS = ['рубашка', 'футболка', 'куртка', 'брюки', 'джинсы', 'платье', 'юбка', 'пальто', 'свитер']
+
+
+def synthetic_entries(count, seed=1):
+    """Записи индекса подсказок вида "льняная рубашка 1f" со случайной популярностью"""
+    rng = random.Random(seed)
+    return [
+        (f'{rng.choice(ADJECTIVES)} {rng.choice(NOUNS)} {i:x}', 'product', f'/product/{i}/', rng.random())
+        for i in range(count)
+    ]
+
+
+class Command(BaseCommand):
+    help = ('Скорость индекса подсказок поиска: построение и поиск по префиксам '
+            'на синтетических записях или на текущем каталоге')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entries', type=int, default=1_000_000,
+                            help='Сколько синтетических записей (по умолчанию 1 000 000)')
+        parser.add_argument('--queries', type=int, default=5000, help='Сколько запросов замерить')
+        parser.add_argument('--catalog', action='store_true',
+                            help='Взять записи из каталога в базе вместо синтетических')
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING('\n' + '=' * 60))
+        self.stdout.write(self.style.WARNING('СКОРОСТЬ ПОДСКАЗОК ПОИСКА'))
+        self.stdout.write(self.style.WARNING('=' * 60 + '\n'))
+
+        entries = catalog_entries() if options['catalog'] else synthetic_entries(options['entries'], options['seed'])
+        if not entries:
+            self.stdout.write(self.style.ERROR('Нет записей для индекса'))
+            return
+
+        start = time.perf_counter()
+        index = SuggestIndex(entries)
+        build_ms = (time.perf_counter() - start) * 1000
+        self.stdout.write(f'📦 Записей: {len(entries)}, ключей: {len(index.keys)}, '
+                          f'тяжёлых префиксов: {len(index.heavy)}')
+        self.stdout.write(f'🏗  Построение: {build_ms:.0f} мс')
+
+        # Запросы -- начала случайных слов записей, как при наборе
+        rng = random.Random(options['seed'])
+        queries = []
+        for text, _, _, _ in rng.choices(entries, k=options['queries']):
+            word = rng.choice(text.split())
+            queries.append(word[:rng.randint(1, len(word))])
+
+        timings = []
+        for query in queries:
+            start = time.perf_counter()
+            index.suggest(query)
+            timings.append((time.perf_counter() - start) * 1_000_000)
+        timings.sort()
+
+        self.stdout.write(f'🔍 Поиск ({len(timings)} запросов): медиана {statistics.median(timings):.0f} мкс, '
+                          f'p99 {timings[int(len(timings) * 0.99)]:.0f} мкс, максимум {timings[-1]:.0f} мкс')
+        self.stdout.write(self.style.SUCCESS('\n✅ Готово'))
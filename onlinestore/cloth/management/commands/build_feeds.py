@@ -0,0 +1,33 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ...feeds import CHUNK_SIZE, build_feeds
+
+
+class Command(BaseCommand):
+    help = ('Построение sitemap и товарного фида (YML) в FEEDS_DIR. Переписываются только '
+            'диапазоны товаров, изменившиеся с прошлого запуска. Запускать по расписанию, например раз в час')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Переписать все файлы, а не только изменившиеся')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help=f'Товаров (по id) в одном файле sitemap (по умолчанию {CHUNK_SIZE})')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING('\n' + '=' * 60))
+        self.stdout.write(self.style.WARNING('SITEMAP И ТОВАРНЫЙ ФИД'))
+        self.stdout.write(self.style.WARNING('=' * 60 + '\n'))
+        self.stdout.write(f"📁 Каталог: {settings.FEEDS_DIR}")
+        self.stdout.write(f"🌐 Сайт: {settings.SITE_URL}")
+
+        start = time.perf_counter()
+        stats = build_feeds(full=options['full'], chunk_size=options['chunk_size'])
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(f"📦 Диапазонов товаров: {stats['chunks']}")
+        self.stdout.write(f"🗺  Переписано sitemap: {stats['sitemaps_written']} ({stats['urls']} адресов)")
+        self.stdout.write(f"🛒 Переписано фрагментов фида: {stats['parts_written']} ({stats['offers']} предложений)")
+        self.stdout.write(f"🗑  Удалено устаревших файлов: {stats['removed']}")
+        self.stdout.write(self.style.SUCCESS(f'\n✅ Готово за {elapsed:.1f} c'))
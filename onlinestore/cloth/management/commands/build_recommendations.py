@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...recommendations import DEFAULT_TOP_K, build_recommendations
+
+
+class Command(BaseCommand):
+    help = 'Пересчёт рекомендаций "С этим товаром покупают" по совместным покупкам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K,
+                            help='Сколько рекомендаций хранить для каждого товара')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING('\n' + '=' * 60))
+        self.stdout.write(self.style.WARNING('ПЕРЕСЧЁТ РЕКОМЕНДАЦИЙ'))
+        self.stdout.write(self.style.WARNING('=' * 60 + '\n'))
+
+        start = time.perf_counter()
+        stats = build_recommendations(options['top_k'])
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(f"🛍  Товаров с рекомендациями: {stats['products']}")
+        self.stdout.write(f"🔗 По совместным покупкам: {stats['co_purchase']}")
+        self.stdout.write(f"🧵 Похожие по описанию: {stats['similar']}")
+        self.stdout.write(f"📂 Популярное в категории: {stats['category']}")
+        self.stdout.write(self.style.SUCCESS(f'\n✅ Готово за {elapsed:.1f} c'))
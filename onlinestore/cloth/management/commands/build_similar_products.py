@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...similarity import DEFAULT_TOP_K, build_similarity_index
+
+
+class Command(BaseCommand):
+    help = ('Индекс похожих товаров по описанию (TF-IDF). По умолчанию пересчитываются '
+            'только товары, изменённые после прошлого запуска: команду можно ставить в cron каждые несколько минут')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top-k', type=int, default=DEFAULT_TOP_K,
+                            help='Сколько похожих товаров хранить для каждого товара')
+        parser.add_argument('--full', action='store_true',
+                            help='Построить индекс целиком (например, раз в сутки)')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING('\n' + '=' * 60))
+        self.stdout.write(self.style.WARNING('ИНДЕКС ПОХОЖИХ ТОВАРОВ'))
+        self.stdout.write(self.style.WARNING('=' * 60 + '\n'))
+
+        start = time.perf_counter()
+        stats = build_similarity_index(options['top_k'], full=options['full'])
+        elapsed = time.perf_counter() - start
+
+        mode = 'целиком' if stats['mode'] == 'full' else 'инкрементально'
+        self.stdout.write(f"🧮 Построение: {mode}")
+        self.stdout.write(f"🛍  Товаров в индексе: {stats['products']}")
+        self.stdout.write(f"✏️  Пересчитано строк: {stats['changed']}")
+        self.stdout.write(self.style.SUCCESS(f'\n✅ Готово за {elapsed:.1f} c'))
@@ -0,0 +1,448 @@
+from array import array
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from itertools import accumulate
+import random
+import time
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from ...models import (
+    Product, Category, Size, Color, Gender,
+    ProductVariant, ProductImage, Role, OrderStatus,
+    TransactionStatus, Order, OrderItem,
+    Cart, CartItem, Transaction, Review, User
+)
+from .reset_products import Command as ResetProductsCommand, cyrillic_slugify
+
+# Словари для генерации названий товаров
+NAME_ADJECTIVES = [
+    'Базовая', 'Классическая', 'Оверсайз', 'Льняная', 'Хлопковая', 'Летняя', 'Зимняя',
+    'Легкая', 'Теплая', 'Приталенная', 'Прямая', 'Укороченная', 'Удлиненная', 'Вязаная',
+]
+NAME_NOUNS = {
+    'outerwear': ['куртка', 'ветровка', 'парка', 'жилетка'],
+    'dresses': ['платье', 'сарафан', 'туника'],
+    'shirts': ['рубашка', 'блуза', 'сорочка'],
+    'pants': ['брюки', 'чиносы', 'кюлоты'],
+    'skirts': ['юбка', 'мини-юбка', 'юбка-миди'],
+    'jeans': ['джинсы', 'джинсы-клеш', 'джинсы-скинни'],
+    't-shirts': ['футболка', 'майка', 'лонгслив'],
+    'sweaters': ['свитер', 'джемпер', 'кардиган', 'худи'],
+    'accessories': ['шапка', 'шарф', 'ремень', 'сумка'],
+}
+MATERIALS = ['Хлопок 100%', 'Лен 100%', 'Шерсть 70%, акрил 30%', 'Полиэстер 100%', 'Деним (хлопок 98%, эластан 2%)']
+
+
+@contextmanager
+def explicit_timestamps(*models):
+    """
+    Отключение auto_now/auto_now_add, чтобы bulk_create сохранил заданные даты
+
+    Даты попадают в тот же INSERT, без второго прохода по строкам. Флаги
+    полей общие для процесса, поэтому восстанавливаются в finally.
+    """
+    fields = [
+        field for model in models for field in model._meta.concrete_fields
+        if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+    ]
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+def parse_range(value):
+    """Разбор диапазона вида "2-6" или "3" в (минимум, максимум)"""
+    try:
+        low, _, high = value.partition('-')
+        low = int(low)
+        high = int(high) if high else low
+    except ValueError:
+        raise CommandError(f'Неверный диапазон: {value} (ожидается "N" или "N-M")')
+    if low < 0 or high < low:
+        raise CommandError(f'Неверный диапазон: {value}')
+    return low, high
+
+
+class Command(BaseCommand):
+    help = 'Генерация большого синтетического набора данных для нагрузочного тестирования'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=100_000, help='Количество товаров')
+        parser.add_argument('--variants', default='2-6', help='Вариантов на товар (диапазон N-M)')
+        parser.add_argument('--images', default='1-3', help='Изображений на товар (диапазон N-M)')
+        parser.add_argument('--users', type=int, default=50_000, help='Количество пользователей')
+        parser.add_argument('--cart-ratio', type=float, default=0.3, help='Доля пользователей с корзиной')
+        parser.add_argument('--cart-items', default='1-5', help='Позиций в корзине (диапазон N-M)')
+        parser.add_argument('--orders', type=int, default=200_000, help='Количество заказов')
+        parser.add_argument('--order-items', default='1-4', help='Позиций в заказе (диапазон N-M)')
+        parser.add_argument('--paid-ratio', type=float, default=0.7,
+                            help='Доля оплаченных заказов (с успешной транзакцией)')
+        parser.add_argument('--reviews', type=int, default=100_000, help='Количество отзывов')
+        parser.add_argument('--popularity-skew', type=float, default=1.1,
+                            help='Показатель распределения Ципфа для популярности товаров (0 -- равномерно)')
+        parser.add_argument('--days', type=int, default=365, help='Период, по которому распределяются даты')
+        parser.add_argument('--seed', type=int, default=42, help='Зерно генератора (одинаковое зерно -- одинаковые данные)')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Размер пачки bulk_create')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        self.prefix = f"load{options['seed']}"
+        self.now = timezone.now()
+        self.stats = []
+
+        if Product.objects.filter(slug__startswith=f'{self.prefix}-').exists():
+            raise CommandError(
+                f'Данные с зерном {options["seed"]} уже сгенерированы. '
+                f'Используйте другое --seed или очистите базу (reset_products --force).'
+            )
+
+        self.stdout.write(self.style.WARNING('\n' + '=' * 60))
+        self.stdout.write(self.style.WARNING('ГЕНЕРАЦИЯ НАГРУЗОЧНЫХ ДАННЫХ'))
+        self.stdout.write(self.style.WARNING('=' * 60 + '\n'))
+
+        # Справочники создаём так же, как reset_products
+        ResetProductsCommand(stdout=self.stdout, stderr=self.stderr).init_base_data()
+        self.load_reference_data()
+
+        started = time.perf_counter()
+        with explicit_timestamps(Product, User, Cart, Order, Transaction, Review):
+            product_ids = self.create_products()
+            variant_ids, variant_prices = self.create_variants(product_ids)
+            self.create_images(product_ids)
+            user_ids = self.create_users()
+            self.create_carts(user_ids, variant_ids)
+            self.create_orders(user_ids, variant_ids, variant_prices)
+            self.create_reviews(user_ids, product_ids)
+        elapsed = time.perf_counter() - started
+
+        self.report(elapsed)
+
+    # -----------------------------------------------------------------
+    # Вспомогательные методы
+    # -----------------------------------------------------------------
+
+    def load_reference_data(self):
+        self.categories = list(Category.objects.all())
+        self.genders = list(Gender.objects.all())
+        self.sizes = list(Size.objects.all())
+        self.colors = list(Color.objects.all())
+        self.user_role = Role.objects.get(name='user')
+        self.order_statuses = {status.name: status for status in OrderStatus.objects.all()}
+        self.tx_statuses = {status.name: status for status in TransactionStatus.objects.all()}
+
+        media_path = settings.MEDIA_ROOT / 'products'
+        self.image_files = sorted(f'products/{file.name}' for file in media_path.glob('*.png'))
+
+    def random_date(self):
+        return self.now - timedelta(seconds=self.rng.randrange(self.options['days'] * 86400))
+
+    def randint_range(self, value):
+        low, high = parse_range(value)
+        return self.rng.randint(low, high)
+
+    def popularity_picker(self, count):
+        """Выбор индексов с распределением Ципфа: первые товары -- самые популярные"""
+        skew = self.options['popularity_skew']
+        if skew <= 0:
+            return lambda k: [self.rng.randrange(count) for _ in range(k)]
+        cum_weights = array('d', accumulate(1 / (rank ** skew) for rank in range(1, count + 1)))
+        population = range(count)
+        return lambda k: self.rng.choices(population, cum_weights=cum_weights, k=k)
+
+    def insert(self, label, model, rows, on_created=None):
+        """
+        Вставка строк пачками
+
+        Args:
+            label: Название таблицы для отчёта
+            model: Модель
+            rows: Итератор объектов модели
+            on_created: Функция, вызываемая для каждой созданной пачки
+
+        Returns:
+            array с ID созданных объектов
+        """
+        ids = array('q')
+        total = 0
+        started = time.perf_counter()
+        batch = []
+
+        def flush():
+            nonlocal total
+            with transaction.atomic():
+                created = model.objects.bulk_create(batch, batch_size=self.batch_size)
+            ids.extend(obj.pk for obj in created if obj.pk is not None)
+            if on_created:
+                on_created(created)
+            total += len(batch)
+            batch.clear()
+
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                flush()
+        if batch:
+            flush()
+
+        elapsed = time.perf_counter() - started
+        self.stats.append((label, total, elapsed))
+        self.stdout.write(f'  + {label}: {total} ({total / elapsed if elapsed else 0:,.0f} строк/с)')
+        return ids
+
+    # -----------------------------------------------------------------
+    # Генерация
+    # -----------------------------------------------------------------
+
+    def create_products(self):
+        self.stdout.write('\n✨ Товары...')
+
+        def rows():
+            for i in range(self.options['products']):
+                category = self.categories[i % len(self.categories)]
+                noun = self.rng.choice(NAME_NOUNS.get(category.slug, ['товар']))
+                name = f'{self.rng.choice(NAME_ADJECTIVES)} {noun} {i}'
+                created_at = self.random_date()
+                yield Product(
+                    name=name,
+                    slug=f'{self.prefix}-{cyrillic_slugify(name)}',
+                    description=f'{name}. Материал: {self.rng.choice(MATERIALS)}. Артикул серии {i}.',
+                    price=Decimal(self.rng.randrange(500, 20000, 10)),
+                    category=category,
+                    gender=self.rng.choice(self.genders),
+                    material=self.rng.choice(MATERIALS),
+                    care_instructions='Стирка при 30°C',
+                    is_active=self.rng.random() < 0.95,
+                    is_new=created_at > self.now - timedelta(days=30),
+                    is_bestseller=self.rng.random() < 0.05,
+                    created_at=created_at,
+                    updated_at=created_at,
+                )
+
+        return self.insert('Товары', Product, rows())
+
+    def create_variants(self, product_ids):
+        self.stdout.write('\n👕 Варианты...')
+        # Цены в копейках по тому же индексу, что и ID (array компактнее словаря Decimal)
+        prices = array('q')
+
+        def rows():
+            for product_id in product_ids:
+                count = min(self.randint_range(self.options['variants']), len(self.sizes) * len(self.colors))
+                combos = self.rng.sample(range(len(self.sizes) * len(self.colors)), count)
+                base_price = Decimal(self.rng.randrange(500, 20000, 10))
+                for combo in combos:
+                    size = self.sizes[combo % len(self.sizes)]
+                    color = self.colors[combo // len(self.sizes)]
+                    yield ProductVariant(
+                        product_id=product_id,
+                        size=size,
+                        color=color,
+                        price=base_price,
+                        stock_quantity=self.rng.choice([0, 0, 1, 3, 5, 10, 20, 50]),
+                        sku=f'{product_id}-{size.id}-{color.id}',
+                    )
+
+        def remember_prices(created):
+            prices.extend(int(variant.price * 100) for variant in created)
+
+        ids = self.insert('Варианты', ProductVariant, rows(), on_created=remember_prices)
+        return ids, prices
+
+    def create_images(self, product_ids):
+        self.stdout.write('\n🖼 Изображения...')
+        # Записи на несуществующие файлы сломали бы generate_renditions и страницы товаров
+        if not self.image_files:
+            self.stdout.write(self.style.WARNING(
+                f'  Нет файлов *.png в {settings.MEDIA_ROOT / "products"}: изображения не создаются'
+            ))
+            return
+
+        def rows():
+            for product_id in product_ids:
+                for order in range(self.randint_range(self.options['images'])):
+                    yield ProductImage(
+                        product_id=product_id,
+                        image=self.rng.choice(self.image_files),
+                        is_main=order == 0,
+                        order=order,
+                    )
+
+        self.insert('Изображения', ProductImage, rows())
+
+    def create_users(self):
+        self.stdout.write('\n👤 Пользователи...')
+        # Хэшируем один раз: make_password на каждого пользователя занял бы часы
+        password = make_password('password')
+
+        def rows():
+            for i in range(self.options['users']):
+                date_joined = self.random_date()
+                yield User(
+                    email=f'{self.prefix}-user{i}@example.com',
+                    first_name=f'Покупатель{i}',
+                    password=password,
+                    role=self.user_role,
+                    date_joined=date_joined,
+                    updated_at=date_joined,
+                )
+
+        return self.insert('Пользователи', User, rows())
+
+    def create_carts(self, user_ids, variant_ids):
+        self.stdout.write('\n🛒 Корзины...')
+        pick_variant = self.popularity_picker(len(variant_ids))
+
+        def cart_rows():
+            for user_id in user_ids:
+                if self.rng.random() < self.options['cart_ratio']:
+                    created_at = self.random_date()
+                    yield Cart(user_id=user_id, created_at=created_at, updated_at=created_at)
+
+        cart_ids = self.insert('Корзины', Cart, cart_rows())
+
+        def item_rows():
+            for cart_id in cart_ids:
+                count = self.randint_range(self.options['cart_items'])
+                for index in set(pick_variant(count)):
+                    yield CartItem(cart_id=cart_id, variant_id=variant_ids[index], quantity=self.rng.randint(1, 3))
+
+        self.insert('Позиции корзин', CartItem, item_rows())
+
+    def create_orders(self, user_ids, variant_ids, variant_prices):
+        self.stdout.write('\n📦 Заказы...')
+        pick_variant = self.popularity_picker(len(variant_ids))
+        paid_ratio = self.options['paid_ratio']
+        paid_statuses = [self.order_statuses[name] for name in ('paid', 'shipped', 'delivered')]
+        order_lines = {}
+
+        def order_rows():
+            for i in range(self.options['orders']):
+                count = self.randint_range(self.options['order_items'])
+                lines = [
+                    (variant_ids[index], Decimal(variant_prices[index]) / 100, self.rng.randint(1, 3))
+                    for index in set(pick_variant(count))
+                ]
+                paid = self.rng.random() < paid_ratio
+                status = self.rng.choice(paid_statuses) if paid else self.rng.choice(
+                    [self.order_statuses['created'], self.order_statuses['cancelled']]
+                )
+                created_at = self.random_date()
+                order = Order(
+                    user_id=user_ids[self.rng.randrange(len(user_ids))],
+                    order_number=f'{self.prefix.upper()}-{i:09d}',
+                    total_amount=sum((price * quantity for _, price, quantity in lines), Decimal('0')),
+                    delivery_address=f'г. Москва, ул. Нагрузочная, д. {i % 300 + 1}',
+                    payment_method='yookassa' if paid or self.rng.random() < 0.5 else 'cash',
+                    status=status,
+                    created_at=created_at,
+                    updated_at=created_at,
+                )
+                order_lines[order.order_number] = (lines, paid)
+                yield order
+
+        # Позиции и транзакции вставляем сразу после каждой пачки заказов,
+        # чтобы не держать в памяти позиции всех заказов
+        started = time.perf_counter()
+        totals = {'Заказы': 0, 'Позиции заказов': 0, 'Транзакции': 0}
+        batch = []
+
+        def flush():
+            with transaction.atomic():
+                created = Order.objects.bulk_create(batch, batch_size=self.batch_size)
+                items = []
+                transactions = []
+                for order in created:
+                    lines, paid = order_lines.pop(order.order_number)
+                    items.extend(
+                        OrderItem(order_id=order.pk, variant_id=variant_id, quantity=quantity, price_per_unit=price)
+                        for variant_id, price, quantity in lines
+                    )
+                    if paid:
+                        transactions.append(Transaction(
+                            order_id=order.pk,
+                            amount=order.total_amount,
+                            external_id=f'{self.prefix}-payment-{order.pk}',
+                            status=self.tx_statuses['succeeded'],
+                            created_at=order.created_at,
+                            updated_at=order.created_at,
+                        ))
+                OrderItem.objects.bulk_create(items, batch_size=self.batch_size)
+                Transaction.objects.bulk_create(transactions, batch_size=self.batch_size)
+            totals['Заказы'] += len(created)
+            totals['Позиции заказов'] += len(items)
+            totals['Транзакции'] += len(transactions)
+            batch.clear()
+
+        for order in order_rows():
+            batch.append(order)
+            if len(batch) >= self.batch_size:
+                flush()
+        if batch:
+            flush()
+
+        elapsed = time.perf_counter() - started
+        rows_total = sum(totals.values())
+        for label, total in totals.items():
+            # Время общее на три таблицы: делим пропорционально количеству строк
+            self.stats.append((label, total, elapsed * total / rows_total if rows_total else 0))
+            self.stdout.write(f'  + {label}: {total}')
+        self.stdout.write(f'    ({rows_total / elapsed if elapsed else 0:,.0f} строк/с)')
+
+    def create_reviews(self, user_ids, product_ids):
+        self.stdout.write('\n⭐ Отзывы...')
+        pick_product = self.popularity_picker(len(product_ids))
+        seen = set()
+
+        def rows():
+            attempts = 0
+            created = 0
+            target = self.options['reviews']
+            while created < target and attempts < target * 3:
+                attempts += 1
+                user_id = user_ids[self.rng.randrange(len(user_ids))]
+                product_id = product_ids[pick_product(1)[0]]
+                # unique_together (product, user)
+                if (product_id, user_id) in seen:
+                    continue
+                seen.add((product_id, user_id))
+                created += 1
+                created_at = self.random_date()
+                moderated = self.rng.random() < 0.8
+                yield Review(
+                    product_id=product_id,
+                    user_id=user_id,
+                    rating=self.rng.choices([1, 2, 3, 4, 5], weights=[5, 5, 15, 35, 40])[0],
+                    comment='Отзыв покупателя',
+                    is_moderated=moderated,
+                    moderated_at=created_at if moderated else None,
+                    created_at=created_at,
+                    updated_at=created_at,
+                )
+
+        self.insert('Отзывы', Review, rows())
+
+    def report(self, elapsed):
+        total_rows = sum(rows for _, rows, _ in self.stats)
+
+        self.stdout.write(self.style.SUCCESS('\n' + '=' * 60))
+        self.stdout.write(f'{"Таблица":<20}{"Строк":>12}{"Время, с":>12}{"Строк/с":>14}')
+        for label, rows, seconds in self.stats:
+            rate = rows / seconds if seconds else 0
+            self.stdout.write(f'{label:<20}{rows:>12}{seconds:>12.1f}{rate:>14,.0f}')
+        self.stdout.write(self.style.SUCCESS(
+            f'✅ Всего: {total_rows} строк за {elapsed:.1f} с ({total_rows / elapsed if elapsed else 0:,.0f} строк/с)'
+        ))
+        self.stdout.write(self.style.SUCCESS('=' * 60 + '\n'))
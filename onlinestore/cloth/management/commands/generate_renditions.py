@@ -0,0 +1,90 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Q
+
+from ...cache import invalidate_products
+from ...images import build_renditions, delete_renditions, setup_worker
+from ...models import ProductImage
+
+
+def _build(image_id, name):
+    """Задача процесса-воркера: только работа с файлами, без обращений к БД"""
+    try:
+        return image_id, build_renditions(name), None
+    except Exception as e:
+        return image_id, None, str(e)
+
+
+class Command(BaseCommand):
+    help = 'Построение миниатюр WebP/JPEG и превью для уже загруженных изображений товаров'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Перестроить миниатюры для всех изображений, а не только для тех, где их нет')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Количество процессов')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Размер пакета для bulk_update')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING('\n' + '=' * 60))
+        self.stdout.write(self.style.WARNING('ПОСТРОЕНИЕ МИНИАТЮР ИЗОБРАЖЕНИЙ'))
+        self.stdout.write(self.style.WARNING('=' * 60 + '\n'))
+
+        images = ProductImage.objects.exclude(image='')
+        if not options['all']:
+            images = images.filter(Q(renditions={}) | Q(placeholder=''))
+        images = {image.id: image for image in images.only('id', 'product_id', 'image', 'renditions')}
+
+        if not images:
+            self.stdout.write(self.style.SUCCESS('✅ Все изображения уже обработаны'))
+            return
+
+        self.stdout.write(f'📷 Изображений к обработке: {len(images)} (процессов: {options["workers"]})')
+
+        # Соединения с БД не должны наследоваться дочерними процессами
+        connections.close_all()
+
+        start = time.perf_counter()
+        done, failed, pending = 0, 0, []
+        # fork, где он есть: воркеры наследуют настроенный Django (и настройки тестов);
+        # иначе (Windows) -- spawn, и setup_worker вызывает django.setup()
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('fork' if 'fork' in methods else 'spawn')
+        with ProcessPoolExecutor(max_workers=options['workers'], mp_context=context,
+                                 initializer=setup_worker) as executor:
+            futures = [executor.submit(_build, image.id, image.image.name) for image in images.values()]
+            for future in as_completed(futures):
+                image_id, renditions, error = future.result()
+                image = images[image_id]
+                if error:
+                    failed += 1
+                    self.stdout.write(self.style.ERROR(f'  ❌ {image.image.name}: {error}'))
+                    continue
+
+                if image.renditions and image.renditions.get('hash') != renditions['hash']:
+                    delete_renditions(image.renditions)
+                image.apply_image_data(renditions)
+                pending.append(image)
+                done += 1
+                if len(pending) >= options['batch_size']:
+                    ProductImage.objects.bulk_update(pending, ProductImage.IMAGE_DATA_FIELDS)
+                    pending = []
+                    self.stdout.write(f'  ✓ {done}/{len(images)}')
+
+        if pending:
+            ProductImage.objects.bulk_update(pending, ProductImage.IMAGE_DATA_FIELDS)
+        # bulk_update не отправляет сигналы -- сбрасываем кэш карточек и каталога явно
+        invalidate_products(image.product_id for image in images.values())
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'\n✅ Готово: {done} изображений за {elapsed:.1f} c ({done / elapsed if elapsed else 0:.1f} шт/с)'
+        ))
+        if failed:
+            self.stdout.write(self.style.ERROR(f'❌ Ошибок: {failed}'))
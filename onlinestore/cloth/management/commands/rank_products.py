@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from ...ranking import HALF_LIFE_DAYS, WINDOW_DAYS, rank_products
+
+
+class Command(BaseCommand):
+    help = ('Пересчёт популярности товаров и подборок главной ("Хиты продаж", "Новинки") '
+            'по оплаченным заказам, избранному и просмотрам. Запускать по расписанию, например раз в час')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING('\n' + '=' * 60))
+        self.stdout.write(self.style.WARNING('РЕЙТИНГ ТОВАРОВ'))
+        self.stdout.write(self.style.WARNING('=' * 60 + '\n'))
+        self.stdout.write(f"📅 Окно: {WINDOW_DAYS} дн., полураспад: {HALF_LIFE_DAYS} дн.")
+
+        start = time.perf_counter()
+        stats = rank_products()
+        elapsed = time.perf_counter() - start
+
+        self.stdout.write(f"📈 Товаров с событиями: {stats['scored']}")
+        self.stdout.write(f"✏️  Обновлено оценок: {stats['updated']}")
+        self.stdout.write(f"🔥 Хиты продаж: {stats['bestsellers']}")
+        self.stdout.write(f"🆕 Новинки: {stats['new']}")
+        self.stdout.write(f"🏷  Изменено флагов: {stats['flags_changed']}")
+        self.stdout.write(self.style.SUCCESS(f'\n✅ Готово за {elapsed:.1f} c'))
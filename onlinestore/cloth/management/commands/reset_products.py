@@ -3,6 +3,7 @@ from django.core.files import File
 from django.conf import settings
 from django.utils import timezone
 from django.contrib.auth import get_user_model
+from ...cache import invalidate_products
 from ...models import (
     Product, Category, Size, Color, Gender,
     ProductVariant, ProductImage, Role, OrderStatus,
@@ -540,8 +541,13 @@ class Command(BaseCommand):
         """Исправление всех slug'ов"""
         self.stdout.write('\n🔧 Исправление slug\'ов товаров...')
 
-        fixed_count = 0
-        for product in Product.objects.all():
+        # Все slug'и загружаем одним запросом и проверяем уникальность в памяти
+        products = list(Product.objects.only('id', 'name', 'slug'))
+        taken = {product.slug for product in products}
+
+        fixed = []
+        now = timezone.now()
+        for product in products:
             old_slug = product.slug
             new_slug = old_slug.replace(' ', '-')
             new_slug = re.sub(r'[^a-zA-Z0-9_-]', '', new_slug)
@@ -554,16 +560,22 @@ class Command(BaseCommand):
             if new_slug != old_slug:
                 base_slug = new_slug
                 counter = 1
-                while Product.objects.filter(slug=new_slug).exclude(id=product.id).exists():
+                while new_slug in taken:
                     new_slug = f"{base_slug}-{counter}"
                     counter += 1
 
+                taken.discard(old_slug)
+                taken.add(new_slug)
                 product.slug = new_slug
-                product.save()
+                product.updated_at = now
+                fixed.append(product)
                 self.stdout.write(f'  {old_slug} -> {new_slug}')
-                fixed_count += 1
 
-        if fixed_count:
-            self.stdout.write(self.style.SUCCESS(f'  Исправлено slug\'ов: {fixed_count}'))
+        if fixed:
+            # updated_at -- для ETag страниц товаров, которые ссылаются на новые адреса
+            Product.objects.bulk_update(fixed, ['slug', 'updated_at'], batch_size=1000)
+            # bulk_update не отправляет post_save -- сбрасываем кэш карточек и каталога явно
+            invalidate_products(product.id for product in fixed)
+            self.stdout.write(self.style.SUCCESS(f'  Исправлено slug\'ов: {len(fixed)}'))
         else:
-            self.stdout.write('  Все slug\'и корректны')
\ No newline at end of file
+            self.stdout.write('  Все slug\'и корректны')
@@ -0,0 +1,51 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...search_log import flush_search_log, search_report
+
+
+class Command(BaseCommand):
+    help = ('Сводка журнала поиска каталога: частые запросы, запросы без результатов '
+            'и медленные запросы за последние дни')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7, help='За сколько дней (по умолчанию 7)')
+        parser.add_argument('--limit', type=int, default=20, help='Сколько запросов в каждом списке')
+        parser.add_argument('--slow-ms', type=float, default=500,
+                            help='Порог медленного поиска в миллисекундах (по умолчанию 500)')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING('\n' + '=' * 60))
+        self.stdout.write(self.style.WARNING('ЖУРНАЛ ПОИСКА'))
+        self.stdout.write(self.style.WARNING('=' * 60 + '\n'))
+
+        # События этого процесса (если команду вызвали из shell) -- тоже в сводку
+        flush_search_log()
+        since = timezone.now() - timedelta(days=options['days'])
+        report = search_report(since, limit=options['limit'], slow_ms=options['slow_ms'])
+
+        searches = report['searches']
+        zero_share = report['zero_results'] / searches * 100 if searches else 0
+        self.stdout.write(f"📅 Период: {options['days']} дн.")
+        self.stdout.write(f"🔍 Поисков: {searches}, переходов на товар: {report['clicks']}")
+        self.stdout.write(f"🚫 Без результатов: {report['zero_results']} ({zero_share:.1f}%)")
+
+        self.section('ЧАСТЫЕ ЗАПРОСЫ', report['top'],
+                     lambda row: f"{row['searches']:>6}  CTR {row['clicks'] / row['searches'] * 100:5.1f}%  "
+                                 f"найдено ~{row['avg_results'] or 0:.0f}  {row['query']}")
+        self.section('ЗАПРОСЫ БЕЗ РЕЗУЛЬТАТОВ', report['zero'],
+                     lambda row: f"{row['searches']:>6}  {row['query']}")
+        self.section(f"МЕДЛЕННЫЕ ЗАПРОСЫ (от {options['slow_ms']:.0f} мс)", report['slow'],
+                     lambda row: f"{row['max_ms']:>8.0f} мс  среднее {row['avg_ms']:.0f} мс  "
+                                 f"x{row['searches']}  {row['query']}")
+
+        self.stdout.write(self.style.SUCCESS('\n✅ Готово'))
+
+    def section(self, title, rows, line):
+        self.stdout.write(self.style.WARNING(f'\n{title}'))
+        if not rows:
+            self.stdout.write('  —')
+        for row in rows:
+            self.stdout.write(f'  {line(row)}')
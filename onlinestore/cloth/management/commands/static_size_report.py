@@ -0,0 +1,74 @@
+import os
+
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management.base import BaseCommand
+
+from ...staticfiles import COMPRESSIBLE_EXTENSIONS
+
+
+def file_size(path):
+    return os.path.getsize(path) if path and os.path.isfile(path) else None
+
+
+def format_size(size):
+    if size is None:
+        return '—'
+    if size >= 1024:
+        return f'{size / 1024:.1f} KB'
+    return f'{size} B'
+
+
+class Command(BaseCommand):
+    help = 'Размеры статических файлов до и после collectstatic (минификация, gzip, brotli)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Показать все файлы, а не только текстовые (CSS, JS, SVG...)')
+
+    def handle(self, *args, **options):
+        self.stdout.write(self.style.WARNING('\n' + '=' * 100))
+        self.stdout.write(self.style.WARNING('РАЗМЕРЫ СТАТИЧЕСКИХ ФАЙЛОВ'))
+        self.stdout.write(self.style.WARNING('=' * 100 + '\n'))
+
+        hashed_files = getattr(staticfiles_storage, 'hashed_files', None)
+        if not hashed_files:
+            self.stdout.write(self.style.ERROR('Манифест не найден: сначала выполните collectstatic'))
+            return
+
+        self.stdout.write(
+            f"{'Файл':<44}{'Исходный':>11}{'Минифиц.':>11}{'gzip':>11}{'brotli':>11}{'По сети':>12}"
+        )
+        totals = {'source': 0, 'minified': 0, 'wire': 0}
+        for name, hashed_name in sorted(hashed_files.items()):
+            if not options['all'] and not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+
+            source = file_size(finders.find(name))
+            collected_path = staticfiles_storage.path(hashed_name)
+            minified = file_size(collected_path)
+            gzipped = file_size(collected_path + '.gz')
+            brotli = file_size(collected_path + '.br')
+            if source is None or minified is None:
+                continue
+            # Браузер получает наименьшую из доступных версий
+            wire = min(size for size in (minified, gzipped, brotli) if size is not None)
+            totals['source'] += source
+            totals['minified'] += minified
+            totals['wire'] += wire
+
+            self.stdout.write(
+                f'{name[:43]:<44}{format_size(source):>11}{format_size(minified):>11}'
+                f'{format_size(gzipped):>11}{format_size(brotli):>11}{format_size(wire):>12}'
+            )
+
+        self.stdout.write('')
+        self.stdout.write(self.style.SUCCESS('=' * 100))
+        if totals['source']:
+            self.stdout.write(self.style.SUCCESS(
+                f"Итого: исходные {format_size(totals['source'])}, "
+                f"после минификации {format_size(totals['minified'])}, "
+                f"по сети {format_size(totals['wire'])} "
+                f"({100 * totals['wire'] / totals['source']:.1f}% от исходного)"
+            ))
+        self.stdout.write(self.style.SUCCESS('=' * 100 + '\n'))
@@ -0,0 +1,137 @@
+"""
+Метрики в формате Prometheus
+
+Если задан PROMETHEUS_MULTIPROC_DIR, каждый процесс gunicorn пишет значения
+в свои файлы в этом каталоге, а /metrics агрегирует их (multiprocess mode
+prometheus_client). Без установленного prometheus_client все функции
+записи ничего не делают, а /metrics отвечает 503.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+if settings.PROMETHEUS_MULTIPROC_DIR:
+    # Должно быть выставлено до импорта prometheus_client
+    os.makedirs(settings.PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', str(settings.PROMETHEUS_MULTIPROC_DIR))
+
+try:
+    from prometheus_client import (
+        CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest
+    )
+    from prometheus_client.core import GaugeMetricFamily
+    from prometheus_client import multiprocess
+except ImportError:
+    CONTENT_TYPE_LATEST = 'text/plain; version=0.0.4; charset=utf-8'
+    Counter = Histogram = None
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+if Histogram is not None:
+    REQUEST_LATENCY = Histogram(
+        'cloth_request_duration_seconds', 'Время обработки запроса',
+        ['view', 'status'], buckets=LATENCY_BUCKETS
+    )
+    REQUEST_DB_QUERIES = Histogram(
+        'cloth_request_db_queries', 'Количество SQL-запросов на запрос',
+        ['view'], buckets=QUERY_COUNT_BUCKETS
+    )
+    REQUEST_DB_TIME = Histogram(
+        'cloth_request_db_duration_seconds', 'Время SQL-запросов на запрос',
+        ['view'], buckets=LATENCY_BUCKETS
+    )
+    CACHE_REQUESTS = Counter(
+        'cloth_cache_requests_total', 'Обращения к кэшу (hit/miss)',
+        ['cache', 'result']
+    )
+    CHECKOUTS = Counter(
+        'cloth_checkout_total', 'Оформление заказов',
+        ['result', 'payment_method']
+    )
+    YOOKASSA_LATENCY = Histogram(
+        'cloth_yookassa_request_duration_seconds', 'Время запросов к API ЮKassa',
+        ['operation', 'outcome'], buckets=LATENCY_BUCKETS
+    )
+
+
+def observe_request(view_name, status_code, stats):
+    """Запись метрик запроса (вызывается из RequestTimingMiddleware)"""
+    if Histogram is None:
+        return
+    REQUEST_LATENCY.labels(view_name, str(status_code)).observe(stats.total_time)
+    REQUEST_DB_QUERIES.labels(view_name).observe(stats.query_count)
+    REQUEST_DB_TIME.labels(view_name).observe(stats.db_time)
+
+
+def record_cache(cache_name, hit):
+    """Учёт попадания/промаха кэша; доля попаданий считается в Prometheus"""
+    if Counter is None:
+        return
+    CACHE_REQUESTS.labels(cache_name, 'hit' if hit else 'miss').inc()
+
+
+def record_checkout(result, payment_method=''):
+    """Учёт оформления заказа: result -- success или failure"""
+    if Counter is None:
+        return
+    CHECKOUTS.labels(result, payment_method).inc()
+
+
+@contextmanager
+def yookassa_timer(operation):
+    """Замер времени запроса к ЮKassa"""
+    start = time.perf_counter()
+    outcome = 'error'
+    try:
+        yield
+        outcome = 'success'
+    finally:
+        if Histogram is not None:
+            YOOKASSA_LATENCY.labels(operation, outcome).observe(time.perf_counter() - start)
+
+
+class QueueDepthCollector:
+    """
+    Глубина очередей, вычисляемая в момент опроса
+
+    Платежи и возвраты в статусе pending ждут webhook от ЮKassa.
+    """
+
+    def collect(self):
+        from .models import Refund, Transaction
+
+        pending_transactions = GaugeMetricFamily(
+            'cloth_pending_transactions', 'Платежи, ожидающие подтверждения ЮKassa'
+        )
+        pending_transactions.add_metric([], Transaction.objects.filter(status__name='pending').count())
+        yield pending_transactions
+
+        pending_refunds = GaugeMetricFamily(
+            'cloth_pending_refunds', 'Возвраты, ожидающие подтверждения ЮKassa'
+        )
+        pending_refunds.add_metric([], Refund.objects.filter(status='pending').count())
+        yield pending_refunds
+
+
+def is_available():
+    return Histogram is not None
+
+
+def render_latest():
+    """Текст метрик для /metrics"""
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    output = generate_latest(registry)
+
+    # Глубину очередей считаем отдельным реестром, чтобы не регистрировать
+    # коллектор в глобальном реестре на каждый запрос
+    queues = CollectorRegistry()
+    queues.register(QueueDepthCollector())
+    return output + generate_latest(queues)
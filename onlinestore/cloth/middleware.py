@@ -0,0 +1,361 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import secrets
+import time
+import traceback
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+from django.template.backends.django import Template as DjangoBackendTemplate
+from django.utils.cache import patch_vary_headers
+from django.utils.regex_helper import _lazy_re_compile
+from django.utils.text import compress_string
+
+from . import metrics
+from .db_router import PIN_COOKIE, primary_pinning
+from .staticfiles import accepted_encodings, brotli, minify_css
+
+logger = logging.getLogger(__name__)
+
+# Статистика текущего запроса (ContextVar корректно работает и в ASGI)
+_current_stats = ContextVar('request_stats', default=None)
+
+
+class RequestStats:
+    """Статистика одного запроса: SQL, шаблоны, общее время"""
+
+    def __init__(self):
+        self.query_count = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.total_time = 0.0
+        self.slow_queries = []
+
+    def query_wrapper(self, execute, sql, params, many, context):
+        """Обёртка для connection.execute_wrapper: замер каждого запроса"""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - start
+            self.query_count += 1
+            self.db_time += duration
+            if duration * 1000 >= settings.PERF_SLOW_QUERY_MS:
+                self.slow_queries.append((duration, sql, _query_origin()))
+
+
+def get_request_stats():
+    """Статистика текущего запроса или None вне запроса"""
+    return _current_stats.get()
+
+
+def _query_origin():
+    """Первый кадр стека из кода проекта (а не Django/библиотек)"""
+    base_dir = str(settings.BASE_DIR)
+    for frame in reversed(traceback.extract_stack()[:-2]):
+        filename = frame.filename
+        if filename.startswith(base_dir) and filename != __file__ and 'site-packages' not in filename:
+            return f"{os.path.relpath(filename, base_dir)}:{frame.lineno} in {frame.name}"
+    return 'unknown'
+
+
+def _install_template_timer():
+    """
+    Замер времени рендеринга шаблонов
+
+    Оборачиваем Template.render бэкенда Django: он вызывается один раз на
+    render()/TemplateResponse, а вложенные {% include %} идут мимо него,
+    поэтому время не считается дважды.
+    """
+    if getattr(DjangoBackendTemplate.render, '_timed', False):
+        return
+
+    original_render = DjangoBackendTemplate.render
+
+    def render(self, context=None, request=None):
+        stats = _current_stats.get()
+        if stats is None:
+            return original_render(self, context, request)
+        start = time.perf_counter()
+        try:
+            return original_render(self, context, request)
+        finally:
+            stats.template_time += time.perf_counter() - start
+
+    render._timed = True
+    DjangoBackendTemplate.render = render
+
+
+class RequestTimingMiddleware:
+    """
+    Инструментирование запросов
+
+    Считает количество SQL-запросов, время в БД, время рендеринга шаблонов
+    и общее время и пишет их в лог. Заголовок Server-Timing с этими цифрами
+    получают только сотрудники (и все при DEBUG): посетителям незачем
+    видеть устройство бэкенда.
+    Медленные запросы (дольше PERF_SLOW_QUERY_MS) логируются с местом вызова.
+    Сотрудник может получить профиль cProfile для одного запроса, передав
+    заголовок PERF_PROFILE_HEADER.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        _install_template_timer()
+
+    def __call__(self, request):
+        stats = RequestStats()
+        request.perf_stats = stats
+        token = _current_stats.set(stats)
+
+        profiler = cProfile.Profile() if self._wants_profile(request) else None
+        start = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(stats.query_wrapper))
+                if profiler:
+                    profiler.enable()
+                try:
+                    response = self.get_response(request)
+                finally:
+                    if profiler:
+                        profiler.disable()
+        finally:
+            stats.total_time = time.perf_counter() - start
+            _current_stats.reset(token)
+
+        view_name = self._view_name(request)
+        self._log(request, view_name, stats, response)
+        metrics.observe_request(view_name, response.status_code, stats)
+
+        if profiler:
+            return self._profile_response(profiler, view_name, stats)
+
+        if settings.DEBUG or self._is_staff(request):
+            response['Server-Timing'] = self._server_timing(stats)
+        return response
+
+    @staticmethod
+    def _is_staff(request):
+        user = getattr(request, 'user', None)
+        return bool(user and user.is_authenticated and user.is_staff)
+
+    def _wants_profile(self, request):
+        header = 'HTTP_' + settings.PERF_PROFILE_HEADER.upper().replace('-', '_')
+        return bool(request.META.get(header)) and self._is_staff(request)
+
+    @staticmethod
+    def _view_name(request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unresolved'
+        return match.view_name or match._func_path
+
+    @staticmethod
+    def _server_timing(stats):
+        return (
+            f'db;dur={stats.db_time * 1000:.1f};desc="{stats.query_count} queries", '
+            f'tpl;dur={stats.template_time * 1000:.1f}, '
+            f'total;dur={stats.total_time * 1000:.1f}'
+        )
+
+    @staticmethod
+    def _log(request, view_name, stats, response):
+        logger.info(
+            f"{request.method} {view_name} status={response.status_code} "
+            f"queries={stats.query_count} db={stats.db_time * 1000:.1f}ms "
+            f"tpl={stats.template_time * 1000:.1f}ms total={stats.total_time * 1000:.1f}ms"
+        )
+        for duration, sql, origin in sorted(stats.slow_queries, reverse=True):
+            logger.warning(f"Slow query in {view_name} ({duration * 1000:.1f}ms) at {origin}: {sql}")
+
+    @staticmethod
+    def _profile_response(profiler, view_name, stats):
+        output = io.StringIO()
+        output.write(
+            f"{view_name}: queries={stats.query_count} db={stats.db_time * 1000:.1f}ms "
+            f"tpl={stats.template_time * 1000:.1f}ms total={stats.total_time * 1000:.1f}ms\n\n"
+        )
+        pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(50)
+        logger.info(f"Profile for {view_name}:\n{output.getvalue()}")
+        return HttpResponse(output.getvalue(), content_type='text/plain; charset=utf-8')
+
+
+# Содержимое этих тегов не трогаем (кроме <style>, его минифицирует minify_css)
+_HTML_PROTECTED = _lazy_re_compile(r'(<(pre|textarea|script|style)\b[^>]*>.*?</\2\s*>)', re.S | re.I)
+_HTML_STYLE = _lazy_re_compile(r'(<style\b[^>]*>)(.*?)(</style\s*>)', re.S | re.I)
+# Комментарии, кроме условных (<!--[if IE]>)
+_HTML_COMMENT = _lazy_re_compile(r'<!--(?!\[if).*?-->', re.S)
+_HTML_NEWLINES = _lazy_re_compile(r'\s*\n\s*')
+_HTML_SPACES = _lazy_re_compile(r'[ \t]{2,}')
+# Тег целиком (значения атрибутов могут содержать ">") и значения атрибутов в нём
+_HTML_TAG = _lazy_re_compile(r'<[a-zA-Z/][^>"\']*(?:(?:"[^"]*"|\'[^\']*\')[^>"\']*)*>')
+_HTML_ATTRIBUTE_VALUE = _lazy_re_compile(r'("[^"]*"|\'[^\']*\')')
+
+COMPRESSIBLE_CONTENT_TYPES = (
+    'text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+)
+
+
+def minify_html(html):
+    """
+    Минификация HTML без изменения отображения
+
+    Удаляет комментарии и отступы. Любая последовательность пробельных
+    символов в HTML отображается как один пробел, поэтому перевод строки
+    сохраняется там, где он был, а <pre>, <textarea>, <script> и значения
+    атрибутов (title, data-*, value) не изменяются.
+    """
+    parts = []
+    position = 0
+    for match in _HTML_PROTECTED.finditer(html):
+        parts.append(_minify_html_text(html[position:match.start()]))
+        block = match.group(1)
+        if match.group(2).lower() == 'style':
+            block = _HTML_STYLE.sub(lambda m: m.group(1) + minify_css(m.group(2)) + m.group(3), block)
+        parts.append(block)
+        position = match.end()
+    parts.append(_minify_html_text(html[position:]))
+    return ''.join(parts).strip()
+
+
+def _minify_html_text(text):
+    text = _HTML_COMMENT.sub('', text)
+    parts = []
+    position = 0
+    for match in _HTML_TAG.finditer(text):
+        parts.append(_collapse_whitespace(text[position:match.start()]))
+        # split с группой: нечётные элементы -- значения атрибутов в кавычках
+        parts.extend(
+            part if number % 2 else _collapse_whitespace(part)
+            for number, part in enumerate(_HTML_ATTRIBUTE_VALUE.split(match.group()))
+        )
+        position = match.end()
+    parts.append(_collapse_whitespace(text[position:]))
+    return ''.join(parts)
+
+
+def _collapse_whitespace(text):
+    text = _HTML_NEWLINES.sub('\n', text)
+    return _HTML_SPACES.sub(' ', text)
+
+
+def minify_html_content(content, charset):
+    """minify_html для тела ответа; тело, не декодируемое в charset, возвращается как есть"""
+    try:
+        return minify_html(content.decode(charset)).encode(charset)
+    except (UnicodeError, LookupError):
+        logger.warning(f"HTML minification skipped: body is not valid {charset}")
+        return content
+
+
+class ResponseCompressionMiddleware:
+    """
+    Минификация HTML и сжатие текстовых ответов
+
+    HTML-страницы минифицируются (HTML_MINIFY), затем текстовые ответы
+    больше RESPONSE_COMPRESS_MIN_SIZE сжимаются brotli или gzip -- что
+    предпочитает клиент по Accept-Encoding (brotli, если установлен).
+    Против BREACH длина сжатого ответа делается случайной: для gzip -- как
+    в GZipMiddleware (случайные байты в заголовке), для brotli, у которого
+    такого поля нет, -- HTML-комментарием случайной длины в конце страницы.
+    Остальные ответы brotli (JSON, CSS, JS) не дополняются: секретов вроде
+    CSRF-токена в них нет. Должен стоять в начале MIDDLEWARE,
+    чтобы сжимать окончательное содержимое ответа. Страницы из кэша
+    (cloth.cache.cache_anonymous_page) уже минифицированы и повторно не обрабатываются.
+    """
+
+    # Как в django.middleware.gzip.GZipMiddleware
+    max_random_bytes = 100
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.has_header('Content-Encoding'):
+            return response
+
+        content_type = response.get('Content-Type', '')
+        if (settings.HTML_MINIFY and content_type.startswith('text/html') and response.status_code == 200
+                and not getattr(response, 'html_minified', False)):
+            response.content = minify_html_content(response.content, response.charset or 'utf-8')
+            response['Content-Length'] = str(len(response.content))
+
+        if not content_type.startswith(COMPRESSIBLE_CONTENT_TYPES):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+        if len(response.content) < settings.RESPONSE_COMPRESS_MIN_SIZE:
+            return response
+
+        encoding = self._choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None:
+            return response
+
+        if encoding == 'br':
+            content = response.content
+            if content_type.startswith('text/html'):
+                content += self._random_padding()
+            compressed = brotli.compress(content, quality=settings.RESPONSE_BROTLI_QUALITY)
+        else:
+            compressed = compress_string(response.content, max_random_bytes=self.max_random_bytes)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        # Сжатое тело отличается от несжатого побайтно
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        return response
+
+    def _random_padding(self):
+        """Комментарий из случайных символов: случайные данные почти не сжимаются"""
+        length = secrets.randbelow(self.max_random_bytes + 1)
+        return f'<!--{secrets.token_urlsafe(length)[:length]}-->'.encode('ascii')
+
+    @staticmethod
+    def _choose_encoding(accept_encoding):
+        accepted = accepted_encodings(accept_encoding)
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+
+class ReplicaPinningMiddleware:
+    """
+    "Прочитал то, что записал" при чтении с реплик (cloth.db_router)
+
+    Ответ на POST и другие изменяющие запросы ставит cookie на
+    REPLICA_PIN_SECONDS (больше ожидаемого отставания реплики); пока она есть,
+    запросы посетителя читают только с основной базы. Без реплик ничего не делает.
+    """
+
+    SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'TRACE')
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.REPLICA_DATABASES:
+            return self.get_response(request)
+
+        with primary_pinning(PIN_COOKIE in request.COOKIES):
+            response = self.get_response(request)
+        if request.method not in self.SAFE_METHODS:
+            response.set_cookie(
+                PIN_COOKIE, '1', max_age=settings.REPLICA_PIN_SECONDS, httponly=True, samesite='Lax'
+            )
+        return response
@@ -0,0 +1,60 @@
+# Generated by Django 6.0.1 on 2026-10-19 00:30
+
+import django.core.validators
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloth', '0004_alter_productimage_image'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Refund',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10, validators=[django.core.validators.MinValueValidator(0)], verbose_name='Сумма')),
+                ('status', models.CharField(choices=[('pending', 'Ожидание'), ('succeeded', 'Успешно'), ('canceled', 'Отменён')], default='pending', max_length=20, verbose_name='Статус')),
+                ('external_id', models.CharField(blank=True, max_length=255, null=True, unique=True, verbose_name='Внешний ID')),
+                ('idempotence_key', models.UUIDField(default=uuid.uuid4, editable=False, unique=True, verbose_name='Ключ идемпотентности')),
+                ('reason', models.CharField(blank=True, max_length=255, verbose_name='Причина')),
+                ('stock_returned', models.BooleanField(default=False, verbose_name='Товар возвращён на склад')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата создания')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='Дата обновления')),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='refunds', to=settings.AUTH_USER_MODEL, verbose_name='Инициатор')),
+                ('transaction', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='refunds', to='cloth.transaction', verbose_name='Транзакция')),
+            ],
+            options={
+                'verbose_name': 'Возврат',
+                'verbose_name_plural': 'Возвраты',
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RefundItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField(verbose_name='Количество')),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=10, verbose_name='Сумма')),
+                ('order_item', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='refund_items', to='cloth.orderitem', verbose_name='Позиция заказа')),
+                ('refund', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='items', to='cloth.refund', verbose_name='Возврат')),
+            ],
+            options={
+                'verbose_name': 'Позиция возврата',
+                'verbose_name_plural': 'Позиции возвратов',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='refund',
+            index=models.Index(fields=['external_id'], name='cloth_refun_externa_bff54f_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='refund',
+            index=models.Index(fields=['status'], name='cloth_refun_status_edf737_idx'),
+        ),
+    ]
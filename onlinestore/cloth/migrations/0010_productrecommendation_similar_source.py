@@ -0,0 +1,18 @@
+# Generated by Django 6.0.1 on 2026-10-19 01:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloth', '0009_productrecommendation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='productrecommendation',
+            name='source',
+            field=models.CharField(choices=[('co_purchase', 'Покупают вместе'), ('similar', 'Похожие по описанию'), ('category', 'Популярное в категории')], max_length=20, verbose_name='Источник'),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 6.0.1 on 2026-10-19 01:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloth', '0010_productrecommendation_similar_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductRanking',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('list_name', models.CharField(choices=[('bestsellers', 'Хиты продаж'), ('new', 'Новинки')], max_length=20, verbose_name='Подборка')),
+                ('position', models.PositiveSmallIntegerField(verbose_name='Позиция')),
+                ('score', models.FloatField(default=0, verbose_name='Оценка')),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата расчёта')),
+            ],
+            options={
+                'verbose_name': 'Позиция в подборке',
+                'verbose_name_plural': 'Подборки главной',
+                'ordering': ['list_name', 'position'],
+            },
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='popularity_score',
+            field=models.FloatField(default=0, verbose_name='Популярность'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['popularity_score', 'id'], name='cloth_produ_popular_57f8e8_idx'),
+        ),
+        migrations.AddField(
+            model_name='productranking',
+            name='product',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rankings', to='cloth.product', verbose_name='Товар'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='productranking',
+            unique_together={('list_name', 'position')},
+        ),
+    ]
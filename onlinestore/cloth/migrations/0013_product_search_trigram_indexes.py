@@ -0,0 +1,38 @@
+# Generated by Django 6.0.1 on 2026-10-19 09:12
+
+from django.db import migrations
+
+# Индексы только для PostgreSQL: на остальных базах поиск идёт
+# по n-граммному индексу в памяти (cloth.search)
+TRIGRAM_INDEXES = {
+    'cloth_product_name_trgm': 'name',
+    'cloth_product_material_trgm': 'material',
+}
+
+
+def create_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    for index, column in TRIGRAM_INDEXES.items():
+        schema_editor.execute(
+            f'CREATE INDEX IF NOT EXISTS {index} ON cloth_product USING gin ({column} gin_trgm_ops)'
+        )
+
+
+def drop_trigram_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for index in TRIGRAM_INDEXES:
+        schema_editor.execute(f'DROP INDEX IF EXISTS {index}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloth', '0012_product_view_counters'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 6.0.1 on 2026-10-19 01:42
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cloth', '0013_product_search_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchQuery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('search', 'Поиск'), ('click', 'Переход на товар')], default='search', max_length=10, verbose_name='Событие')),
+                ('query', models.CharField(max_length=255, verbose_name='Запрос')),
+                ('results', models.PositiveIntegerField(blank=True, null=True, verbose_name='Найдено товаров')),
+                ('duration_ms', models.FloatField(blank=True, null=True, verbose_name='Время ответа, мс')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Время')),
+                ('clicked_product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='search_clicks', to='cloth.product', verbose_name='Товар')),
+            ],
+            options={
+                'verbose_name': 'Поисковый запрос',
+                'verbose_name_plural': 'Поисковые запросы',
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['created_at'], name='cloth_searc_created_35c260_idx')],
+            },
+        ),
+    ]
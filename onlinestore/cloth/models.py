@@ -8,8 +8,11 @@ from django.contrib.auth.models import (
 from django.utils import timezone
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db.models import Q, Avg
+import logging
 import uuid
 
+logger = logging.getLogger(__name__)
+
 
 # =========================================================
 # USER & ROLE
@@ -202,6 +205,10 @@ class Product(models.Model):
     is_active = models.BooleanField(default=True, verbose_name="Активен")
     is_new = models.BooleanField(default=False, verbose_name="Новинка")
     is_bestseller = models.BooleanField(default=False, verbose_name="Хит продаж")
+    # Пересчитывается командой rank_products
+    popularity_score = models.FloatField(default=0, verbose_name="Популярность")
+    # Накапливается буфером cloth.view_counter
+    view_count = models.PositiveBigIntegerField(default=0, verbose_name="Просмотры")
 
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
@@ -214,12 +221,29 @@ class Product(models.Model):
             models.Index(fields=["price"]),
             models.Index(fields=["is_active"]),
             models.Index(fields=["created_at"]),
+            # Сортировка каталога "Популярные": popularity_score DESC, id DESC
+            models.Index(fields=["popularity_score", "id"]),
         ]
         ordering = ['-created_at']
 
     def __str__(self):
         return self.name
 
+    # Пишутся только своими механизмами: view_count -- cloth.view_counter (view_count + n),
+    # popularity_score -- rank_products (bulk_update). Обычное сохранение их не трогает,
+    # иначе форма, открытая до пересчёта, вернула бы старые значения
+    COUNTER_FIELDS = ('view_count', 'popularity_score')
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None and not kwargs.get('force_insert'):
+            # Отложенные поля (only/defer) не пишутся, как и в стандартном save()
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.COUNTER_FIELDS and field.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
+
     def get_average_rating(self):
         """Получить средний рейтинг"""
         result = self.reviews.filter(is_moderated=True).aggregate(Avg('rating'))
@@ -240,6 +264,7 @@ class ProductVariant(models.Model):
     stock_quantity = models.PositiveIntegerField(default=0, verbose_name="Количество на складе")
 
     sku = models.CharField(max_length=100, unique=True, blank=True, verbose_name="Артикул")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
 
     class Meta:
         verbose_name = "Вариант товара"
@@ -277,6 +302,16 @@ class ProductImage(models.Model):
     image = models.ImageField(upload_to='products/', verbose_name="Изображение")  # Убрали %Y/%m/
     is_main = models.BooleanField(default=False, verbose_name="Главное")
     order = models.PositiveIntegerField(default=0, verbose_name="Порядок")
+    # Миниатюры WebP/JPEG, см. cloth.images.build_renditions
+    renditions = models.JSONField(default=dict, blank=True, editable=False, verbose_name="Миниатюры")
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="Ширина")
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False, verbose_name="Высота")
+    # Крошечное превью (data URI), показывается до загрузки изображения
+    placeholder = models.TextField(blank=True, editable=False, verbose_name="Превью")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    # Поля, заполняемые из результата build_renditions (updated_at -- для bulk_update)
+    IMAGE_DATA_FIELDS = ['renditions', 'width', 'height', 'placeholder', 'updated_at']
 
     class Meta:
         verbose_name = "Изображение товара"
@@ -289,7 +324,84 @@ class ProductImage(models.Model):
     def save(self, *args, **kwargs):
         if self.is_main:
             ProductImage.objects.filter(product=self.product, is_main=True).update(is_main=False)
+        # Новый файл (edit_product, инлайн в админке) -- после сохранения строим миниатюры.
+        # Это синхронно, в запросе загрузки (около секунды на большое изображение);
+        # при IMAGE_RENDITIONS_ON_SAVE=False их строит manage.py generate_renditions
+        new_upload = bool(self.image) and not self.image._committed
         super().save(*args, **kwargs)
+        if new_upload and settings.IMAGE_RENDITIONS_ON_SAVE:
+            self.generate_renditions()
+
+    def generate_renditions(self):
+        """Построить миниатюры и сохранить их описание"""
+        from .cache import invalidate_products
+        from .images import build_renditions, delete_renditions
+
+        old_renditions = self.renditions
+        try:
+            self.apply_image_data(build_renditions(self.image.name))
+        except Exception as e:
+            logger.error(f"Failed to build renditions for {self.image.name}: {e}")
+            return
+        ProductImage.objects.filter(pk=self.pk).update(
+            **{field: getattr(self, field) for field in self.IMAGE_DATA_FIELDS}
+        )
+        # update() не отправляет post_save: карточка и каталог должны получить новые миниатюры
+        invalidate_products([self.product_id])
+        if old_renditions and old_renditions.get('hash') != self.renditions['hash']:
+            delete_renditions(old_renditions)
+
+    def apply_image_data(self, data):
+        """Разложить результат build_renditions по полям (без сохранения)"""
+        data = dict(data)
+        self.placeholder = data.pop('placeholder', '')
+        self.width = data['width']
+        self.height = data['height']
+        self.renditions = data
+        self.updated_at = timezone.now()
+
+    def rendition_url(self, rendition, fmt='jpeg'):
+        """URL миниатюры; если её ещё нет -- URL оригинала"""
+        entry = self.renditions.get('sizes', {}).get(rendition) if self.renditions else None
+        if entry and entry.get(fmt):
+            return self.image.storage.url(entry[fmt])
+        return self.image.url
+
+    def srcset(self, fmt='jpeg'):
+        """Значение атрибута srcset по всем миниатюрам формата"""
+        if not self.renditions:
+            return ''
+        storage = self.image.storage
+        candidates = {}
+        for entry in self.renditions.get('sizes', {}).values():
+            if entry.get(fmt):
+                # Для маленьких оригиналов несколько миниатюр совпадают по ширине
+                candidates.setdefault(entry['width'], storage.url(entry[fmt]))
+        return ', '.join(f"{url} {width}w" for width, url in sorted(candidates.items()))
+
+    @property
+    def cart_url(self):
+        return self.rendition_url('cart')
+
+    @property
+    def card_url(self):
+        return self.rendition_url('card')
+
+    @property
+    def detail_url(self):
+        return self.rendition_url('detail')
+
+    @property
+    def zoom_url(self):
+        return self.rendition_url('zoom')
+
+    @property
+    def webp_srcset(self):
+        return self.srcset('webp')
+
+    @property
+    def jpeg_srcset(self):
+        return self.srcset('jpeg')
 
 
 # =========================================================
@@ -515,6 +627,64 @@ class Transaction(models.Model):
         return f"Транзакция {self.external_id} - {self.amount} ₽"
 
 
+class Refund(models.Model):
+    """Возврат по транзакции"""
+    STATUS_CHOICES = (
+        ('pending', 'Ожидание'),
+        ('succeeded', 'Успешно'),
+        ('canceled', 'Отменён'),
+    )
+
+    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name='refunds',
+                                    verbose_name="Транзакция")
+
+    amount = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(0)],
+                                 verbose_name="Сумма")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name="Статус")
+
+    external_id = models.CharField(max_length=255, unique=True, null=True, blank=True, verbose_name="Внешний ID")
+    idempotence_key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False,
+                                       verbose_name="Ключ идемпотентности")
+
+    reason = models.CharField(max_length=255, blank=True, verbose_name="Причина")
+    stock_returned = models.BooleanField(default=False, verbose_name="Товар возвращён на склад")
+
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True,
+                                   related_name='refunds', verbose_name="Инициатор")
+
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата создания")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата обновления")
+
+    class Meta:
+        verbose_name = "Возврат"
+        verbose_name_plural = "Возвраты"
+        indexes = [
+            models.Index(fields=['external_id']),
+            models.Index(fields=['status']),
+        ]
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"Возврат {self.external_id or self.idempotence_key} - {self.amount} ₽"
+
+
+class RefundItem(models.Model):
+    """Позиция возврата"""
+    refund = models.ForeignKey(Refund, on_delete=models.CASCADE, related_name='items', verbose_name="Возврат")
+    order_item = models.ForeignKey(OrderItem, on_delete=models.PROTECT, related_name='refund_items',
+                                   verbose_name="Позиция заказа")
+
+    quantity = models.PositiveIntegerField(verbose_name="Количество")
+    amount = models.DecimalField(max_digits=10, decimal_places=2, verbose_name="Сумма")
+
+    class Meta:
+        verbose_name = "Позиция возврата"
+        verbose_name_plural = "Позиции возвратов"
+
+    def __str__(self):
+        return f"{self.order_item} (возврат x{self.quantity})"
+
+
 # =========================================================
 # REVIEWS
 # =========================================================
@@ -550,3 +720,114 @@ class Review(models.Model):
 
     def __str__(self):
         return f"{self.product.name} - {self.rating}/5"
+
+
+# =========================================================
+# RECOMMENDATIONS
+# =========================================================
+
+class ProductRecommendation(models.Model):
+    """Рекомендация к товару (строится командой build_recommendations)"""
+    SOURCE_CHOICES = [
+        ('co_purchase', 'Покупают вместе'),
+        ('similar', 'Похожие по описанию'),
+        ('category', 'Популярное в категории'),
+    ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommendations',
+                                verbose_name="Товар")
+    recommended = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='recommended_for',
+                                    verbose_name="Рекомендуемый товар")
+    rank = models.PositiveSmallIntegerField(verbose_name="Позиция")
+    score = models.FloatField(default=0, verbose_name="Оценка")
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES, verbose_name="Источник")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата расчёта")
+
+    class Meta:
+        verbose_name = "Рекомендация"
+        verbose_name_plural = "Рекомендации"
+        ordering = ['product', 'rank']
+        # Индекс (product, rank) -- чтение рекомендаций страницы товара
+        unique_together = ('product', 'rank')
+
+    def __str__(self):
+        return f"{self.product_id} -> {self.recommended_id} (#{self.rank})"
+
+
+# =========================================================
+# RANKING
+# =========================================================
+
+class ProductRanking(models.Model):
+    """Позиция товара в подборке главной страницы (строится командой rank_products)"""
+    LIST_CHOICES = [
+        ('bestsellers', 'Хиты продаж'),
+        ('new', 'Новинки'),
+    ]
+
+    list_name = models.CharField(max_length=20, choices=LIST_CHOICES, verbose_name="Подборка")
+    position = models.PositiveSmallIntegerField(verbose_name="Позиция")
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='rankings', verbose_name="Товар")
+    score = models.FloatField(default=0, verbose_name="Оценка")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата расчёта")
+
+    class Meta:
+        verbose_name = "Позиция в подборке"
+        verbose_name_plural = "Подборки главной"
+        ordering = ['list_name', 'position']
+        unique_together = ('list_name', 'position')
+
+    def __str__(self):
+        return f"{self.list_name} #{self.position}: {self.product_id}"
+
+
+class ProductViewDaily(models.Model):
+    """Просмотры страницы товара за день (для рейтинга популярности)"""
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_views', verbose_name="Товар")
+    day = models.DateField(verbose_name="День")
+    views = models.PositiveIntegerField(default=0, verbose_name="Просмотры")
+
+    class Meta:
+        verbose_name = "Просмотры за день"
+        verbose_name_plural = "Просмотры по дням"
+        # Уникальность -- цель ON CONFLICT при сбросе счётчиков
+        unique_together = ('product', 'day')
+        indexes = [
+            models.Index(fields=['day']),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id} {self.day}: {self.views}"
+
+
+# =========================================================
+# SEARCH ANALYTICS
+# =========================================================
+
+class SearchQuery(models.Model):
+    """Поиск в каталоге или переход из выдачи на товар (пишется пачками, cloth.search_log)"""
+    KIND_CHOICES = [
+        ('search', 'Поиск'),
+        ('click', 'Переход на товар'),
+    ]
+
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default='search', verbose_name="Событие")
+    query = models.CharField(max_length=255, verbose_name="Запрос")
+    results = models.PositiveIntegerField(null=True, blank=True, verbose_name="Найдено товаров")
+    duration_ms = models.FloatField(null=True, blank=True, verbose_name="Время ответа, мс")
+    clicked_product = models.ForeignKey(
+        Product, on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='search_clicks', verbose_name="Товар"
+    )
+    created_at = models.DateTimeField(default=timezone.now, verbose_name="Время")
+
+    class Meta:
+        verbose_name = "Поисковый запрос"
+        verbose_name_plural = "Поисковые запросы"
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.kind}: {self.query}"
@@ -1,8 +1,13 @@
+import json
 import uuid
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
 from django.conf import settings
+from django.db import transaction as db_transaction
+from django.db.models import F, Q, Sum
+from django.db.models.functions import Coalesce
 from django.urls import reverse
 from django.core.mail import send_mail
 
@@ -10,7 +15,11 @@ import yookassa
 from yookassa import Payment, Configuration
 from yookassa.domain.notification import WebhookNotification
 
-from .models import Transaction, TransactionStatus, Order, OrderStatus
+from . import metrics
+from .models import (
+    Transaction, TransactionStatus, Order, OrderStatus,
+    ProductVariant, Refund, RefundItem
+)
 
 logger = logging.getLogger(__name__)
 
@@ -39,30 +48,31 @@ class YooKassaClient:
             idempotence_key = str(uuid.uuid4())
 
             # Создаем платеж
-            payment = Payment.create({
-                "amount": {
-                    "value": f"{order.total_amount:.2f}",
-                    "currency": "RUB"
-                },
-                "confirmation": {
-                    "type": "redirect",
-                    "return_url": return_url
-                },
-                "capture": True,  # Автоматическое подтверждение платежа
-                "description": f"Оплата заказа №{order.order_number} в магазине CLOTH",
-                "metadata": {
-                    "order_id": order.id,
-                    "order_number": order.order_number,
-                    "user_id": order.user.id,
-                    "user_email": order.user.email
-                },
-                "receipt": {
-                    "customer": {
-                        "email": order.user.email
+            with metrics.yookassa_timer('create_payment'):
+                payment = Payment.create({
+                    "amount": {
+                        "value": f"{order.total_amount:.2f}",
+                        "currency": "RUB"
                     },
-                    "items": self._get_receipt_items(order)
-                }
-            }, idempotence_key)
+                    "confirmation": {
+                        "type": "redirect",
+                        "return_url": return_url
+                    },
+                    "capture": True,  # Автоматическое подтверждение платежа
+                    "description": f"Оплата заказа №{order.order_number} в магазине CLOTH",
+                    "metadata": {
+                        "order_id": order.id,
+                        "order_number": order.order_number,
+                        "user_id": order.user.id,
+                        "user_email": order.user.email
+                    },
+                    "receipt": {
+                        "customer": {
+                            "email": order.user.email
+                        },
+                        "items": self._get_receipt_items(order)
+                    }
+                }, idempotence_key)
 
             logger.info(f"Payment created: {payment.id} for order {order.order_number}")
             return payment
@@ -82,7 +92,8 @@ class YooKassaClient:
             Объект платежа или None в случае ошибки
         """
         try:
-            payment = Payment.find_one(payment_id)
+            with metrics.yookassa_timer('get_payment'):
+                payment = Payment.find_one(payment_id)
             return payment
         except Exception as e:
             logger.error(f"Failed to get payment info for {payment_id}: {e}")
@@ -109,7 +120,8 @@ class YooKassaClient:
                     "currency": "RUB"
                 }
 
-            payment = Payment.capture(payment_id, capture_data, idempotence_key)
+            with metrics.yookassa_timer('capture_payment'):
+                payment = Payment.capture(payment_id, capture_data, idempotence_key)
             logger.info(f"Payment captured: {payment_id}")
             return payment
 
@@ -129,7 +141,8 @@ class YooKassaClient:
         """
         try:
             idempotence_key = str(uuid.uuid4())
-            payment = Payment.cancel(payment_id, idempotence_key)
+            with metrics.yookassa_timer('cancel_payment'):
+                payment = Payment.cancel(payment_id, idempotence_key)
             logger.info(f"Payment canceled: {payment_id}")
             return payment
 
@@ -137,13 +150,16 @@ class YooKassaClient:
             logger.error(f"Failed to cancel payment {payment_id}: {e}")
             return None
 
-    def refund_payment(self, payment_id, amount):
+    def refund_payment(self, payment_id, amount, idempotence_key=None, receipt_items=None):
         """
         Возврат платежа
 
         Args:
             payment_id: ID платежа в ЮKassa
             amount: Сумма возврата
+            idempotence_key: Ключ идемпотентности (повторный запрос с тем же
+                ключом не создаст второй возврат)
+            receipt_items: Позиции чека возврата
 
         Returns:
             Объект возврата или None в случае ошибки
@@ -151,15 +167,20 @@ class YooKassaClient:
         try:
             from yookassa import Refund
 
-            idempotence_key = str(uuid.uuid4())
+            idempotence_key = str(idempotence_key or uuid.uuid4())
 
-            refund = Refund.create({
+            refund_data = {
                 "payment_id": payment_id,
                 "amount": {
                     "value": f"{amount:.2f}",
                     "currency": "RUB"
                 }
-            }, idempotence_key)
+            }
+            if receipt_items:
+                refund_data["receipt"] = {"items": receipt_items}
+
+            with metrics.yookassa_timer('refund_payment'):
+                refund = Refund.create(refund_data, idempotence_key)
 
             logger.info(f"Refund created: {refund.id} for payment {payment_id}")
             return refund
@@ -215,6 +236,7 @@ class PaymentService:
 
     def __init__(self):
         self.yookassa = YooKassaClient()
+        self.refunds = RefundService(self.yookassa)
 
     def process_payment(self, order, request):
         """
@@ -403,7 +425,9 @@ class PaymentService:
             True в случае успеха, False при ошибке
         """
         try:
-            # Получаем объект уведомления
+            # Получаем объект уведомления (SDK ожидает словарь, а не строку)
+            if isinstance(request_body, (str, bytes)):
+                request_body = json.loads(request_body)
             notification = WebhookNotification(request_body)
             event = notification.event
             payment = notification.object
@@ -420,11 +444,267 @@ class PaymentService:
                 # Здесь можно автоматически подтвердить платеж
                 # self.yookassa.capture_payment(payment.id)
             elif event == 'refund.succeeded':
-                logger.info(f"Refund succeeded for payment {payment.id}")
-                # Обработка возврата
+                # Для событий возврата объект уведомления -- сам возврат
+                logger.info(f"Refund succeeded: {payment.id} for payment {payment.payment_id}")
+                refund = self.refunds.handle_refund_succeeded(
+                    payment.id, payment_id=payment.payment_id, amount=payment.amount.value
+                )
+                if refund is None:
+                    # Ответ не 200 -- ЮKassa повторит уведомление позже
+                    return False
 
             return True
 
         except Exception as e:
             logger.error(f"Webhook processing error: {e}")
             return False
+
+
+class RefundService:
+    """Сервис возвратов: частичные возвраты по позициям и массовая отправка"""
+
+    # Сколько запросов к ЮKassa отправлять одновременно при массовом возврате
+    MAX_WORKERS = 8
+
+    def __init__(self, yookassa_client=None):
+        self.yookassa = yookassa_client or YooKassaClient()
+
+    def get_refundable_items(self, order):
+        """
+        Позиции заказа с количеством, которое ещё можно вернуть
+
+        Учитываются возвраты в статусах pending и succeeded, отменённые
+        возвраты количество не занимают.
+        """
+        return order.items.select_related('variant__product').annotate(
+            refunded_quantity=Coalesce(
+                Sum('refund_items__quantity', filter=~Q(refund_items__refund__status='canceled')),
+                0
+            )
+        ).annotate(
+            refundable_quantity=F('quantity') - F('refunded_quantity')
+        )
+
+    def create_refund(self, transaction, quantities=None, user=None, reason=''):
+        """
+        Создание возврата в статусе pending (без обращения к ЮKassa)
+
+        Args:
+            transaction: Успешная транзакция
+            quantities: Словарь {id позиции заказа: количество};
+                None -- вернуть всё, что ещё не возвращено
+            user: Инициатор возврата
+            reason: Причина возврата
+
+        Returns:
+            Объект возврата
+
+        Raises:
+            ValueError: если возвращать нечего или количество превышает доступное
+        """
+        with db_transaction.atomic():
+            # Блокируем транзакцию, чтобы параллельные возвраты не превысили количество
+            transaction = Transaction.objects.select_for_update(of=('self',)).select_related('status').get(pk=transaction.pk)
+
+            if transaction.status.name != 'succeeded':
+                raise ValueError(f'Транзакция {transaction.external_id} не оплачена или уже возвращена')
+
+            lines = []
+            for order_item in self.get_refundable_items(transaction.order):
+                if quantities is None:
+                    quantity = order_item.refundable_quantity
+                else:
+                    quantity = int(quantities.get(order_item.id, 0) or 0)
+
+                if quantity <= 0:
+                    continue
+                if quantity > order_item.refundable_quantity:
+                    raise ValueError(
+                        f'Для позиции "{order_item.variant.product.name}" можно вернуть '
+                        f'не более {order_item.refundable_quantity} шт.'
+                    )
+                lines.append((order_item, quantity))
+
+            if not lines:
+                raise ValueError(f'Нет позиций для возврата по транзакции {transaction.external_id}')
+
+            amount = sum((item.price_per_unit * quantity for item, quantity in lines), Decimal('0'))
+
+            refund = Refund.objects.create(
+                transaction=transaction,
+                amount=amount,
+                reason=reason,
+                created_by=user
+            )
+            RefundItem.objects.bulk_create([
+                RefundItem(
+                    refund=refund,
+                    order_item=item,
+                    quantity=quantity,
+                    amount=item.price_per_unit * quantity
+                )
+                for item, quantity in lines
+            ])
+
+        logger.info(f"Refund {refund.idempotence_key} created for transaction {transaction.external_id}: {amount}")
+        return refund
+
+    def submit_refund(self, refund):
+        """Отправка одного возврата в ЮKassa"""
+        return self.submit_refunds([refund])[0]
+
+    def submit_refunds(self, refunds):
+        """
+        Параллельная отправка возвратов в ЮKassa
+
+        В потоках выполняются только HTTP-запросы; результаты применяются
+        к базе в текущем потоке. Каждый возврат отправляется со своим
+        сохранённым ключом идемпотентности, поэтому повторная отправка
+        не приведёт к двойному списанию.
+
+        Returns:
+            Список объектов возврата с обновлённым статусом
+        """
+        refunds = [refund for refund in refunds if refund.status == 'pending']
+        if not refunds:
+            return []
+
+        requests = [
+            (
+                refund.transaction.external_id,
+                refund.amount,
+                refund.idempotence_key,
+                self._get_refund_receipt_items(refund),
+            )
+            for refund in refunds
+        ]
+
+        with ThreadPoolExecutor(max_workers=min(self.MAX_WORKERS, len(requests))) as executor:
+            responses = list(executor.map(lambda args: self.yookassa.refund_payment(*args), requests))
+
+        for refund, response in zip(refunds, responses):
+            self._apply_refund_response(refund, response)
+
+        return refunds
+
+    def handle_refund_succeeded(self, refund_id, payment_id=None, amount=None):
+        """
+        Обработка успешного возврата (webhook refund.succeeded)
+
+        Уведомление может прийти раньше, чем ответ ЮKassa на создание
+        возврата сохранит external_id. Тогда возврат ищется среди ожидающих
+        возвратов платежа payment_id без external_id (по сумме, если их
+        несколько); если однозначно найти не удалось, возвращается None, и
+        уведомление нужно повторить.
+
+        Args:
+            refund_id: ID возврата в ЮKassa
+            payment_id: ID платежа в ЮKassa
+            amount: Сумма возврата из уведомления
+
+        Returns:
+            Объект возврата или None
+        """
+        refund = Refund.objects.select_related('transaction').filter(external_id=refund_id).first()
+        if refund is None and payment_id:
+            candidates = Refund.objects.select_related('transaction').filter(
+                transaction__external_id=payment_id, external_id__isnull=True, status='pending'
+            )
+            if amount is not None and candidates.count() > 1:
+                candidates = candidates.filter(amount=Decimal(str(amount)))
+            matched = list(candidates[:2])
+            if len(matched) == 1:
+                refund = matched[0]
+                refund.external_id = refund_id
+                refund.save(update_fields=['external_id', 'updated_at'])
+
+        if refund is None:
+            logger.error(f"Refund not found: {refund_id} (payment {payment_id}), notification will be retried")
+            return None
+
+        self._complete_refund(refund)
+        return refund
+
+    def _apply_refund_response(self, refund, response):
+        """Сохранение ответа ЮKassa по возврату"""
+        if response is None:
+            # Возврат остаётся в pending и может быть отправлен повторно с тем же ключом
+            logger.warning(f"Refund {refund.idempotence_key} was not accepted by YooKassa")
+            return
+
+        refund.external_id = response.id
+        refund.save(update_fields=['external_id', 'updated_at'])
+
+        if response.status == 'succeeded':
+            self._complete_refund(refund)
+        elif response.status == 'canceled':
+            Refund.objects.filter(pk=refund.pk, status='pending').update(status='canceled')
+            refund.status = 'canceled'
+
+    def _complete_refund(self, refund):
+        """
+        Завершение возврата: возврат товара на склад и обновление статусов
+
+        Повторный вызов (ответ API + webhook) ничего не меняет: склад
+        пополняется только тем вызовом, который перевёл флаг stock_returned.
+        """
+        with db_transaction.atomic():
+            updated = Refund.objects.filter(pk=refund.pk, stock_returned=False).update(
+                status='succeeded',
+                stock_returned=True
+            )
+            refund.status = 'succeeded'
+            if not updated:
+                return
+
+            refund.stock_returned = True
+            for refund_item in refund.items.select_related('order_item'):
+                ProductVariant.objects.filter(pk=refund_item.order_item.variant_id).update(
+                    stock_quantity=F('stock_quantity') + refund_item.quantity
+                )
+
+            transaction = refund.transaction
+            refunded_total = transaction.refunds.filter(status='succeeded').aggregate(
+                total=Sum('amount')
+            )['total'] or Decimal('0')
+            items_total = transaction.order.items.aggregate(
+                total=Sum(F('price_per_unit') * F('quantity'))
+            )['total'] or Decimal('0')
+
+            # Транзакция считается возвращённой, когда возвращены все позиции:
+            # доставка в возвраты по позициям не входит, поэтому сумма платежа
+            # может так и не набраться
+            if refunded_total >= min(transaction.amount, items_total):
+                status_refunded, _ = TransactionStatus.objects.get_or_create(name='refunded')
+                transaction.status = status_refunded
+                transaction.save(update_fields=['status', 'updated_at'])
+
+        logger.info(f"Refund {refund.external_id} succeeded for transaction {refund.transaction.external_id}")
+
+    def _get_refund_receipt_items(self, refund):
+        """
+        Формирование элементов чека возврата
+
+        Args:
+            refund: Объект возврата
+
+        Returns:
+            Список товаров для чека
+        """
+        items = []
+
+        for refund_item in refund.items.select_related('order_item__variant__product'):
+            order_item = refund_item.order_item
+            items.append({
+                "description": order_item.variant.product.name[:128],
+                "quantity": refund_item.quantity,
+                "amount": {
+                    "value": f"{order_item.price_per_unit:.2f}",
+                    "currency": "RUB"
+                },
+                "vat_code": 1,
+                "payment_mode": "full_payment",
+                "payment_subject": "commodity"
+            })
+
+        return items
@@ -0,0 +1,151 @@
+"""
+Популярность товаров и подборки главной страницы
+
+Оценка товара -- сумма событий за последние WINDOW_DAYS дней
+с экспоненциальным затуханием (вклад события вдвое меньше каждые
+HALF_LIFE_DAYS дней):
+  - проданные штуки в оплаченных заказах (вес SALES_WEIGHT);
+  - добавления в избранное (вес WISHLIST_WEIGHT);
+  - просмотры страницы товара (вес VIEW_WEIGHT, cloth.view_counter).
+
+rank_products() записывает оценку в Product.popularity_score (сортировка
+каталога "Популярные"), подборки "Хиты продаж" и "Новинки" -- в ProductRanking
+(главная читает их одним запросом), а флаги is_bestseller и is_new
+приводит в соответствие с подборками.
+"""
+from collections import defaultdict
+from datetime import timedelta
+import logging
+
+from django.db import transaction
+from django.db.models import Sum, Count
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .cache import bump_catalog_version, invalidate_products
+from .models import OrderItem, Product, ProductRanking, ProductViewDaily, Wishlist
+from .recommendations import PURCHASED_STATUSES
+
+logger = logging.getLogger(__name__)
+
+WINDOW_DAYS = 90
+HALF_LIFE_DAYS = 14
+SALES_WEIGHT = 1.0
+WISHLIST_WEIGHT = 0.3
+# Просмотров на порядки больше, чем покупок
+VIEW_WEIGHT = 0.02
+# Товар считается новинкой столько дней после создания
+NEW_DAYS = 30
+LIST_SIZE = 8
+
+
+def _decay(age_days):
+    return 0.5 ** (max(age_days, 0) / HALF_LIFE_DAYS)
+
+
+def product_scores(now=None):
+    """
+    Оценки популярности товаров
+
+    События агрегируются в базе по дням, поэтому объём выборки
+    ограничен числом товаров x WINDOW_DAYS, а не числом заказов.
+
+    Returns:
+        dict: {product_id: оценка} (товары без событий отсутствуют)
+    """
+    now = now or timezone.now()
+    today = timezone.localdate(now)
+    since = now - timedelta(days=WINDOW_DAYS)
+    scores = defaultdict(float)
+
+    sales = (
+        OrderItem.objects.filter(order__status__name__in=PURCHASED_STATUSES, order__created_at__gte=since)
+        .annotate(day=TruncDate('order__created_at'))
+        .values('variant__product_id', 'day')
+        .annotate(quantity=Sum('quantity'))
+        .order_by()
+    )
+    for row in sales:
+        scores[row['variant__product_id']] += SALES_WEIGHT * row['quantity'] * _decay((today - row['day']).days)
+
+    wishlist = (
+        Wishlist.objects.filter(added_at__gte=since)
+        .annotate(day=TruncDate('added_at'))
+        .values('product_id', 'day')
+        .annotate(count=Count('id'))
+        .order_by()
+    )
+    for row in wishlist:
+        scores[row['product_id']] += WISHLIST_WEIGHT * row['count'] * _decay((today - row['day']).days)
+
+    views = (
+        ProductViewDaily.objects.filter(day__gte=timezone.localdate(since))
+        .values_list('product_id', 'day', 'views')
+    )
+    for product_id, day, count in views:
+        scores[product_id] += VIEW_WEIGHT * count * _decay((today - day).days)
+
+    return dict(scores)
+
+
+def rank_products(now=None):
+    """
+    Пересчитать популярность, подборки главной и флаги товаров
+
+    Returns:
+        dict: {'scored', 'updated', 'bestsellers', 'new', 'flags_changed'}
+    """
+    now = now or timezone.now()
+    scores = product_scores(now)
+    products = list(Product.objects.values_list('id', 'popularity_score', 'created_at', 'is_active'))
+
+    changed = [
+        Product(id=product_id, popularity_score=round(scores.get(product_id, 0.0), 6))
+        for product_id, old_score, _, _ in products
+        if abs(old_score - scores.get(product_id, 0.0)) > 1e-6
+    ]
+    Product.objects.bulk_update(changed, ['popularity_score'], batch_size=1000)
+
+    # При равной оценке выше более новый товар
+    active = sorted(
+        ((product_id, created_at) for product_id, _, created_at, is_active in products if is_active),
+        key=lambda item: (-scores.get(item[0], 0.0), -item[1].timestamp()),
+    )
+    bestsellers = [product_id for product_id, _ in active if scores.get(product_id, 0.0) > 0][:LIST_SIZE]
+    new_since = now - timedelta(days=NEW_DAYS)
+    new = [product_id for product_id, created_at in active if created_at >= new_since][:LIST_SIZE]
+
+    rows = [
+        ProductRanking(list_name=list_name, position=position, product_id=product_id, score=scores.get(product_id, 0.0))
+        for list_name, ranked in (('bestsellers', bestsellers), ('new', new))
+        for position, product_id in enumerate(ranked)
+    ]
+    with transaction.atomic():
+        ProductRanking.objects.all().delete()
+        ProductRanking.objects.bulk_create(rows)
+        flags_changed = _sync_flag('is_bestseller', bestsellers, now) | _sync_flag('is_new', new, now)
+
+    # Бейдж "Новинка" есть на странице товара, порядок товаров -- в каталоге
+    invalidate_products(flags_changed)
+    bump_catalog_version()
+
+    stats = {
+        'scored': len(scores),
+        'updated': len(changed),
+        'bestsellers': len(bestsellers),
+        'new': len(new),
+        'flags_changed': len(flags_changed),
+    }
+    logger.info(f"Products ranked: {stats}")
+    return stats
+
+
+def _sync_flag(field, product_ids, now):
+    """Выставить флаг ровно товарам из подборки, вернуть id изменённых"""
+    unset = Product.objects.filter(**{field: True}).exclude(id__in=product_ids)
+    missing = Product.objects.filter(**{field: False}, id__in=product_ids)
+    changed = set(unset.values_list('id', flat=True)) | set(missing.values_list('id', flat=True))
+    # update() не трогает auto_now: updated_at нужен ETag страницы товара и индексу похожих товаров
+    unset.update(**{field: False}, updated_at=now)
+    missing.update(**{field: True}, updated_at=now)
+    return changed
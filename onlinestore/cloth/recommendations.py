@@ -0,0 +1,157 @@
+"""
+Рекомендации "С этим товаром покупают"
+
+Матрица заказы x товары (1 -- товар есть в заказе) строится из OrderItem
+через variant.product. Её произведение X.T @ X -- матрица совместных покупок:
+элемент (i, j) равен числу заказов, где были оба товара. Оценка нормируется
+на популярность товаров (косинусная мера), чтобы самые продаваемые товары
+не оказывались соседями у всех подряд.
+
+Товарам, у которых соседей по покупкам меньше k (новые и редкие), список
+дополняется похожими по описанию (индекс cloth.similarity, если он построен),
+а затем самыми покупаемыми товарами той же категории.
+"""
+import logging
+
+import numpy as np
+from scipy import sparse
+
+from django.db import transaction
+
+from .models import OrderItem, Product, ProductRecommendation
+from .similarity import similar_product_ids
+
+logger = logging.getLogger(__name__)
+
+# Заказы, которые считаются покупкой
+PURCHASED_STATUSES = ['paid', 'confirmed', 'shipped', 'delivered']
+DEFAULT_TOP_K = 8
+
+
+def purchase_matrix():
+    """
+    Разреженная матрица заказы x товары
+
+    Returns:
+        tuple: (csr_matrix, массив id товаров по столбцам)
+    """
+    pairs = np.array(
+        OrderItem.objects.filter(order__status__name__in=PURCHASED_STATUSES)
+        .values_list('order_id', 'variant__product_id')
+        .distinct(),
+        dtype=np.int64,
+    ).reshape(-1, 2)
+
+    order_ids, rows = np.unique(pairs[:, 0], return_inverse=True)
+    product_ids, columns = np.unique(pairs[:, 1], return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(pairs), dtype=np.float32), (rows, columns)),
+        shape=(len(order_ids), len(product_ids)),
+    )
+    return matrix, product_ids
+
+
+def co_purchase_neighbours(matrix, k=DEFAULT_TOP_K):
+    """
+    Top-k соседей каждого товара по совместным покупкам
+
+    Args:
+        matrix: заказы x товары (0/1)
+        k: сколько соседей оставить
+
+    Returns:
+        tuple: (popularity -- число заказов с товаром,
+                {индекс столбца: [(индекс соседа, оценка), ...]} по убыванию оценки)
+    """
+    co_occurrence = (matrix.T @ matrix).tocsr()
+    popularity = np.asarray(co_occurrence.diagonal()).ravel()
+    co_occurrence.setdiag(0)
+    co_occurrence.eliminate_zeros()
+
+    # cos(i, j) = co(i, j) / sqrt(n_i * n_j)
+    norms = np.sqrt(popularity)
+    norms[norms == 0] = 1
+    scaling = sparse.diags(1 / norms)
+    similarity = (scaling @ co_occurrence @ scaling).tocsr()
+
+    neighbours = {}
+    for row in range(similarity.shape[0]):
+        start, end = similarity.indptr[row], similarity.indptr[row + 1]
+        if start == end:
+            continue
+        columns = similarity.indices[start:end]
+        scores = similarity.data[start:end]
+        if len(scores) > k:
+            top = np.argpartition(-scores, k)[:k]
+            columns, scores = columns[top], scores[top]
+        # При равной оценке -- более популярный сосед
+        order = np.lexsort((-popularity[columns], -scores))
+        neighbours[row] = [(int(columns[i]), float(scores[i])) for i in order]
+    return popularity, neighbours
+
+
+def build_recommendations(k=DEFAULT_TOP_K):
+    """
+    Пересчитать таблицу ProductRecommendation целиком
+
+    Returns:
+        dict: {'products', 'co_purchase', 'similar', 'category'} -- сколько товаров
+              и рекомендаций каждого вида записано
+    """
+    matrix, product_ids = purchase_matrix()
+    if len(product_ids):
+        popularity, neighbours = co_purchase_neighbours(matrix, k)
+    else:
+        popularity, neighbours = np.zeros(0), {}
+
+    sales = dict(zip(product_ids.tolist(), popularity.tolist()))
+    products = list(Product.objects.values_list('id', 'category_id', 'is_active'))
+    active = {product_id for product_id, _, is_active in products if is_active}
+
+    # Популярные товары каждой категории для дополнения списка
+    by_category = {}
+    for product_id, category_id, is_active in products:
+        if is_active:
+            by_category.setdefault(category_id, []).append(product_id)
+    for category_products in by_category.values():
+        category_products.sort(key=lambda product_id: (-sales.get(product_id, 0), -product_id))
+
+    rows = []
+    stats = {'products': 0, 'co_purchase': 0, 'similar': 0, 'category': 0}
+    column_of = {product_id: column for column, product_id in enumerate(product_ids.tolist())}
+    for product_id, category_id, _ in products:
+        chosen = []
+        column = column_of.get(product_id)
+        for neighbour, score in neighbours.get(column, []):
+            recommended = int(product_ids[neighbour])
+            if recommended in active:
+                chosen.append((recommended, score, 'co_purchase'))
+
+        seen = {product_id} | {recommended for recommended, _, _ in chosen}
+        if len(chosen) < k:
+            for recommended in similar_product_ids(product_id):
+                if len(chosen) >= k:
+                    break
+                if recommended in active and recommended not in seen:
+                    chosen.append((recommended, 0.0, 'similar'))
+                    seen.add(recommended)
+        for recommended in by_category.get(category_id, []):
+            if len(chosen) >= k:
+                break
+            if recommended not in seen:
+                chosen.append((recommended, 0.0, 'category'))
+                seen.add(recommended)
+
+        for rank, (recommended, score, source) in enumerate(chosen[:k]):
+            rows.append(ProductRecommendation(
+                product_id=product_id, recommended_id=recommended, rank=rank, score=score, source=source
+            ))
+            stats[source] += 1
+        stats['products'] += bool(chosen)
+
+    with transaction.atomic():
+        ProductRecommendation.objects.all().delete()
+        ProductRecommendation.objects.bulk_create(rows, batch_size=1000)
+
+    logger.info(f"Recommendations rebuilt: {stats}")
+    return stats
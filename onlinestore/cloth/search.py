@@ -0,0 +1,276 @@
+"""
+Поиск по каталогу с опечатками и транслитом
+
+Запрос сравнивается с названием, материалом и категорией товара по
+триграммам (тройкам букв), как в pg_trgm: "футбока" находит "футболку",
+хотя подстроки "футбока" в названии нет. Слово запроса совпадает с
+документом, если доля его триграмм, найденных в документе, не ниже
+WORD_SIMILARITY; товар найден, если совпали все слова запроса.
+
+Запрос латиницей переводится в кириллицу обратной таблицей TRANSLIT_MAP
+(той же, по которой строятся slug): "dzhinsy" -> "джинсы". Распространённые
+варианты записи ("djinsy", "jinsy", "shch"/"sch", "w", "x") добавлены
+отдельно. Ищутся также запрос как есть и в другой раскладке (cloth.suggest).
+
+PostgreSQL: условие word_similarity (оператор %>) по GIN-индексам
+gin_trgm_ops на name и material (миграция 0013), порядок -- по
+TrigramWordSimilarity. Категории (их немного) сопоставляются отдельным
+запросом и входят в условие как category_id IN (...): условие на
+присоединённую таблицу в OR не даёт планировщику объединить индексы
+cloth_product (BitmapOr) и ведёт к последовательному чтению.
+
+Другие базы: n-граммный индекс в памяти процесса, перестраивается при смене
+версии каталога (cloth.cache). Он отдаёт не больше MAX_RESULTS лучших
+товаров: более слабые совпадения в выдачу не попадают.
+"""
+from functools import reduce
+import logging
+import operator
+import threading
+import time
+
+import numpy as np
+
+from django.db import connections
+from django.db.models import Case, F, FloatField, IntegerField, Q, Value, When
+from django.db.models.functions import Greatest
+
+from .cache import get_catalog_version
+from .management.commands.reset_products import TRANSLIT_MAP, cyrillic_slugify
+from .models import Category, Product
+from .suggest import normalize, query_variants
+
+logger = logging.getLogger(__name__)
+
+# Порог pg_trgm.word_similarity_threshold по умолчанию
+WORD_SIMILARITY = 0.6
+# Сколько лучших товаров индекс в памяти отдаёт в каталог (остальные отбрасываются)
+MAX_RESULTS = 500
+# Поля товара, по которым ищет PostgreSQL (GIN-индексы миграции 0013)
+SEARCH_FIELDS = ('name', 'material')
+
+# Латиница -> кириллица: сначала длинные сочетания ("shch" раньше "sh" и "s")
+_FROM_LATIN = {}
+for _cyrillic, _latin in TRANSLIT_MAP.items():
+    if _latin and _cyrillic not in 'ёэ':
+        _FROM_LATIN.setdefault(_latin, _cyrillic)
+_FROM_LATIN.update({
+    'y': 'ы', 'e': 'е', 'yo': 'ё', 'jo': 'ё', 'ju': 'ю', 'ja': 'я', 'ia': 'я', 'iu': 'ю',
+    'dj': 'дж', 'j': 'дж', 'sch': 'щ', 'w': 'в', 'x': 'кс', 'q': 'к', 'c': 'к', 'h': 'х',
+})
+_LATIN_KEYS = sorted(_FROM_LATIN, key=len, reverse=True)
+_VOWELS = 'аеёиоуыэюя'
+
+
+def to_cyrillic(text):
+    """
+    Латинская транслитерация -> кириллица ("dzhinsy", "djinsy" -> "джинсы")
+
+    "y" после гласной читается как "й" ("sinyaya" -> "синяя", "kray" -> "край"),
+    иначе как "ы". Буквы, которых нет в таблице, остаются как есть.
+    """
+    text = text.lower()
+    result = []
+    position = 0
+    while position < len(text):
+        for latin in _LATIN_KEYS:
+            if text.startswith(latin, position):
+                cyrillic = _FROM_LATIN[latin]
+                if latin == 'y' and result and result[-1][-1:] in _VOWELS:
+                    cyrillic = 'й'
+                result.append(cyrillic)
+                position += len(latin)
+                break
+        else:
+            result.append(text[position])
+            position += 1
+    return ''.join(result)
+
+
+def search_variants(query):
+    """
+    Нормализованные формы запроса для поиска
+
+    Запрос как есть, в другой раскладке и, если в нём есть латиница, --
+    транслитерацией в кириллицу.
+    """
+    variants = query_variants(query)
+    if variants and any('a' <= char <= 'z' for char in variants[0]):
+        transliterated = normalize(to_cyrillic(variants[0]))
+        if transliterated not in variants:
+            variants.append(transliterated)
+    return variants
+
+
+def trigrams(word):
+    """Триграммы слова в духе pg_trgm: два пробела в начале, один в конце"""
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NgramIndex:
+    """
+    Инвертированный индекс триграмм: триграмма -> массив номеров документов
+
+    Args:
+        documents: [(product_id, текст)]
+    """
+
+    def __init__(self, documents):
+        self.product_ids = np.array([product_id for product_id, _ in documents], dtype=np.int64)
+        postings = {}
+        for number, (_, text) in enumerate(documents):
+            grams = set()
+            for word in normalize(text).split():
+                grams |= trigrams(word)
+            for gram in grams:
+                postings.setdefault(gram, []).append(number)
+        self.postings = {gram: np.array(numbers, dtype=np.int32) for gram, numbers in postings.items()}
+
+    def word_scores(self, word):
+        """Доля триграмм слова, найденных в каждом документе"""
+        grams = trigrams(word)
+        found = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not found:
+            return np.zeros(len(self.product_ids))
+        counts = np.bincount(np.concatenate(found), minlength=len(self.product_ids))
+        return counts / len(grams)
+
+    def search(self, query, limit=MAX_RESULTS):
+        """
+        Товары, подходящие под запрос, по убыванию сходства
+
+        Returns:
+            list: [(product_id, сходство)]
+        """
+        if not len(self.product_ids):
+            return []
+        best = np.zeros(len(self.product_ids))
+        for variant in search_variants(query):
+            words = variant.split()
+            scores = np.ones(len(self.product_ids))
+            total = np.zeros(len(self.product_ids))
+            for word in words:
+                word_score = self.word_scores(word)
+                # Все слова запроса должны совпасть
+                scores = np.where(word_score >= WORD_SIMILARITY, scores, 0)
+                total += word_score
+            best = np.maximum(best, np.where(scores > 0, total / len(words), 0))
+
+        matched = np.flatnonzero(best)
+        if len(matched) > limit:
+            logger.info(f"Search {query!r} matched {len(matched)} products, keeping best {limit}")
+            matched = matched[np.argpartition(-best[matched], limit - 1)[:limit]]
+        # При равном сходстве -- более новый товар (больший id)
+        order = np.lexsort((-self.product_ids[matched], -best[matched]))
+        return [(int(self.product_ids[i]), float(best[i])) for i in matched[order]]
+
+
+def catalog_documents():
+    """
+    Документы индекса: название, материал и категория активных товаров
+
+    К названию добавлена его транслитерация (cyrillic_slugify), поэтому
+    латинский запрос совпадает и тогда, когда обратный перевод неоднозначен
+    ("e" -- это "е" или "э").
+    """
+    products = Product.objects.filter(is_active=True).values_list('id', 'name', 'material', 'category__name')
+    return [
+        (product_id, f'{name} {cyrillic_slugify(name).replace("-", " ")} {material} {category or ""}')
+        for product_id, name, material, category in products
+    ]
+
+
+_index = None
+_index_version = None
+_build_lock = threading.Lock()
+
+
+def get_index():
+    """Индекс этого процесса; перестраивается при смене версии каталога"""
+    global _index, _index_version
+    version = get_catalog_version()
+    if _index is not None and version == _index_version:
+        return _index
+    with _build_lock:
+        if _index is None or version != _index_version:
+            start = time.perf_counter()
+            _index = NgramIndex(catalog_documents())
+            _index_version = version
+            logger.info(
+                f"Search index built: {len(_index.product_ids)} products, {len(_index.postings)} trigrams "
+                f"in {(time.perf_counter() - start) * 1000:.0f} ms"
+            )
+    return _index
+
+
+def search_products(queryset, query):
+    """
+    Отфильтровать товары по запросу
+
+    Returns:
+        tuple: (queryset, выражение для сортировки по релевантности или None,
+                если запрос пустой после нормализации)
+    """
+    variants = search_variants(query)
+    if not variants:
+        return queryset, None
+    if connections[queryset.db].vendor == 'postgresql':
+        return _search_postgresql(queryset, variants)
+
+    found = get_index().search(query)
+    ids = [product_id for product_id, _ in found]
+    relevance = Case(
+        *[When(id=product_id, then=Value(position)) for position, product_id in enumerate(ids)],
+        default=Value(len(ids)), output_field=IntegerField(),
+    )
+    return queryset.filter(id__in=ids), relevance.asc()
+
+
+def _search_postgresql(queryset, variants):
+    """Оператор %> по GIN-индексам pg_trgm, порядок по word_similarity"""
+    # contrib.postgres импортирует psycopg, поэтому только здесь
+    from django.contrib.postgres.lookups import TrigramWordSimilar
+    from django.contrib.postgres.search import TrigramWordSimilarity
+
+    def greatest(expressions):
+        return expressions[0] if len(expressions) == 1 else Greatest(*expressions)
+
+    categories = {}
+
+    def matching_categories(word):
+        """{id категории: сходство} -- отдельный запрос по маленькой таблице"""
+        if word not in categories:
+            categories[word] = dict(
+                Category.objects.filter(TrigramWordSimilar(F('name'), Value(word)))
+                .annotate(similarity=TrigramWordSimilarity(word, 'name'))
+                .values_list('id', 'similarity')
+            )
+        return categories[word]
+
+    conditions, relevances = [], []
+    for variant in variants:
+        words = variant.split()
+        word_conditions, word_relevances = [], []
+        for word in words:
+            matched = matching_categories(word)
+            condition = reduce(operator.or_, [
+                Q(TrigramWordSimilar(F(field), Value(word))) for field in SEARCH_FIELDS
+            ])
+            similarities = [TrigramWordSimilarity(word, field) for field in SEARCH_FIELDS]
+            if matched:
+                condition |= Q(category_id__in=list(matched))
+                similarities.append(Case(
+                    *[When(category_id=category_id, then=Value(similarity))
+                      for category_id, similarity in matched.items()],
+                    default=Value(0.0), output_field=FloatField(),
+                ))
+            word_conditions.append(condition)
+            word_relevances.append(greatest(similarities))
+        conditions.append(reduce(operator.and_, word_conditions))
+        relevances.append(reduce(operator.add, word_relevances) / len(words))
+
+    queryset = queryset.filter(reduce(operator.or_, conditions)).alias(
+        relevance=greatest(relevances) if len(relevances) > 1 else relevances[0],
+    )
+    return queryset, F('relevance').desc(nulls_last=True)
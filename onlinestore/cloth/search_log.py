@@ -0,0 +1,200 @@
+"""
+Журнал поиска каталога
+
+Каждый поиск (?q= на первой странице каталога) -- строка SearchQuery с
+нормализованным запросом, числом найденных товаров и временем ответа;
+переход из выдачи на страницу товара (Referer -- каталог с q) -- строка
+с kind='click' и товаром.
+
+Как и счётчики просмотров (cloth.view_counter), события не пишутся в базу
+в запросе посетителя: они копятся в буфере процесса, и раз в
+SEARCH_LOG_FLUSH_SECONDS (или при SEARCH_LOG_MAX_PENDING событиях в буфере)
+уходят одним bulk_create (перед ним -- проверка, что товары переходов ещё
+не удалены). Если запись не удалась, события возвращаются
+в буфер; при долгой недоступности базы самые старые отбрасываются, чтобы
+буфер не рос без предела.
+
+Число найденных товаров view отдаёт заголовком X-Search-Results: он
+сохраняется в кэше страниц, поэтому попадания в кэш тоже учитываются.
+
+search_report() -- сводка для команды search_report: частые запросы,
+запросы без результатов и медленные запросы.
+"""
+from functools import wraps
+from urllib.parse import parse_qs, urlsplit
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import Avg, Count, Max, Q
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import Product, SearchQuery
+from .suggest import normalize
+
+logger = logging.getLogger(__name__)
+
+RESULTS_HEADER = 'X-Search-Results'
+MAX_QUERY_LENGTH = SearchQuery._meta.get_field('query').max_length
+# Сколько буферов может накопиться, пока база недоступна
+MAX_BACKLOG_FLUSHES = 10
+
+_lock = threading.Lock()
+_pending = []
+_last_flush = time.monotonic()
+# Буфер, унаследованный при fork, принадлежит родителю
+_pid = os.getpid()
+
+
+def _record(event):
+    global _pending, _last_flush, _pid
+    with _lock:
+        if _pid != os.getpid():
+            _pending, _pid, _last_flush = [], os.getpid(), time.monotonic()
+        _pending.append(event)
+        due = (len(_pending) >= settings.SEARCH_LOG_MAX_PENDING
+               or time.monotonic() - _last_flush >= settings.SEARCH_LOG_FLUSH_SECONDS)
+    if due:
+        flush_search_log()
+
+
+def record_search(query, results, duration_ms):
+    """Учесть поиск (запись в базу -- когда подойдёт срок)"""
+    query = normalize(query)[:MAX_QUERY_LENGTH]
+    if query:
+        _record(SearchQuery(kind='search', query=query, results=results,
+                            duration_ms=round(duration_ms, 2), created_at=timezone.now()))
+
+
+def record_click(query, product_id):
+    """Учесть переход из выдачи по запросу на страницу товара"""
+    query = normalize(query)[:MAX_QUERY_LENGTH]
+    if query:
+        _record(SearchQuery(kind='click', query=query, clicked_product_id=product_id, created_at=timezone.now()))
+
+
+def pending_events():
+    """Ещё не записанные события этого процесса"""
+    with _lock:
+        return list(_pending)
+
+
+def flush_search_log():
+    """
+    Записать накопленные события в базу
+
+    Returns:
+        int: сколько строк записано
+    """
+    global _pending, _last_flush
+    with _lock:
+        pending, _pending = _pending, []
+        _last_flush = time.monotonic()
+    if not pending:
+        return 0
+
+    try:
+        _forget_deleted_products(pending)
+        SearchQuery.objects.bulk_create(pending, batch_size=500)
+    except DatabaseError as e:
+        logger.warning(f"Search log flush failed, will retry: {e}")
+        with _lock:
+            _pending[:0] = pending
+            overflow = len(_pending) - settings.SEARCH_LOG_MAX_PENDING * MAX_BACKLOG_FLUSHES
+            if overflow > 0:
+                del _pending[:overflow]
+                logger.warning(f"Search log backlog full, dropped {overflow} oldest events")
+        return 0
+    return len(pending)
+
+
+def _forget_deleted_products(events):
+    """Товар мог быть удалён, пока событие ждало в буфере: как SET_NULL у внешнего ключа"""
+    product_ids = {event.clicked_product_id for event in events if event.clicked_product_id}
+    if not product_ids:
+        return
+    existing = set(Product.objects.filter(id__in=product_ids).values_list('id', flat=True))
+    for event in events:
+        if event.clicked_product_id not in existing:
+            event.clicked_product_id = None
+
+
+def log_search(view_func):
+    """
+    Декоратор каталога: журнал поиска с временем ответа
+
+    Ставится над cache_anonymous_page, чтобы учитывать и ответы из кэша.
+    Листание страниц выдачи -- не новый поиск, учитывается только первая.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        start = time.perf_counter()
+        response = view_func(request, *args, **kwargs)
+        results = response.get(RESULTS_HEADER)
+        if (request.method == 'GET' and response.status_code == 200 and results is not None
+                and request.GET.get('page', '1') == '1'):
+            record_search(request.GET.get('q', ''), int(results), (time.perf_counter() - start) * 1000)
+        return response
+    return wrapper
+
+
+def referring_query(request):
+    """Поисковый запрос из Referer, если посетитель пришёл из выдачи каталога"""
+    referer = request.META.get('HTTP_REFERER')
+    if not referer:
+        return None
+    parts = urlsplit(referer)
+    if parts.netloc and parts.netloc != request.get_host():
+        return None
+    if parts.path != reverse('catalog'):
+        return None
+    query = parse_qs(parts.query).get('q', [''])[-1]
+    return query if query.strip() else None
+
+
+def search_report(since, limit=20, slow_ms=500):
+    """
+    Сводка журнала поиска с момента since
+
+    Args:
+        since: начало периода
+        limit: сколько запросов в каждом списке
+        slow_ms: порог медленного поиска (максимум времени ответа)
+
+    Returns:
+        dict: {'searches', 'clicks', 'zero_results', 'top', 'zero', 'slow'};
+              списки -- словари с query, searches, clicks, avg_results, avg_ms, max_ms
+    """
+    events = SearchQuery.objects.filter(created_at__gte=since)
+    totals = events.aggregate(
+        searches=Count('id', filter=Q(kind='search')),
+        clicks=Count('id', filter=Q(kind='click')),
+        zero_results=Count('id', filter=Q(kind='search', results=0)),
+    )
+
+    by_query = (
+        events.values('query')
+        .annotate(
+            searches=Count('id', filter=Q(kind='search')),
+            clicks=Count('id', filter=Q(kind='click')),
+            avg_results=Avg('results'),
+            avg_ms=Avg('duration_ms'),
+            max_ms=Max('duration_ms'),
+        )
+        .filter(searches__gt=0)
+    )
+    return {
+        **totals,
+        'top': list(by_query.order_by('-searches', 'query')[:limit]),
+        # Средний ноль -- ни одна выдача по запросу не нашла товаров
+        'zero': list(by_query.filter(avg_results=0).order_by('-searches', 'query')[:limit]),
+        'slow': list(by_query.filter(max_ms__gte=slow_ms).order_by('-max_ms', 'query')[:limit]),
+    }
+
+
+atexit.register(flush_search_log)
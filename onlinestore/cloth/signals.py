@@ -0,0 +1,29 @@
+"""Сброс кэшей при изменении каталога"""
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cache import bump_all_card_versions, bump_catalog_version, invalidate_products
+from .models import Category, Color, Product, ProductImage, ProductVariant
+
+
+@receiver([post_save, post_delete], sender=Product)
+def product_changed(sender, instance, **kwargs):
+    invalidate_products([instance.pk])
+
+
+@receiver([post_save, post_delete], sender=ProductVariant)
+@receiver([post_save, post_delete], sender=ProductImage)
+def product_part_changed(sender, instance, **kwargs):
+    invalidate_products([instance.product_id])
+
+
+@receiver([post_save, post_delete], sender=Category)
+def category_changed(sender, instance, **kwargs):
+    bump_catalog_version()
+
+
+@receiver([post_save, post_delete], sender=Color)
+def color_changed(sender, instance, **kwargs):
+    # Название и цвет точки есть в карточках любых товаров
+    bump_all_card_versions()
+    bump_catalog_version()
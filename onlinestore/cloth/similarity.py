@@ -0,0 +1,332 @@
+"""
+Похожие товары по содержанию (TF-IDF)
+
+Для товаров без истории покупок соседи ищутся по тексту: названию,
+описанию, материалу, категории и полу. Слова переводятся в латиницу
+по TRANSLIT_MAP ("футболка" и "futbolka" -- одно слово), от них отрезаются
+типичные окончания; вектор товара -- TF-IDF с весами полей, близость -- косинус.
+
+Индекс -- один .npy-файл со структурированным массивом
+(id товара, k соседей, k оценок), отсортированным по id. Воркеры открывают
+его через np.load(mmap_mode='r'): страницы файла общие для всех процессов
+(page cache ОС), а после атомарной замены файла воркер переоткрывает его
+по изменившемуся mtime.
+
+build_similarity_index() по умолчанию обновляет индекс инкрементально:
+строки товаров, изменённых после прошлого построения, считаются заново,
+а в строки остальных товаров изменённые товары добавляются как кандидаты.
+Оценки между неизменёнными товарами не пересчитываются (IDF немного
+"плывёт"), поэтому периодически индекс стоит строить целиком (full=True).
+"""
+from datetime import datetime, timezone as dt_timezone
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+from django.conf import settings
+from django.utils import timezone
+
+from .management.commands.reset_products import TRANSLIT_MAP
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOP_K = 8
+# Вес слов каждого поля товара
+FIELD_WEIGHTS = {'name': 3.0, 'material': 2.0, 'description': 1.0}
+CATEGORY_WEIGHT = 2.0
+GENDER_WEIGHT = 1.0
+# Доля изменённых товаров, начиная с которой индекс строится заново
+FULL_REBUILD_RATIO = 0.2
+# Ячеек в плотном блоке матрицы близости (~64 МБ float32)
+BLOCK_CELLS = 16 * 1024 * 1024
+
+# Окончания (в транслите), от длинных к коротким
+ENDINGS = sorted([
+    'iyami', 'yami', 'ami', 'ogo', 'ego', 'omu', 'emu', 'ykh', 'ikh', 'ymi', 'imi',
+    'aya', 'yaya', 'oye', 'yye', 'iye', 'akh', 'yakh',
+    'oy', 'ey', 'iy', 'yy', 'om', 'em', 'ov', 'ev', 'ya', 'yu',
+    'a', 'y', 'i', 'e', 'o', 'u',
+], key=len, reverse=True)
+MIN_STEM = 3
+STOP_WORDS = {
+    'и', 'в', 'во', 'на', 'с', 'со', 'для', 'из', 'по', 'к', 'не', 'от', 'до', 'а', 'но',
+    'или', 'это', 'как', 'же', 'при', 'без', 'под', 'над', 'об', 'у', 'and', 'the', 'of', 'for', 'with',
+}
+_WORD = re.compile(r'[0-9a-zа-я]+')
+
+# Открытый воркером индекс: (путь, mtime_ns, массив)
+_loaded = None
+
+
+def transliterate(word):
+    """Кириллица -> латиница по TRANSLIT_MAP, остальные символы без изменений"""
+    return ''.join(TRANSLIT_MAP.get(char, char) for char in word)
+
+
+def stem(word):
+    """Отрезать типичное окончание, если остаётся хотя бы MIN_STEM букв"""
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    """Слова текста в единой латинской форме: "Футболки" -> "futbolk", "futbolka" -> "futbolk" """
+    words = _WORD.findall(text.lower().replace('ё', 'е'))
+    return [stem(transliterate(word)) for word in words if len(word) > 1 and word not in STOP_WORDS]
+
+
+def _document_terms(product):
+    terms = {}
+    for field, weight in FIELD_WEIGHTS.items():
+        for token in tokenize(product[field] or ''):
+            terms[token] = terms.get(token, 0) + weight
+    if product['category_id']:
+        terms[f"category:{product['category_id']}"] = CATEGORY_WEIGHT
+    if product['gender_id']:
+        terms[f"gender:{product['gender_id']}"] = GENDER_WEIGHT
+    return terms
+
+
+def tfidf_matrix(products):
+    """
+    Нормированная TF-IDF матрица товары x термы
+
+    Args:
+        products: словари с name, description, material, category_id, gender_id
+
+    Returns:
+        csr_matrix: строки единичной длины (скалярное произведение = косинус)
+    """
+    vocabulary = {}
+    rows, columns, values = [], [], []
+    for row, product in enumerate(products):
+        for term, weight in _document_terms(product).items():
+            rows.append(row)
+            columns.append(vocabulary.setdefault(term, len(vocabulary)))
+            values.append(1 + math.log(weight))
+
+    count = len(products)
+    columns = np.array(columns, dtype=np.int64)
+    matrix = sparse.csr_matrix(
+        (np.array(values, dtype=np.float32), (np.array(rows, dtype=np.int64), columns)),
+        shape=(count, len(vocabulary)),
+    )
+    document_frequency = np.bincount(columns, minlength=len(vocabulary))
+    idf = (np.log((1 + count) / (1 + document_frequency)) + 1).astype(np.float32)
+    matrix = matrix @ sparse.diags(idf)
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return (sparse.diags((1 / norms).astype(np.float32)) @ matrix).tocsr()
+
+
+def _index_dtype(k):
+    return np.dtype([('id', '<i4'), ('neighbours', '<i4', (k,)), ('scores', '<f2', (k,))])
+
+
+def _blocks(matrix, rows, columns):
+    """Плотные блоки близости строк rows к строкам columns: (номера строк, блок)"""
+    step = max(1, BLOCK_CELLS // max(1, len(columns)))
+    right = matrix[columns].T.tocsc()
+    for start in range(0, len(rows), step):
+        block_rows = rows[start:start + step]
+        yield block_rows, (matrix[block_rows] @ right).toarray()
+
+
+def _top_k(scores, candidates, k):
+    """
+    k лучших кандидатов в каждой строке
+
+    Args:
+        scores: m x c оценки
+        candidates: id кандидатов (c или m x c)
+
+    Returns:
+        tuple: (id m x k, оценки m x k); кандидаты с оценкой <= 0 заменены на -1
+    """
+    m, c = scores.shape
+    ids = np.full((m, k), -1, dtype=np.int32)
+    top_scores = np.zeros((m, k), dtype=np.float32)
+    take = min(k, c)
+    if not take:
+        return ids, top_scores
+
+    if c > take:
+        positions = np.argpartition(-scores, take - 1, axis=1)[:, :take]
+    else:
+        positions = np.broadcast_to(np.arange(c), (m, c))
+    chosen = np.take_along_axis(scores, positions, axis=1)
+    order = np.argsort(-chosen, axis=1, kind='stable')
+    positions = np.take_along_axis(positions, order, axis=1)
+    chosen = np.take_along_axis(chosen, order, axis=1)
+
+    chosen_ids = np.take_along_axis(np.broadcast_to(candidates, (m, c)), positions, axis=1)
+    found = chosen > 0
+    ids[:, :take] = np.where(found, chosen_ids, -1)
+    top_scores[:, :take] = np.where(found, chosen, 0)
+    return ids, top_scores
+
+
+def _fill_rows(index, matrix, ids, rows, k):
+    """Строки rows заново по всем товарам (сам товар исключается)"""
+    everything = np.arange(len(ids))
+    for block_rows, scores in _blocks(matrix, rows, everything):
+        scores[np.arange(len(block_rows)), block_rows] = -1
+        index['neighbours'][block_rows], index['scores'][block_rows] = _top_k(scores, ids, k)
+
+
+def _merge_changed(index, matrix, ids, changed, previous, k):
+    """
+    Строки неизменённых товаров: старые соседи плюс изменённые товары
+
+    Соседи, которые изменились или пропали из каталога, вычёркиваются
+    из старого списка; изменённые товары сравниваются заново.
+    """
+    unchanged = np.setdiff1d(np.arange(len(ids)), changed)
+    old = previous[np.searchsorted(previous['id'], ids[unchanged])]
+    stale = np.union1d(ids[changed], np.setdiff1d(previous['id'], ids))
+
+    old_neighbours = old['neighbours']
+    old_scores = old['scores'].astype(np.float32)
+    old_scores[np.isin(old_neighbours, stale) | (old_neighbours < 0)] = 0
+
+    offset = 0
+    for block_rows, scores in _blocks(matrix, unchanged, changed):
+        block = slice(offset, offset + len(block_rows))
+        offset += len(block_rows)
+        candidates = np.hstack([old_neighbours[block], np.broadcast_to(ids[changed], scores.shape)])
+        index['neighbours'][block_rows], index['scores'][block_rows] = _top_k(
+            np.hstack([old_scores[block], scores]), candidates, k
+        )
+
+
+def build_similarity_index(k=DEFAULT_TOP_K, full=False):
+    """
+    Построить или обновить индекс похожих товаров
+
+    Args:
+        k: сколько соседей хранить
+        full: пересчитать все строки, даже если есть прошлый индекс
+
+    Returns:
+        dict: {'mode': 'full' | 'incremental', 'products', 'changed'}
+    """
+    path = settings.SIMILARITY_INDEX_PATH
+    # Момент начала: товары, изменённые во время построения, попадут в следующий проход
+    started = timezone.now()
+    products = list(
+        Product.objects.filter(is_active=True).order_by('id')
+        .values('id', 'name', 'description', 'material', 'category_id', 'gender_id', 'updated_at')
+    )
+    ids = np.array([product['id'] for product in products], dtype=np.int32)
+    matrix = tfidf_matrix(products)
+
+    changed = None
+    previous, meta = _read_index(path)
+    if not full and previous is not None and meta.get('k') == k:
+        built_at = datetime.fromisoformat(meta['built_at'])
+        known = set(previous['id'].tolist())
+        changed = np.array([
+            position for position, product in enumerate(products)
+            if product['id'] not in known or product['updated_at'] > built_at
+        ], dtype=np.int64)
+        if len(changed) > FULL_REBUILD_RATIO * len(products):
+            changed = None
+
+    index = np.zeros(len(ids), dtype=_index_dtype(k))
+    index['id'] = ids
+    if changed is None:
+        _fill_rows(index, matrix, ids, np.arange(len(ids)), k)
+        stats = {'mode': 'full', 'products': len(ids), 'changed': len(ids)}
+    else:
+        _fill_rows(index, matrix, ids, changed, k)
+        _merge_changed(index, matrix, ids, changed, previous, k)
+        stats = {'mode': 'incremental', 'products': len(ids), 'changed': len(changed)}
+
+    _write_index(path, index, {'built_at': started.isoformat(), 'k': k, 'products': len(ids)})
+    logger.info(f"Similarity index built: {stats}")
+    return stats
+
+
+def _meta_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def _read_index(path):
+    """Прошлый индекс целиком в памяти и его метаданные (или None, {})"""
+    try:
+        with open(_meta_path(path), encoding='utf-8') as f:
+            meta = json.load(f)
+        return np.load(path), meta
+    except (OSError, ValueError):
+        return None, {}
+
+
+def _atomic_write(path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            write(tmp)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _write_index(path, index, meta):
+    """Атомарная замена: открытые воркерами старые отображения остаются валидными"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    _atomic_write(path, lambda f: np.save(f, index))
+    # Метаданные пишутся вторыми: при сбое следующий проход просто пересчитает больше строк
+    _atomic_write(_meta_path(path), lambda f: f.write(json.dumps(meta).encode('utf-8')))
+
+
+def load_index():
+    """
+    Индекс, отображённый в память этого воркера
+
+    Returns:
+        Структурированный массив (id, neighbours, scores) или None, если индекса нет
+    """
+    global _loaded
+    path = str(settings.SIMILARITY_INDEX_PATH)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if _loaded is None or _loaded[:2] != (path, mtime):
+        _loaded = (path, mtime, np.load(path, mmap_mode='r'))
+    return _loaded[2]
+
+
+def index_modified():
+    """Время построения индекса (для Last-Modified страниц), None -- индекса нет"""
+    try:
+        mtime = os.stat(settings.SIMILARITY_INDEX_PATH).st_mtime
+    except FileNotFoundError:
+        return None
+    return datetime.fromtimestamp(mtime, tz=dt_timezone.utc)
+
+
+def similar_product_ids(product_id, limit=None):
+    """id похожих товаров по убыванию близости"""
+    index = load_index()
+    if index is None or not len(index):
+        return []
+    position = int(np.searchsorted(index['id'], product_id))
+    if position == len(index) or index['id'][position] != product_id:
+        return []
+    neighbours = index['neighbours'][position]
+    return [int(neighbour) for neighbour in neighbours[neighbours >= 0][:limit]]
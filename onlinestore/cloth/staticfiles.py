@@ -0,0 +1,267 @@
+"""
+Статические файлы: отпечатки, минификация, предварительное сжатие
+
+CompressedManifestStaticFilesStorage подключается через STORAGES['staticfiles']
+и работает при collectstatic:
+  1. CSS/JS минифицируются при копировании в STATIC_ROOT;
+  2. ManifestStaticFilesStorage добавляет в имя хэш содержимого
+     (style.css -> style.3f1a2b4c5d6e.css) и переписывает url() в CSS;
+  3. для текстовых файлов рядом пишутся .gz и .br (если установлен brotli).
+
+serve() отдаёт файлы из STATIC_ROOT с выбором сжатой версии по Accept-Encoding
+и бессрочным кэшированием для имён с отпечатком.
+"""
+import gzip
+import logging
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage, staticfiles_storage
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.base import ContentFile
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import rcssmin
+except ImportError:
+    rcssmin = None
+
+try:
+    import rjsmin
+except ImportError:
+    rjsmin = None
+
+logger = logging.getLogger(__name__)
+
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json', '.txt', '.xml', '.html', '.map')
+# Сжатая версия сохраняется, только если она заметно меньше оригинала
+MIN_COMPRESSION_RATIO = 0.95
+# Порядок предпочтения кодировок: (кодировка, расширение файла)
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
+_CSS_STRINGS = r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\''
+_CSS_COMMENTS = re.compile(r'(%s)|/\*.*?\*/' % _CSS_STRINGS, re.S)
+_CSS_TOKENS = re.compile(_CSS_STRINGS)
+_CSS_SPACES = re.compile(r'\s+')
+_CSS_PUNCTUATION = re.compile(r'\s*([{};,>])\s*')
+_CSS_COLON = re.compile(r':\s+')
+
+
+def minify_css(text):
+    """
+    Минификация CSS
+
+    Использует rcssmin, если он установлен. Встроенный вариант консервативен:
+    удаляет комментарии и лишние пробелы, не трогая строки, пробелы перед
+    двоеточием (a :hover) и вокруг + и ~ (они значимы внутри calc()).
+    """
+    if rcssmin is not None:
+        return rcssmin.cssmin(text)
+
+    text = _CSS_COMMENTS.sub(lambda match: match.group(1) or '', text)
+    parts = []
+    position = 0
+    for match in _CSS_TOKENS.finditer(text):
+        parts.append(_minify_css_code(text[position:match.start()]))
+        parts.append(match.group(0))
+        position = match.end()
+    parts.append(_minify_css_code(text[position:]))
+    return ''.join(parts).strip()
+
+
+def _minify_css_code(code):
+    code = _CSS_SPACES.sub(' ', code)
+    code = _CSS_PUNCTUATION.sub(r'\1', code)
+    code = _CSS_COLON.sub(':', code)
+    return code.replace(';}', '}')
+
+
+def minify_js(text):
+    """
+    Минификация JS (только с установленным rjsmin)
+
+    Надёжно минифицировать JS регулярными выражениями нельзя
+    (шаблонные строки, литералы регулярных выражений), поэтому без rjsmin
+    файл остаётся как есть и только сжимается.
+    """
+    if rjsmin is not None:
+        return rjsmin.jsmin(text)
+    return text
+
+
+MINIFIERS = {
+    '.css': minify_css,
+    '.js': minify_js,
+}
+
+
+def compress_file(path):
+    """
+    Записать .gz и .br рядом с файлом
+
+    Returns:
+        dict: {'gzip': размер или None, 'br': размер или None}
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    sizes = {'gzip': None, 'br': None}
+    variants = [('gzip', '.gz', lambda raw: gzip.compress(raw, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('br', '.br', lambda raw: brotli.compress(raw, quality=11)))
+
+    for encoding, extension, compress in variants:
+        compressed = compress(data)
+        if len(compressed) < len(data) * MIN_COMPRESSION_RATIO:
+            with open(path + extension, 'wb') as f:
+                f.write(compressed)
+            sizes[encoding] = len(compressed)
+        elif os.path.exists(path + extension):
+            os.remove(path + extension)
+    return sizes
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    ManifestStaticFilesStorage с минификацией и предварительным сжатием
+
+    Пока collectstatic не запускался (разработка, тесты), {% static %}
+    отдаёт имена без отпечатка вместо ошибки. Ссылка на отсутствующий
+    файл тоже не роняет страницу, а логируется.
+    """
+
+    manifest_strict = False
+
+    def _save(self, name, content):
+        minify = MINIFIERS.get(os.path.splitext(name)[1])
+        if minify is not None:
+            text = b''.join(content.chunks()).decode('utf-8')
+            content = ContentFile(minify(text).encode('utf-8'))
+        return super()._save(name, content)
+
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        # Манифест уже содержит итоговые имена (промежуточные файлы удалены)
+        for hashed_name in sorted(set(self.hashed_files.values())):
+            if hashed_name.endswith(COMPRESSIBLE_EXTENSIONS):
+                compress_file(self.path(hashed_name))
+
+    def stored_name(self, name):
+        if not self.hashed_files:
+            return name
+        try:
+            return super().stored_name(name)
+        except ValueError as e:
+            logger.warning(f"Static file without manifest entry: {name} ({e})")
+            return name
+
+
+def accepted_encodings(accept_encoding):
+    """
+    Кодировки, которые принимает клиент, по заголовку Accept-Encoding
+
+    Кодировки с q=0 ("gzip;q=0") клиент явно отклоняет -- их в результате нет.
+    """
+    accepted = set()
+    for part in accept_encoding.split(','):
+        encoding, *params = part.split(';')
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        encoding = encoding.strip().lower()
+        if encoding and quality > 0:
+            accepted.add(encoding)
+    return accepted
+
+
+# (mtime манифеста, имена с отпечатком)
+_fingerprinted = (None, frozenset())
+
+
+def _is_fingerprinted(path):
+    """
+    Имя с отпечатком (есть среди значений манифеста)
+
+    Манифест перечитывается, когда меняется его mtime: после collectstatic
+    на работающем сервере новые имена сразу кэшируются навсегда.
+    """
+    global _fingerprinted
+    try:
+        mtime = os.stat(staticfiles_storage.path(staticfiles_storage.manifest_name)).st_mtime_ns
+    except (AttributeError, NotImplementedError, OSError):
+        return False
+    if _fingerprinted[0] != mtime:
+        try:
+            paths, _ = staticfiles_storage.load_manifest()
+        except ValueError as e:
+            # Манифест как раз перезаписывается -- прочитаем при следующем запросе
+            logger.warning(f"Static files manifest is unreadable: {e}")
+            return False
+        _fingerprinted = (mtime, frozenset(paths.values()))
+    return path in _fingerprinted[1]
+
+
+def serve(request, path):
+    """
+    Отдача файла из STATIC_ROOT
+
+    Используется, когда статику раздаёт само приложение (SERVE_STATIC),
+    а не nginx. Выбирает .br или .gz по Accept-Encoding; файлы с отпечатком
+    кэшируются навсегда (immutable), остальные -- на STATIC_MAX_AGE.
+    """
+    try:
+        full_path = safe_join(settings.STATIC_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('Файл не найден')
+    if not os.path.isfile(full_path):
+        raise Http404('Файл не найден')
+
+    stat = os.stat(full_path)
+    if not was_modified_since(request.META.get('HTTP_IF_MODIFIED_SINCE'), stat.st_mtime):
+        return HttpResponseNotModified()
+
+    content_type, _ = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type in ('application/javascript', 'image/svg+xml'):
+        content_type += '; charset=utf-8'
+
+    accepted = accepted_encodings(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    serve_path, content_encoding = full_path, None
+    if path.endswith(COMPRESSIBLE_EXTENSIONS):
+        for encoding, extension in ENCODINGS:
+            if encoding in accepted and os.path.isfile(full_path + extension):
+                serve_path, content_encoding = full_path + extension, encoding
+                break
+
+    response = FileResponse(open(serve_path, 'rb'), content_type=content_type)
+    response['Content-Length'] = os.path.getsize(serve_path)
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    if content_encoding:
+        response['Content-Encoding'] = content_encoding
+    if path.endswith(COMPRESSIBLE_EXTENSIONS):
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+    if _is_fingerprinted(path):
+        response['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        response['Cache-Control'] = f'public, max-age={settings.STATIC_MAX_AGE}'
+    return response
@@ -0,0 +1,222 @@
+"""
+Подсказки поиска (typeahead)
+
+Индекс -- отсортированный массив ключей в памяти процесса. Ключ -- хвост
+названия товара, категории или материала, начиная с каждого слова
+("льняная рубашка" даёт "льняная рубашка" и "рубашка"), поэтому подсказка
+находится по началу любого слова. Префиксу соответствует непрерывный
+диапазон массива (bisect); подсказки -- записи диапазона с наибольшей
+популярностью.
+
+Для коротких префиксов диапазон огромен ("к" -- десятки процентов
+ключей), поэтому для всех префиксов, диапазон которых длиннее
+HEAVY_RANGE, top-N считается заранее при построении. Остальные диапазоны
+короткие и разбираются при запросе за микросекунды.
+
+Индекс перестраивается, когда меняется версия каталога (cloth.cache):
+при сохранении товаров, категорий и после пересчёта рейтинга.
+
+Раскладка: запрос, набранный не в той раскладке ("aenb,jkrf"), ищется
+ещё и в переведённом виде ("футболка"), и наоборот.
+"""
+from bisect import bisect_left
+import logging
+import re
+import threading
+import time
+
+import numpy as np
+
+from django.db.models import Count, Sum
+from django.urls import reverse
+from django.utils.http import urlencode
+
+from .cache import get_catalog_version
+from .models import Category, Product
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMIT = 8
+MAX_LIMIT = 20
+# Диапазоны длиннее этого получают готовый top-N при построении
+HEAVY_RANGE = 256
+# Сколько кандидатов хранить для тяжёлых префиксов (с запасом на повторы записей)
+HEAVY_TOP = 3 * MAX_LIMIT
+MAX_KEY_LENGTH = 64
+
+_LATIN = "qwertyuiop[]asdfghjkl;'zxcvbnm,.`"
+_CYRILLIC = 'йцукенгшщзхъфывапролджэячсмитьбюё'
+TO_CYRILLIC = str.maketrans(_LATIN, _CYRILLIC)
+TO_LATIN = str.maketrans(_CYRILLIC, _LATIN)
+_NON_WORD = re.compile(r'[^\w]+')
+
+
+def normalize(text):
+    """Нижний регистр, ё -> е, всё, кроме букв и цифр, -- один пробел"""
+    return _NON_WORD.sub(' ', text.lower().replace('ё', 'е')).strip()
+
+
+def query_variants(query):
+    """Запрос как есть и в другой раскладке (без повторов и пустых)"""
+    query = query.lower()
+    variants = []
+    for variant in (query, query.translate(TO_CYRILLIC), query.translate(TO_LATIN)):
+        variant = normalize(variant)
+        if variant and variant not in variants:
+            variants.append(variant)
+    return variants
+
+
+class SuggestIndex:
+    """
+    Отсортированный массив ключей с популярностью
+
+    Args:
+        entries: [(текст, тип, url, популярность)]
+    """
+
+    def __init__(self, entries):
+        self.entries = entries
+        keys, owners = [], []
+        for entry_id, (text, _, _, _) in enumerate(entries):
+            # Хвосты текста с начала каждого слова
+            text = normalize(text)[:MAX_KEY_LENGTH]
+            position = 0
+            while text:
+                keys.append(text[position:])
+                owners.append(entry_id)
+                position = text.find(' ', position) + 1
+                if not position:
+                    break
+
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self.keys = [keys[position] for position in order]
+        self.entry_ids = np.array(owners, dtype=np.int32)[np.array(order, dtype=np.int64)]
+        self.popularity = np.array([entry[3] for entry in entries], dtype=np.float64)[self.entry_ids]
+        self.heavy = self._heavy_prefixes()
+
+    def _heavy_prefixes(self):
+        """
+        {префикс: id записей по убыванию популярности} для длинных диапазонов
+
+        Обход неявного дерева префиксов сверху вниз: дети узла находятся
+        бинарным поиском, а в глубину идут только диапазоны длиннее HEAVY_RANGE.
+        """
+        heavy = {}
+        stack = [('', 0, len(self.keys))]
+        while stack:
+            prefix, start, end = stack.pop()
+            if end - start <= HEAVY_RANGE:
+                continue
+            if prefix:
+                heavy[prefix] = self._top(start, end, HEAVY_TOP)
+            depth = len(prefix)
+            position = start
+            while position < end:
+                key = self.keys[position]
+                if len(key) <= depth:
+                    position += 1
+                    continue
+                child = key[:depth + 1]
+                child_end = bisect_left(self.keys, child + '\uffff', position, end)
+                stack.append((child, position, child_end))
+                position = child_end
+        return heavy
+
+    def _top(self, start, end, limit):
+        """id записей диапазона [start, end) по убыванию популярности, без повторов"""
+        popularity = self.popularity[start:end]
+        if len(popularity) > limit:
+            # С запасом: одна запись может встретиться в диапазоне несколько раз
+            candidates = np.argpartition(-popularity, limit - 1)[:limit]
+        else:
+            candidates = np.arange(len(popularity))
+        candidates = candidates[np.argsort(-popularity[candidates], kind='stable')]
+        result = []
+        for entry_id in self.entry_ids[start + candidates].tolist():
+            if entry_id not in result:
+                result.append(entry_id)
+        return result
+
+    def lookup(self, prefix, limit=DEFAULT_LIMIT):
+        """id записей, начинающихся с prefix (с начала любого слова)"""
+        if not prefix:
+            return []
+        if prefix in self.heavy:
+            return self.heavy[prefix][:limit]
+        start = bisect_left(self.keys, prefix)
+        end = bisect_left(self.keys, prefix + '\uffff', start)
+        return self._top(start, end, limit * 3)[:limit]
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        """
+        Подсказки для запроса во всех раскладках
+
+        Returns:
+            list: [{'text', 'type', 'url'}] по убыванию популярности
+        """
+        found = []
+        for variant in query_variants(query):
+            for entry_id in self.lookup(variant, limit):
+                if entry_id not in found:
+                    found.append(entry_id)
+        found.sort(key=lambda entry_id: -self.entries[entry_id][3])
+        return [
+            {'text': text, 'type': kind, 'url': url}
+            for text, kind, url, _ in (self.entries[entry_id] for entry_id in found[:limit])
+        ]
+
+
+def catalog_entries():
+    """
+    Записи индекса из базы: товары, категории и материалы
+
+    Популярность товара -- popularity_score (cloth.ranking) плюс доля
+    просмотров, чтобы до первого пересчёта рейтинга порядок был осмысленным;
+    категории и материала -- сумма по их товарам плюс число товаров.
+    """
+    catalog_url = reverse('catalog')
+    entries = []
+    products = Product.objects.filter(is_active=True).values_list('name', 'slug', 'popularity_score', 'view_count')
+    for name, slug, score, views in products:
+        entries.append((name, 'product', reverse('product_detail', args=[slug]), score + views / 1000))
+
+    categories = (
+        Category.objects.filter(is_active=True, products__is_active=True)
+        .annotate(score=Sum('products__popularity_score'), count=Count('products'))
+        .values_list('name', 'slug', 'score', 'count')
+    )
+    for name, slug, score, count in categories:
+        entries.append((name, 'category', f"{catalog_url}?{urlencode({'category': slug})}", (score or 0) + count))
+
+    materials = (
+        Product.objects.filter(is_active=True).exclude(material='')
+        .values('material').annotate(score=Sum('popularity_score'), count=Count('id'))
+        .values_list('material', 'score', 'count').order_by()
+    )
+    for material, score, count in materials:
+        entries.append((material, 'material', f"{catalog_url}?{urlencode({'q': material})}", (score or 0) + count))
+    return entries
+
+
+_index = None
+_index_version = None
+_build_lock = threading.Lock()
+
+
+def get_index():
+    """Индекс этого процесса; перестраивается при смене версии каталога"""
+    global _index, _index_version
+    version = get_catalog_version()
+    if _index is not None and version == _index_version:
+        return _index
+    with _build_lock:
+        if _index is None or version != _index_version:
+            start = time.perf_counter()
+            _index = SuggestIndex(catalog_entries())
+            _index_version = version
+            logger.info(
+                f"Suggest index built: {len(_index.keys)} keys, {len(_index.heavy)} heavy prefixes "
+                f"in {(time.perf_counter() - start) * 1000:.0f} ms"
+            )
+    return _index
@@ -1,4 +1,11 @@
+from urllib.parse import quote
+
 from django import template
+from django.urls import reverse
+from django.utils.html import json_script
+from django.utils.safestring import mark_safe
+
+from ..cache import render_product_cards
 
 register = template.Library()
 
@@ -35,4 +42,27 @@ def query_transform(request, **kwargs):
             updated[key] = value
         else:
             updated.pop(key, 0)
-    return updated.urlencode()
\ No newline at end of file
+    return updated.urlencode()
+
+
+@register.simple_tag
+def product_cards(products):
+    """
+    Карточки товаров из кэша фрагментов
+    Использование: {% product_cards products %}
+    """
+    return mark_safe(''.join(render_product_cards(products)))
+
+
+@register.simple_tag(takes_context=True)
+def wishlist_state(context, wishlist_ids=()):
+    """
+    Состояние избранного для карточек (применяется в main.js)
+    Использование: {% wishlist_state wishlist_ids %}
+    """
+    request = context['request']
+    return json_script({
+        'authenticated': request.user.is_authenticated,
+        'ids': list(wishlist_ids),
+        'login_url': f"{reverse('login')}?next={quote(request.path)}",
+    }, 'wishlist-state')
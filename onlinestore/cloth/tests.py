@@ -1,3 +1,1995 @@
-from django.test import TestCase
+import base64
+import gzip
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock, skipUnless
+from xml.etree import ElementTree
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.http import Http404, HttpResponse, QueryDict, StreamingHttpResponse
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connection, router, transaction
+from django.db.models import F
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import urls as cloth_urls
+from . import metrics, search_log, view_counter, views
+from .cache import get_card_versions, get_catalog_version, normalize_query, page_cache_keys
+from .db_router import PIN_COOKIE, primary_pinning, replica_reads
+from .feeds import SITEMAP_NS, build_feeds
+from .middleware import RequestTimingMiddleware, ResponseCompressionMiddleware, minify_html
+from .images import RENDITIONS, ResizeCache, build_renditions, delete_renditions
+from .payments import PaymentService, RefundService
+from .ranking import rank_products
+from .recommendations import build_recommendations
+from .search import NgramIndex, search_variants, to_cyrillic
+from .suggest import SuggestIndex, normalize, query_variants
+from .management.commands.benchmark_suggest import synthetic_entries
+from .management.commands.reset_products import Command as ResetProductsCommand
+from .similarity import build_similarity_index, load_index, similar_product_ids, tokenize
+from .staticfiles import brotli, serve as serve_static
+from .models import (
+    Role, User, EmailVerification, Gender, Category, Size, Color,
+    Product, ProductVariant, ProductImage, Wishlist, Cart, CartItem,
+    OrderStatus, DeliveryMethod, Order, OrderItem,
+    TransactionStatus, Transaction, Review, ProductRecommendation, ProductRanking, ProductViewDaily,
+    SearchQuery, Refund,
+)
+
+logger = logging.getLogger(__name__)
+
+# Базовые значения бюджета запросов: python manage.py test cloth
+# с UPDATE_QUERY_BUDGET=1 перезаписывает файл текущими значениями
+QUERY_BUDGET_FILE = Path(__file__).resolve().parent / 'query_budget.json'
+
+# Допустимое превышение: количество запросов -- max(1, 10%),
+# время -- в 3 раза, но не меньше чем на 50 мс (быстрые страницы шумят)
+QUERY_TOLERANCE = 0.10
+TIME_TOLERANCE = float(os.environ.get('QUERY_BUDGET_TIME_TOLERANCE', '3.0'))
+TIME_TOLERANCE_MIN_MS = 50
+
+# Размер тестового каталога
+BENCH_PRODUCTS = int(os.environ.get('BENCH_PRODUCTS', '2000'))
+BENCH_USERS = int(os.environ.get('BENCH_USERS', '100'))
+BENCH_ORDERS = int(os.environ.get('BENCH_ORDERS', '500'))
+BENCH_RUNS = 3
+
+
+def seed_benchmark_data(products=BENCH_PRODUCTS, users=BENCH_USERS, orders=BENCH_ORDERS):
+    """
+    Реалистичный набор данных для замеров: справочники, товары с вариантами
+    и изображениями, пользователи, заказы, отзывы, избранное и корзина.
+
+    Returns:
+        Словарь с объектами, на которые ссылаются URL (товар, заказ и т.д.)
+    """
+    roles = {name: Role.objects.create(name=name) for name in ('user', 'moderator', 'admin')}
+    order_statuses = {
+        name: OrderStatus.objects.create(name=name)
+        for name in ('created', 'paid', 'shipped', 'delivered', 'cancelled')
+    }
+    tx_statuses = {
+        name: TransactionStatus.objects.create(name=name)
+        for name in ('pending', 'succeeded', 'failed', 'refunded')
+    }
+    DeliveryMethod.objects.create(name='courier', price=300)
+    DeliveryMethod.objects.create(name='pickup', price=0)
+
+    genders = [Gender.objects.create(name=name) for name in ('men', 'women', 'unisex', 'kids')]
+    sizes = [Size.objects.create(name=name, order=i) for i, name in enumerate(['XS', 'S', 'M', 'L', 'XL', 'XXL'])]
+    colors = [
+        Color.objects.create(name=name, hex_code=hex_code)
+        for name, hex_code in [
+            ('Черный', '#000000'), ('Белый', '#FFFFFF'), ('Серый', '#808080'), ('Красный', '#FF0000'),
+            ('Синий', '#0000FF'), ('Зеленый', '#008000'), ('Коричневый', '#8B4513'), ('Бежевый', '#F5F5DC'),
+        ]
+    ]
+    categories = [
+        Category.objects.create(name=f'Категория {i}', slug=f'category-{i}', order=i)
+        for i in range(9)
+    ]
+
+    Product.objects.bulk_create([
+        Product(
+            name=f'Товар {i}',
+            slug=f'product-{i}',
+            description=f'Описание товара {i}. Хлопок, классический крой.',
+            price=Decimal(500 + (i * 37) % 9500),
+            category=categories[i % len(categories)],
+            gender=genders[i % len(genders)],
+            material='Хлопок 100%',
+            is_new=i % 10 == 0,
+            is_bestseller=i % 15 == 0,
+        )
+        for i in range(products)
+    ], batch_size=1000)
+    product_list = list(Product.objects.order_by('id'))
+
+    ProductVariant.objects.bulk_create([
+        ProductVariant(
+            product=product,
+            size=sizes[(i + k) % len(sizes)],
+            color=colors[(i + k) % len(colors)],
+            price=product.price,
+            stock_quantity=(i + k) % 20,
+            sku=f'{product.id}-{k}',
+        )
+        for i, product in enumerate(product_list)
+        for k in range(3)
+    ], batch_size=1000)
+    ProductImage.objects.bulk_create([
+        ProductImage(product=product, image='products/bazafutbolka.png', is_main=True)
+        for product in product_list
+    ], batch_size=1000)
+    variant_list = list(ProductVariant.objects.order_by('id'))
+
+    User.objects.bulk_create([
+        User(email=f'customer{i}@example.com', first_name=f'Имя{i}', role=roles['user'])
+        for i in range(users)
+    ], batch_size=1000)
+    user_list = list(User.objects.order_by('id'))
+
+    customer = user_list[0]
+    customer.set_password('password')
+    customer.save()
+    moderator = User.objects.create_user('moderator@example.com', 'password', role=roles['moderator'])
+    admin = User.objects.create_superuser('admin@example.com', 'password')
+
+    status_cycle = ['created', 'paid', 'shipped', 'delivered', 'cancelled']
+    Order.objects.bulk_create([
+        Order(
+            user=user_list[i % len(user_list)],
+            order_number=f'BENCH{i:06d}',
+            total_amount=Decimal('0'),
+            delivery_address='г. Москва, ул. Тестовая, д. 1',
+            status=order_statuses[status_cycle[i % len(status_cycle)]],
+            payment_method='yookassa',
+        )
+        for i in range(orders)
+    ], batch_size=1000)
+    order_list = list(Order.objects.order_by('id'))
+
+    OrderItem.objects.bulk_create([
+        OrderItem(
+            order=order,
+            variant=variant_list[(i * 7 + k) % len(variant_list)],
+            quantity=1 + k,
+            price_per_unit=variant_list[(i * 7 + k) % len(variant_list)].price,
+        )
+        for i, order in enumerate(order_list)
+        for k in range(2)
+    ], batch_size=1000)
+    Transaction.objects.bulk_create([
+        Transaction(
+            order=order,
+            amount=Decimal('1000'),
+            external_id=f'bench-payment-{order.id}',
+            status=tx_statuses['succeeded'],
+        )
+        for order in order_list
+        if order.status_id == order_statuses['paid'].id
+    ], batch_size=1000)
+
+    # Покупатель оплатил заказ с первым товаром -- может оставить отзыв
+    paid_order = Order.objects.create(
+        user=customer,
+        total_amount=product_list[0].price,
+        delivery_address='г. Москва, ул. Тестовая, д. 1',
+        status=order_statuses['paid'],
+    )
+    paid_order.items.create(variant=variant_list[0], quantity=1, price_per_unit=variant_list[0].price)
+    Transaction.objects.create(
+        order=paid_order,
+        amount=paid_order.total_amount,
+        external_id='bench-payment-customer',
+        status=tx_statuses['succeeded'],
+    )
+
+    Review.objects.bulk_create([
+        Review(
+            product=product_list[i % 50],
+            user=user,
+            rating=1 + i % 5,
+            comment='Хороший товар',
+            is_moderated=i % 4 != 0,
+            moderated_by=moderator if i % 4 != 0 else None,
+            moderated_at=timezone.now() if i % 4 != 0 else None,
+        )
+        for i, user in enumerate(user_list[1:])
+    ], batch_size=1000)
+    pending_review = Review.objects.filter(is_moderated=False).first()
+
+    Wishlist.objects.bulk_create([Wishlist(user=customer, product=product) for product in product_list[:12]])
+
+    cart = Cart.objects.create(user=customer)
+    CartItem.objects.bulk_create([
+        CartItem(cart=cart, variant=variant, quantity=1)
+        for variant in variant_list[3:18:3]
+        if variant.stock_quantity > 1
+    ])
+
+    verification = EmailVerification.objects.create(
+        user=customer,
+        token=uuid.uuid4(),
+        expires_at=timezone.now() + timedelta(hours=24),
+    )
+
+    return {
+        'customer': customer,
+        'moderator': moderator,
+        'admin': admin,
+        'product': product_list[0],
+        'product_without_orders': product_list[-1],
+        'variant': variant_list[3],
+        'cart_item': cart.items.first(),
+        'order': paid_order,
+        'review': pending_review,
+        'verification': verification,
+    }
+
+
+# (id замера, имя URL, роль, метод, данные)
+VIEW_CASES = [
+    ('home', 'home', 'anonymous', 'get', None),
+    ('catalog', 'catalog', 'anonymous', 'get', None),
+    ('catalog:filtered', 'catalog', 'anonymous', 'get',
+     {'category': 'category-1', 'size': ['M', 'L'], 'color': 'Черный', 'sort': 'price', 'page': '2'}),
+    ('catalog:search', 'catalog', 'anonymous', 'get', {'q': 'Товар 1'}),
+    ('catalog:popular', 'catalog', 'anonymous', 'get', {'sort': 'popular', 'page': '2'}),
+    ('search_suggest', 'search_suggest', 'anonymous', 'get', {'q': 'тов'}),
+    ('api_categories', 'api_categories', 'anonymous', 'get', None),
+    ('api_products', 'api_products', 'anonymous', 'get', {'category': 'category-1', 'size': 'M', 'sort': 'price'}),
+    ('api_products:search', 'api_products', 'anonymous', 'get', {'q': 'Товар 1', 'fields': 'id,name,price'}),
+    ('api_product_detail', 'api_product_detail', 'anonymous', 'get', None),
+    ('api_variant_availability', 'api_variant_availability', 'anonymous', 'get',
+     {'ids': ','.join(map(str, range(1, 301)))}),
+    ('sitemap', 'sitemap', 'anonymous', 'get', None),
+    ('feed_file', 'feed_file', 'anonymous', 'get', None),
+    ('catalog:customer', 'catalog', 'customer', 'get', None),
+    ('product_detail', 'product_detail', 'anonymous', 'get', None),
+    ('product_detail:customer', 'product_detail', 'customer', 'get', None),
+    ('add_review', 'add_review', 'customer', 'post', {'rating': '5', 'comment': 'Отлично'}),
+    ('wishlist', 'wishlist', 'customer', 'get', None),
+    ('toggle_wishlist', 'toggle_wishlist', 'customer', 'post', None),
+    ('cart', 'cart', 'customer', 'get', None),
+    ('add_to_cart', 'add_to_cart', 'customer', 'post', None),
+    ('update_cart_item', 'update_cart_item', 'customer', 'post', {'quantity': '2'}),
+    ('remove_from_cart', 'remove_from_cart', 'customer', 'post', None),
+    ('clear_cart', 'clear_cart', 'customer', 'post', None),
+    ('checkout', 'checkout', 'customer', 'get', None),
+    ('checkout:cash', 'checkout', 'customer', 'post',
+     {'delivery_address': 'г. Москва, ул. Тестовая, д. 1', 'payment_method': 'cash'}),
+    ('order_history', 'order_history', 'customer', 'get', None),
+    ('order_detail', 'order_detail', 'customer', 'get', None),
+    ('payment', 'payment', 'customer', 'get', None),
+    ('payment_result', 'payment_result', 'customer', 'get', None),
+    ('yookassa_webhook', 'yookassa_webhook', 'anonymous', 'post', json.dumps({
+        'type': 'notification',
+        'event': 'payment.canceled',
+        'object': {
+            'id': 'bench-payment-customer',
+            'status': 'canceled',
+            'paid': False,
+            'amount': {'value': '500.00', 'currency': 'RUB'},
+            'created_at': '2026-01-01T00:00:00.000Z',
+            'test': True,
+        },
+    })),
+    ('register', 'register', 'anonymous', 'get', None),
+    ('login', 'login', 'anonymous', 'get', None),
+    ('logout', 'logout', 'customer', 'get', None),
+    ('profile', 'profile', 'customer', 'get', None),
+    ('profile_edit', 'profile_edit', 'customer', 'get', None),
+    ('change_password', 'change_password', 'customer', 'get', None),
+    ('moderate_reviews', 'moderate_reviews', 'moderator', 'get', None),
+    ('approve_review', 'approve_review', 'moderator', 'post', None),
+    ('reject_review', 'reject_review', 'moderator', 'post', None),
+    ('manage_products', 'manage_products', 'moderator', 'get', None),
+    ('add_product', 'add_product', 'moderator', 'get', None),
+    ('edit_product', 'edit_product', 'moderator', 'get', None),
+    ('delete_product', 'delete_product', 'moderator', 'post', None),
+    ('manage_orders', 'manage_orders', 'moderator', 'get', None),
+    ('update_order_status', 'update_order_status', 'moderator', 'post', {'status': 'shipped'}),
+    ('refund_order', 'refund_order', 'admin', 'get', None),
+    ('admin_dashboard', 'admin_dashboard', 'admin', 'get', None),
+    ('export_orders', 'export_orders', 'admin', 'get', None),
+    ('export_orders_utf8', 'export_orders_utf8', 'admin', 'get', None),
+    ('export_orders_excel', 'export_orders_excel', 'admin', 'get', None),
+    ('export_orders_csv_windows', 'export_orders_csv_windows', 'admin', 'get', None),
+    ('verify_email', 'verify_email', 'anonymous', 'get', None),
+    ('resend_verification', 'resend_verification', 'anonymous', 'get', None),
+    ('forgot_password', 'forgot_password', 'anonymous', 'get', None),
+    ('reset_password', 'reset_password', 'anonymous', 'get', None),
+    ('metrics', 'metrics', 'anonymous', 'get', None),
+    ('resized_image', 'resized_image', 'anonymous', 'get', None),
+]
+
+
+class FakeRefundClient:
+    """Ответы ЮKassa на создание возвратов: status для всех, id по порядку"""
+
+    def __init__(self, status='succeeded'):
+        self.status = status
+        self.calls = []
+
+    def refund_payment(self, payment_id, amount, idempotence_key=None, receipt_items=None):
+        self.calls.append((payment_id, amount, idempotence_key, receipt_items))
+        if self.status is None:
+            return None
+        return SimpleNamespace(id=f'refund-{len(self.calls)}', status=self.status)
+
+
+class RefundTests(TestCase):
+    """Частичные возвраты по позициям (cloth.payments.RefundService)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser('admin@example.com', 'password')
+        category = Category.objects.create(name='Футболки', slug='t-shirts')
+        product = Product.objects.create(name='Футболка', slug='t-shirt', description='', price=Decimal('1000'),
+                                         category=category)
+        cls.shirt = ProductVariant.objects.create(product=product, price=Decimal('1000'), stock_quantity=5)
+        cls.socks = ProductVariant.objects.create(product=product, sku='socks', price=Decimal('200'),
+                                                  stock_quantity=5)
+        TransactionStatus.objects.create(name='succeeded')
+        # Сумма платежа включает доставку 300 ₽
+        order = Order.objects.create(user=cls.user, total_amount=Decimal('2700'), delivery_address='г. Москва',
+                                     status=OrderStatus.objects.create(name='paid'))
+        cls.shirt_item = order.items.create(variant=cls.shirt, quantity=2, price_per_unit=Decimal('1000'))
+        cls.socks_item = order.items.create(variant=cls.socks, quantity=2, price_per_unit=Decimal('200'))
+        cls.transaction = Transaction.objects.create(
+            order=order, amount=Decimal('2700'), external_id='payment-1',
+            status=TransactionStatus.objects.get(name='succeeded'),
+        )
+
+    def stock(self, variant):
+        variant.refresh_from_db()
+        return variant.stock_quantity
+
+    def test_partial_quantities_and_over_refund(self):
+        service = RefundService(FakeRefundClient())
+        refund = service.create_refund(self.transaction, {self.shirt_item.id: 1, self.socks_item.id: 2})
+        self.assertEqual(refund.amount, Decimal('1400'))
+        self.assertEqual(sorted(refund.items.values_list('quantity', flat=True)), [1, 2])
+
+        with self.assertRaisesMessage(ValueError, 'не более 1 шт.'):
+            service.create_refund(self.transaction, {self.shirt_item.id: 2})
+        with self.assertRaises(ValueError):
+            service.create_refund(self.transaction, {self.socks_item.id: 1})
+
+        # Отменённый возврат количество не занимает
+        Refund.objects.filter(pk=refund.pk).update(status='canceled')
+        self.assertEqual(service.create_refund(self.transaction).amount, Decimal('2400'))
+
+    def test_stock_returned_once_and_transaction_refunded_without_delivery(self):
+        client = FakeRefundClient()
+        service = RefundService(client)
+        refund = service.submit_refund(service.create_refund(self.transaction, {self.shirt_item.id: 1}))
+        self.assertEqual((refund.status, refund.external_id), ('succeeded', 'refund-1'))
+        self.assertEqual(client.calls[0][:3], ('payment-1', Decimal('1000'), refund.idempotence_key))
+        self.assertEqual(self.stock(self.shirt), 6)
+
+        # Повторное уведомление о том же возврате склад не пополняет
+        service.handle_refund_succeeded('refund-1')
+        self.assertEqual(self.stock(self.shirt), 6)
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status.name, 'succeeded')
+
+        # Все позиции возвращены -- транзакция возвращена, хотя доставка 300 ₽ осталась
+        service.submit_refund(service.create_refund(self.transaction))
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status.name, 'refunded')
+        self.assertEqual((self.stock(self.shirt), self.stock(self.socks)), (7, 7))
+
+    def test_webhook_before_api_response(self):
+        service = RefundService(FakeRefundClient(status=None))
+        refund = service.submit_refund(service.create_refund(self.transaction, {self.socks_item.id: 1}))
+        self.assertEqual((refund.status, refund.external_id), ('pending', None))
+
+        body = {
+            'type': 'notification', 'event': 'refund.succeeded',
+            'object': {'id': 'refund-early', 'payment_id': 'payment-1', 'status': 'succeeded',
+                       'amount': {'value': '200.00', 'currency': 'RUB'}, 'created_at': '2026-01-01T00:00:00.000Z'},
+        }
+        payments = PaymentService()
+        self.assertFalse(payments.process_webhook({**body, 'object': {**body['object'], 'payment_id': 'other'}}))
+        self.assertTrue(payments.process_webhook(json.dumps(body)))
+
+        refund.refresh_from_db()
+        self.assertEqual((refund.status, refund.external_id, refund.stock_returned),
+                         ('succeeded', 'refund-early', True))
+        self.assertEqual(self.stock(self.socks), 6)
+
+    def test_admin_batch_action(self):
+        self.client.force_login(self.user)
+        with mock.patch('cloth.payments.YooKassaClient.refund_payment', FakeRefundClient().refund_payment):
+            response = self.client.post(reverse('admin:cloth_transaction_changelist'), {
+                'action': 'refund_transactions', '_selected_action': [self.transaction.pk],
+            }, follow=True)
+        self.assertContains(response, 'Возвратов создано: 1, успешно: 1')
+        self.transaction.refresh_from_db()
+        self.assertEqual(self.transaction.status.name, 'refunded')
+
+        # Повторный запуск по возвращённой транзакции -- предупреждение, а не второй возврат
+        response = self.client.post(reverse('admin:cloth_transaction_changelist'), {
+            'action': 'refund_transactions', '_selected_action': [self.transaction.pk],
+        }, follow=True)
+        self.assertContains(response, 'Возвратов создано: 0')
+        self.assertEqual(Refund.objects.count(), 1)
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class RequestTimingTests(TestCase):
+    """Инструментирование запросов (cloth.middleware.RequestTimingMiddleware)"""
+
+    SERVER_TIMING = re.compile(r'^db;dur=\d+\.\d;desc="(\d+) queries", tpl;dur=\d+\.\d, total;dur=\d+\.\d$')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_superuser('admin@example.com', 'password')
+
+    def test_server_timing_only_for_staff(self):
+        self.assertFalse(self.client.get(reverse('home')).has_header('Server-Timing'))
+
+        self.client.force_login(self.staff)
+        header = self.client.get(reverse('home'))['Server-Timing']
+        self.assertRegex(header, self.SERVER_TIMING)
+        self.assertGreater(int(self.SERVER_TIMING.match(header).group(1)), 0)
+
+    @override_settings(DEBUG=True)
+    def test_server_timing_for_everyone_in_debug(self):
+        self.assertRegex(self.client.get(reverse('home'))['Server-Timing'], self.SERVER_TIMING)
+
+    @override_settings(PERF_SLOW_QUERY_MS=0)
+    def test_slow_queries_logged_with_origin(self):
+        with self.assertLogs('cloth.middleware', 'WARNING') as logs:
+            self.client.get(reverse('home'))
+        self.assertIn('Slow query in home', logs.output[0])
+        self.assertIn('cloth/views.py', logs.output[0])
+
+    def test_streaming_response_left_intact(self):
+        chunks = iter([b'first ', b'second'])
+        middleware = RequestTimingMiddleware(lambda request: StreamingHttpResponse(chunks))
+        request = RequestFactory().get('/feed')
+        request.user = self.staff
+        response = middleware(request)
+        self.assertTrue(response.streaming)
+        self.assertRegex(response['Server-Timing'], self.SERVER_TIMING)
+        self.assertEqual(b''.join(response.streaming_content), b'first second')
+
+
+class MetricsTests(TestCase):
+    """Метрики Prometheus (/metrics, cloth.metrics)"""
+
+    def test_output(self):
+        self.client.get(reverse('home'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, 200)
+        body = response.content.decode()
+        self.assertIn('cloth_request_duration_seconds_bucket{', body)
+        self.assertIn('view="home"', body)
+        self.assertIn('cloth_pending_refunds 0.0', body)
+
+    def test_direct_access_from_allowed_ips_only(self):
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='10.0.0.5').status_code, 403)
+        # Через прокси REMOTE_ADDR -- адрес прокси, а не клиента
+        response = self.client.get(reverse('metrics'), HTTP_X_FORWARDED_FOR='203.0.113.7')
+        self.assertEqual(response.status_code, 403)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_bearer_token(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get(url, HTTP_AUTHORIZATION='Bearer secret', HTTP_X_FORWARDED_FOR='203.0.113.7')
+        self.assertEqual(response.status_code, 200)
+
+    def test_multiprocess_values_are_aggregated(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        # Два "воркера" -- отдельные процессы, пишущие в общий каталог
+        script = (
+            "from prometheus_client import Counter; "
+            "Counter('cloth_test_events', 'test', ['kind']).labels('a').inc({})"
+        )
+        for amount in (1, 2):
+            subprocess.run([sys.executable, '-c', script.format(amount)], check=True,
+                           env={**os.environ, 'PROMETHEUS_MULTIPROC_DIR': directory})
+
+        with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+            body = metrics.render_latest().decode()
+        self.assertIn('cloth_test_events_total{kind="a"} 3.0', body)
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Бюджет SQL-запросов и времени для каждого URL из cloth/urls.py
+
+    Каждый URL запрашивается через тестовый клиент на большом наборе данных,
+    число запросов и медианное время сравниваются с query_budget.json.
+    Изменения, сделанные запросом, откатываются, поэтому замеры независимы.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        # Отдельные MEDIA_ROOT и кэш ресайза с одной картинкой для /img/, каталог sitemap и фида
+        media_root = tempfile.mkdtemp()
+        cls.addClassCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        os.makedirs(os.path.join(media_root, 'products'))
+        Image.new('RGB', (1200, 900), (200, 120, 80)).save(os.path.join(media_root, 'products', 'bench.jpg'))
+        # Замеряется рендеринг страниц, а не попадания в кэш страниц (cloth.cache)
+        # Буферы просмотров и журнала поиска сбрасываются только явно: иначе сброс по таймеру попадёт в замер
+        cls.enterClassContext(override_settings(
+            MEDIA_ROOT=media_root, IMAGE_CACHE_DIR=os.path.join(media_root, 'cache'), PAGE_CACHE_TIMEOUT=0,
+            FEEDS_DIR=os.path.join(media_root, 'feeds'),
+            VIEW_COUNTER_FLUSH_SECONDS=3600, SEARCH_LOG_FLUSH_SECONDS=3600,
+        ))
+        super().setUpClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_benchmark_data()
+        # Подборки главной и файлы sitemap и фида, как после плановых rank_products и build_feeds
+        rank_products()
+        build_feeds()
+
+    def setUp(self):
+        # Внешний API ЮKassa в замерах не вызываем
+        patcher = mock.patch.multiple(
+            views.payment_service.yookassa,
+            create_payment=mock.Mock(return_value=None),
+            get_payment_info=mock.Mock(return_value=None),
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def url_kwargs(self, pattern):
+        values = {
+            'slug': self.data['product'].slug,
+            'product_id': self.data['product'].id,
+            'variant_id': self.data['variant'].id,
+            'item_id': self.data['cart_item'].id,
+            'order_id': self.data['order'].id,
+            'review_id': self.data['review'].id,
+            'token': self.data['verification'].token,
+            'width': 400,
+            'height': 0,
+            'path': 'products/bench.jpg',
+            'name': 'products.yml',
+        }
+        return {name: values[name] for name in pattern.pattern.converters}
+
+    def client_for(self, role):
+        client = Client()
+        if role != 'anonymous':
+            client.force_login(self.data[role])
+        return client
+
+    def measure(self, case_id, url_name, role, method, data):
+        pattern = self.patterns[url_name]
+        kwargs = self.url_kwargs(pattern)
+        if case_id == 'delete_product':
+            kwargs['product_id'] = self.data['product_without_orders'].id
+        url = reverse(url_name, kwargs=kwargs)
+
+        query_counts = []
+        timings = []
+        for _ in range(BENCH_RUNS + 1):
+            client = self.client_for(role)
+            queries = []
+
+            def count_queries(execute, sql, params, many, context):
+                queries.append(sql)
+                return execute(sql, params, many, context)
+
+            with transaction.atomic():
+                with connection.execute_wrapper(count_queries):
+                    start = time.perf_counter()
+                    if isinstance(data, str):
+                        response = getattr(client, method)(url, data, content_type='application/json')
+                    else:
+                        response = getattr(client, method)(url, data or {})
+                    elapsed = time.perf_counter() - start
+                transaction.set_rollback(True)
+
+            self.assertLess(response.status_code, 500, f'{case_id}: {response.status_code}')
+            query_counts.append(len(queries))
+            timings.append(elapsed * 1000)
+
+        # Первый прогон прогревает шаблоны и кэши
+        return max(query_counts[1:]), statistics.median(timings[1:])
+
+    @property
+    def patterns(self):
+        return {
+            pattern.name: pattern
+            for pattern in cloth_urls.urlpatterns
+            if isinstance(pattern, URLPattern)
+        }
+
+    def test_every_url_has_budget_case(self):
+        covered = {url_name for _, url_name, _, _, _ in VIEW_CASES}
+        self.assertEqual(set(self.patterns) - covered, set())
+
+    def test_query_budget(self):
+        results = {}
+        for case in VIEW_CASES:
+            queries, elapsed_ms = self.measure(*case)
+            results[case[0]] = {'queries': queries, 'time_ms': round(elapsed_ms, 1)}
+
+        if os.environ.get('UPDATE_QUERY_BUDGET'):
+            QUERY_BUDGET_FILE.write_text(
+                json.dumps(results, ensure_ascii=False, indent=2, sort_keys=True) + '\n',
+                encoding='utf-8'
+            )
+            return
+
+        budget = json.loads(QUERY_BUDGET_FILE.read_text(encoding='utf-8'))
+        failures = []
+        for case_id, result in results.items():
+            expected = budget.get(case_id)
+            if expected is None:
+                failures.append(f'{case_id}: нет базового значения в {QUERY_BUDGET_FILE.name}')
+                continue
+
+            allowed_queries = expected['queries'] + max(1, int(expected['queries'] * QUERY_TOLERANCE))
+            if result['queries'] > allowed_queries:
+                failures.append(
+                    f"{case_id}: {result['queries']} запросов (база {expected['queries']}, допустимо {allowed_queries})"
+                )
+
+            allowed_time = max(expected['time_ms'] * TIME_TOLERANCE, expected['time_ms'] + TIME_TOLERANCE_MIN_MS)
+            if result['time_ms'] > allowed_time:
+                failures.append(
+                    f"{case_id}: {result['time_ms']} мс (база {expected['time_ms']} мс, допустимо {allowed_time:.1f})"
+                )
+
+        self.assertFalse(failures, '\n'.join(failures))
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class RenditionTests(SimpleTestCase):
+    """Миниатюры WebP/JPEG (cloth.images.build_renditions)"""
+
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        self.storage = FileSystemStorage(location=location)
+        self.name = self.save_original((1000, 500), (200, 120, 80))
+
+    def save_original(self, size, color):
+        buffer = BytesIO()
+        Image.new('RGBA', size, color + (128,)).save(buffer, 'PNG')
+        if self.storage.exists('products/shirt.png'):
+            self.storage.delete('products/shirt.png')
+        return self.storage.save('products/shirt.png', ContentFile(buffer.getvalue()))
+
+    def test_formats_and_sizes(self):
+        data = build_renditions(self.name, storage=self.storage)
+        self.assertEqual((data['width'], data['height']), (1000, 500))
+        self.assertTrue(data['placeholder'].startswith('data:image/jpeg;base64,'))
+        self.assertEqual(set(data['sizes']), set(RENDITIONS))
+
+        for rendition, entry in data['sizes'].items():
+            # Оригинал не увеличивается: zoom (1600) -- собственная ширина 1000
+            width = min(RENDITIONS[rendition], 1000)
+            self.assertEqual(entry['width'], width)
+            for fmt, pil_format in (('webp', 'WEBP'), ('jpeg', 'JPEG')):
+                self.assertIn(f".{data['hash']}.{rendition}.", entry[fmt])
+                with self.storage.open(entry[fmt]) as file, Image.open(file) as image:
+                    self.assertEqual((image.format, image.size), (pil_format, (width, width // 2)))
+
+        # Повторный запуск не пересоздаёт файлы
+        self.assertEqual(build_renditions(self.name, storage=self.storage), data)
+
+    def test_new_content_gets_new_names_and_old_ones_are_deleted(self):
+        old = build_renditions(self.name, storage=self.storage)
+        self.save_original((600, 600), (10, 20, 30))
+        new = build_renditions(self.name, storage=self.storage)
+        self.assertNotEqual(old['hash'], new['hash'])
+
+        delete_renditions(old, storage=self.storage)
+        for entry in old['sizes'].values():
+            self.assertFalse(self.storage.exists(entry['webp']))
+            self.assertFalse(self.storage.exists(entry['jpeg']))
+        for entry in new['sizes'].values():
+            self.assertTrue(self.storage.exists(entry['webp']))
+            self.assertTrue(self.storage.exists(entry['jpeg']))
+
+
+class ProductImageDataTests(TestCase):
+    """Размеры и превью ProductImage: при загрузке и через generate_renditions"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Рубашки', slug='shirts')
+        cls.product = Product.objects.create(name='Льняная рубашка', slug='linen-shirt', description='',
+                                             price=Decimal(1000), category=category)
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def upload(self, name='shirt.png'):
+        buffer = BytesIO()
+        Image.new('RGB', (640, 480), (200, 120, 80)).save(buffer, 'PNG')
+        return ProductImage.objects.create(product=self.product, image=ContentFile(buffer.getvalue(), name=name))
+
+    def assert_image_data(self, image):
+        image.refresh_from_db()
+        self.assertEqual((image.width, image.height), (640, 480))
+        self.assertTrue(image.placeholder.startswith('data:image/jpeg;base64,'))
+        with Image.open(BytesIO(base64.b64decode(image.placeholder.split(',', 1)[1]))) as preview:
+            self.assertEqual(preview.format, 'JPEG')
+            self.assertLess(preview.width, 640)
+        self.assertEqual(set(image.renditions['sizes']), set(RENDITIONS))
+        self.assertNotIn('placeholder', image.renditions)
+
+    @override_settings(IMAGE_RENDITIONS_ON_SAVE=True)
+    def test_filled_on_upload(self):
+        self.assert_image_data(self.upload())
+
+    @override_settings(IMAGE_RENDITIONS_ON_SAVE=False)
+    def test_filled_by_generate_renditions(self):
+        image = self.upload()
+        image.refresh_from_db()
+        self.assertEqual((image.width, image.height, image.placeholder, image.renditions), (None, None, '', {}))
+
+        output = StringIO()
+        call_command('generate_renditions', workers=1, stdout=output)
+        self.assertIn('Готово: 1 изображений', output.getvalue())
+        self.assert_image_data(image)
+        # Повторный запуск без --all ничего не делает
+        call_command('generate_renditions', workers=1, stdout=output)
+        self.assertIn('Все изображения уже обработаны', output.getvalue())
+
+
+class ImageResizeTests(TestCase):
+    """Ресайз по запросу (/img/<w>x<h>/<path>, cloth.images.ResizeCache)"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        os.makedirs(os.path.join(self.media_root, 'products'))
+        self.source = os.path.join(self.media_root, 'products', 'shirt.png')
+        Image.new('RGB', (1000, 500), (200, 120, 80)).save(self.source)
+        self.cache_dir = os.path.join(self.media_root, 'cache')
+
+    def test_view_allows_only_configured_sizes(self):
+        url = reverse('resized_image', args=[400, 0, 'products/shirt.png'])
+        with override_settings(MEDIA_ROOT=self.media_root, IMAGE_CACHE_DIR=self.cache_dir,
+                               IMAGE_RESIZE_SIZES={(400, 0)}):
+            response = self.client.get(url, HTTP_ACCEPT='image/webp,*/*')
+            self.assertEqual(response['Content-Type'], 'image/webp')
+            with Image.open(BytesIO(b''.join(response.streaming_content))) as image:
+                self.assertEqual(image.size, (400, 200))
+
+            response_404 = self.client.get(reverse('resized_image', args=[401, 0, 'products/shirt.png']))
+            self.assertEqual(response_404.status_code, 404)
+
+            etag = response['ETag']
+            response = self.client.get(url, HTTP_ACCEPT='image/webp', HTTP_IF_NONE_MATCH=f'"other", {etag}')
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get(url, HTTP_ACCEPT='image/webp', HTTP_IF_NONE_MATCH='*')
+            self.assertEqual(response.status_code, 304)
+            response = self.client.get(url, HTTP_ACCEPT='image/webp', HTTP_IF_NONE_MATCH=etag[:-2] + '"')
+            self.assertEqual(response.status_code, 200)
+
+    def test_lru_eviction_keeps_recently_used(self):
+        cache = ResizeCache(self.cache_dir, max_bytes=250)
+        with mock.patch('cloth.images.resize_image', return_value=b'x' * 100):
+            first, _ = cache.get_or_create(self.source, 100, 0, 'PNG')
+            second, _ = cache.get_or_create(self.source, 200, 0, 'PNG')
+            now = time.time()
+            os.utime(first, (now - 200, now - 200))
+            os.utime(second, (now - 100, now - 100))
+
+            # Попадание обновляет время обращения: первым вытесняется второй файл
+            self.assertEqual(cache.get_or_create(self.source, 100, 0, 'PNG'), (first, True))
+            third, hit = cache.get_or_create(self.source, 300, 0, 'PNG')
+
+        self.assertFalse(hit)
+        self.assertTrue(os.path.exists(first))
+        self.assertFalse(os.path.exists(second))
+        self.assertTrue(os.path.exists(third))
+        self.assertLessEqual(sum(size for _, size, _ in cache._scan()), 250)
+
+    def test_concurrent_misses_resize_once(self):
+        cache = ResizeCache(self.cache_dir, max_bytes=10 ** 6)
+        calls = []
+
+        def slow_resize(*args):
+            calls.append(args)
+            time.sleep(0.1)
+            return b'x' * 100
+
+        results = []
+        with mock.patch('cloth.images.resize_image', side_effect=slow_resize):
+            threads = [
+                threading.Thread(target=lambda: results.append(cache.get_or_create(self.source, 400, 0, 'PNG')))
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(hit for _, hit in results), [False] + [True] * 7)
+        self.assertEqual(len({path for path, _ in results}), 1)
+
+
+class AssignProductImagesTests(TestCase):
+    """Синхронизация фотографий с товарами (assign_product_images)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Футболки', slug='t-shirts')
+        for slug, name in [('basic-premium', 'Базовая футболка премиум'), ('basic', 'Базовая футболка'),
+                           ('oversize', 'Оверсайз футболка унисекс')]:
+            Product.objects.create(name=name, slug=slug, description='', price=Decimal(1000), category=category)
+
+    def setUp(self):
+        self.media_root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+        (self.media_root / 'products').mkdir()
+        for name, color in [('bazafutbolka.png', (200, 120, 80)), ('oversaiz.png', (20, 40, 60)),
+                            ('chinos.png', (90, 90, 90))]:
+            self.save_file(name, color)
+        settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def save_file(self, name, color):
+        Image.new('RGB', (300, 400), color).save(self.media_root / 'products' / name)
+
+    def assign(self, *args):
+        output = StringIO()
+        call_command('assign_product_images', *args, '--workers=2', stdout=output)
+        return output.getvalue()
+
+    def images(self):
+        return {image.image.name: image for image in ProductImage.objects.select_related('product')}
+
+    def test_dry_run_changes_nothing(self):
+        output = self.assign('--dry-run')
+        self.assertIn('+ products/bazafutbolka.png -> "Базовая футболка"', output)
+        self.assertIn('chinos.png (искали: Чиносы)', output)
+        self.assertFalse(ProductImage.objects.exists())
+
+    def test_name_matching(self):
+        self.assign()
+        images = self.images()
+        # Точное совпадение важнее подстроки, без него -- подстрока
+        self.assertEqual(images['products/bazafutbolka.png'].product.slug, 'basic')
+        self.assertEqual(images['products/oversaiz.png'].product.slug, 'oversize')
+        self.assertNotIn('products/chinos.png', images)
+        self.assertTrue(all(image.is_main for image in images.values()))
+
+    def test_incremental_sync(self):
+        self.assign()
+        first = self.images()
+        basic = first['products/bazafutbolka.png']
+        self.assertEqual((basic.width, basic.height), (300, 400))
+        self.assertTrue(basic.renditions['hash'])
+        self.assertIn('Изменений нет', self.assign())
+
+        # Картинка вне PRODUCT_MAPPING (из админки) синхронизацией не трогается
+        manual = ProductImage.objects.create(product=basic.product, image='products/manual.png')
+        self.save_file('bazafutbolka.png', (0, 0, 0))
+        (self.media_root / 'products' / 'oversaiz.png').unlink()
+        output = self.assign()
+        self.assertIn('↻ products/bazafutbolka.png', output)
+        self.assertIn('- products/oversaiz.png', output)
+
+        images = self.images()
+        self.assertEqual(set(images), {'products/bazafutbolka.png', 'products/manual.png'})
+        self.assertEqual(images['products/bazafutbolka.png'].id, basic.id)
+        self.assertNotEqual(images['products/bazafutbolka.png'].renditions['hash'], basic.renditions['hash'])
+        self.assertEqual(images['products/manual.png'].id, manual.id)
+
+
+class PageWeightTests(TestCase):
+    """
+    Объём страниц по сети и время рендеринга: каталог и корзина
+
+    Сравнивает исходный HTML, минифицированный HTML и его gzip/brotli
+    (cloth.middleware.ResponseCompressionMiddleware). Таблица результатов
+    пишется в лог (logger cloth.tests, INFO); проверяется только, что каждый
+    шаг действительно уменьшает ответ.
+    """
+
+    PAGES = [('catalog', 'anonymous'), ('cart', 'customer')]
+    ENCODINGS = ['gzip', 'br'] if brotli is not None else ['gzip']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_benchmark_data(products=200, users=20, orders=20)
+
+    def fetch(self, url_name, role, accept_encoding=''):
+        client = Client()
+        if role != 'anonymous':
+            client.force_login(self.data[role])
+        timings = []
+        for _ in range(BENCH_RUNS + 1):
+            start = time.perf_counter()
+            response = client.get(reverse(url_name), HTTP_ACCEPT_ENCODING=accept_encoding)
+            timings.append((time.perf_counter() - start) * 1000)
+        self.assertEqual(response.status_code, 200)
+        return response, statistics.median(timings[1:])
+
+    def test_page_weight(self):
+        rows = []
+        for url_name, role in self.PAGES:
+            with override_settings(HTML_MINIFY=False):
+                raw, raw_ms = self.fetch(url_name, role)
+            minified, minified_ms = self.fetch(url_name, role)
+            sizes = {'raw': len(raw.content), 'minified': len(minified.content)}
+            for encoding in self.ENCODINGS:
+                compressed, _ = self.fetch(url_name, role, accept_encoding=encoding)
+                self.assertEqual(compressed.get('Content-Encoding'), encoding)
+                sizes[encoding] = len(compressed.content)
+
+            self.assertLess(sizes['minified'], sizes['raw'], url_name)
+            for encoding in self.ENCODINGS:
+                self.assertLess(sizes[encoding], sizes['minified'], f'{url_name} {encoding}')
+            rows.append((url_name, sizes, raw_ms, minified_ms))
+
+        lines = [f"{'Страница':<10}{'HTML':>10}{'Минифиц.':>10}" + ''.join(f'{e:>10}' for e in self.ENCODINGS)
+                 + f"{'Рендер':>12}{'+ минифик.':>12}"]
+        for url_name, sizes, raw_ms, minified_ms in rows:
+            lines.append(
+                f"{url_name:<10}{sizes['raw']:>10}{sizes['minified']:>10}"
+                + ''.join(f'{sizes[e]:>10}' for e in self.ENCODINGS)
+                + f'{raw_ms:>10.1f}мс{minified_ms:>10.1f}мс'
+            )
+        logger.info('Page weight:\n' + '\n'.join(lines))
+
+    def test_minify_keeps_attribute_values(self):
+        html = (
+            '<div   class="card"\n     title="Два   пробела"   data-note=\'a\n  b\'>\n'
+            '    <!-- комментарий -->\n    Текст   <b>жирный</b>\n</div>'
+        )
+        self.assertEqual(
+            minify_html(html),
+            '<div class="card"\ntitle="Два   пробела" data-note=\'a\n  b\'>\nТекст <b>жирный</b>\n</div>',
+        )
+
+    def test_undecodable_body_left_as_is(self):
+        middleware = ResponseCompressionMiddleware(
+            lambda request: HttpResponse(b'<p>\xff\xfe   broken</p>' * 200, content_type='text/html; charset=utf-8')
+        )
+        with self.assertLogs('cloth.middleware', 'WARNING'):
+            response = middleware(RequestFactory().get('/'))
+        self.assertEqual(response.content, b'<p>\xff\xfe   broken</p>' * 200)
+
+    @skipUnless(brotli is not None, 'brotli не установлен')
+    def test_brotli_html_is_padded(self):
+        body = '<html><body>' + 'Каталог одежды. ' * 200 + '</body></html>'
+        middleware = ResponseCompressionMiddleware(lambda request: HttpResponse(body))
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING='br')
+        responses = [middleware(request) for _ in range(20)]
+        self.assertEqual({response['Content-Encoding'] for response in responses}, {'br'})
+        self.assertGreater(len({len(response.content) for response in responses}), 1)
+        self.assertTrue(brotli.decompress(responses[0].content).startswith(body.encode()))
+
+
+class StaticFilesTests(SimpleTestCase):
+    """collectstatic со сжатием и отдача статики (cloth.staticfiles)"""
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        self.root = tempfile.mkdtemp()
+        for directory in (self.source, self.root):
+            self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.write('css/site.css', '.card  {\n    color: red;\n}\n' * 200)
+        self.write('data/noise.txt', os.urandom(600))
+        settings_override = override_settings(
+            STATIC_ROOT=self.root,
+            STATICFILES_DIRS=[self.source],
+            STATICFILES_FINDERS=['django.contrib.staticfiles.finders.FileSystemFinder'],
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def write(self, name, content):
+        path = os.path.join(self.source, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb' if isinstance(content, bytes) else 'w') as f:
+            f.write(content)
+
+    def collectstatic(self):
+        call_command('collectstatic', interactive=False, verbosity=0)
+        with open(os.path.join(self.root, 'staticfiles.json')) as f:
+            return json.load(f)['paths']
+
+    def serve(self, path, accept_encoding='gzip, deflate, br'):
+        response = serve_static(RequestFactory().get(f'/static/{path}', HTTP_ACCEPT_ENCODING=accept_encoding), path)
+        self.addCleanup(response.close)
+        return response
+
+    def test_post_process_minifies_and_compresses(self):
+        paths = self.collectstatic()
+        css = os.path.join(self.root, paths['css/site.css'])
+        with open(css) as f:
+            minified = f.read()
+        self.assertEqual(minified, '.card{color:red}' * 200)
+        with open(css + '.gz', 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()).decode(), minified)
+        # Случайные данные не сжимаются -- .gz не пишется
+        self.assertFalse(os.path.exists(os.path.join(self.root, paths['data/noise.txt']) + '.gz'))
+
+    def test_serve_chooses_encoding(self):
+        name = self.collectstatic()['css/site.css']
+        response = self.serve(name)
+        self.assertEqual(response['Content-Encoding'], 'br' if brotli is not None else 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertIn('immutable', response['Cache-Control'])
+
+        response = self.serve(name, 'br;q=0, gzip;q=0')
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertEqual(b''.join(response.streaming_content).decode(), '.card{color:red}' * 200)
+        self.assertIsNone(ResponseCompressionMiddleware._choose_encoding('br;q=0, gzip; q=0.0'))
+
+        # Имя без отпечатка кэшируется ненадолго
+        response = self.serve('css/site.css')
+        self.assertEqual(response['Cache-Control'], f'public, max-age={settings.STATIC_MAX_AGE}')
+        with self.assertRaises(Http404):
+            self.serve('../secret.txt')
+
+    def test_new_manifest_is_picked_up(self):
+        old_name = self.collectstatic()['css/site.css']
+        self.assertIn('immutable', self.serve(old_name)['Cache-Control'])
+        self.write('css/site.css', '.card{color:blue}' * 200)
+        name = self.collectstatic()['css/site.css']
+        self.assertIn('immutable', self.serve(name)['Cache-Control'])
+
+
+class ProductCardCacheTests(TestCase):
+    """Кэш HTML карточек товаров (cloth.cache): попадания и сброс по версии товара"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_benchmark_data(products=30, users=5, orders=5)
+
+    def setUp(self):
+        cache.clear()
+
+    def catalog_queries(self, client):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(reverse('catalog'))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_cards_are_cached_and_invalidated(self):
+        # Покупатель: страница целиком не кэшируется, только карточки
+        client = Client()
+        client.force_login(self.data['customer'])
+        _, cold_queries = self.catalog_queries(client)
+        _, warm_queries = self.catalog_queries(client)
+        # Без промахов не нужны запросы изображений, вариантов и цветов
+        self.assertLess(warm_queries, cold_queries)
+
+        product = Product.objects.filter(is_active=True).order_by('-created_at').first()
+        variant = product.variants.order_by('id').first()
+        variant.price = Decimal('12345')
+        variant.save()
+
+        response, queries = self.catalog_queries(client)
+        self.assertContains(response, '12345')
+        self.assertGreater(queries, warm_queries)
+
+    def test_cards_are_shared_between_users(self):
+        client = Client()
+        client.force_login(self.data['customer'])
+        customer_page = client.get(reverse('catalog')).content.decode()
+        anonymous_page = Client().get(reverse('catalog')).content.decode()
+        # Избранное отмечается в браузере по #wishlist-state, а не в HTML карточек
+        self.assertNotIn('wishlist-btn active', customer_page)
+        self.assertIn('"authenticated": true', customer_page)
+        self.assertIn('"authenticated": false', anonymous_page)
+
+
+class PageCacheTests(TestCase):
+    """Кэш страниц главной и каталога для анонимных посетителей"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_benchmark_data(products=30, users=5, orders=5)
+
+    def setUp(self):
+        cache.clear()
+
+    def get(self, url, client=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = (client or Client()).get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_normalized_query_shares_entry(self):
+        catalog = reverse('catalog')
+        first, _ = self.get(f'{catalog}?color=Red&size=M&size=S')
+        self.assertEqual(first['X-Page-Cache'], 'miss')
+        second, queries = self.get(f'{catalog}?size=S&sort=-created_at&size=M&color=Red&category=')
+        self.assertEqual(second['X-Page-Cache'], 'hit')
+        self.assertEqual(queries, 0)
+        self.assertEqual(second.content, first.content)
+
+    def test_catalog_change_serves_stale_while_revalidating(self):
+        home = reverse('home')
+        self.get(home)
+        product = Product.objects.filter(is_active=True).order_by('-created_at').first()
+        product.name = 'Обновлённое название'
+        product.save()
+
+        # Пока другой запрос перестраивает страницу, отдаётся устаревшая
+        _, lock_key = page_cache_keys('home', normalize_query(QueryDict()))
+        cache.set(lock_key, 1)
+        stale, queries = self.get(home)
+        self.assertEqual(stale['X-Page-Cache'], 'stale')
+        self.assertEqual(queries, 0)
+        self.assertNotContains(stale, 'Обновлённое название')
+
+        cache.delete(lock_key)
+        fresh, _ = self.get(home)
+        self.assertEqual(fresh['X-Page-Cache'], 'miss')
+        self.assertContains(fresh, 'Обновлённое название')
+
+    def test_authenticated_pages_are_not_cached(self):
+        client = Client()
+        client.force_login(self.data['customer'])
+        response, _ = self.get(reverse('catalog'), client)
+        self.assertFalse(response.has_header('X-Page-Cache'))
+
+
+class ProductConditionalGetTests(TestCase):
+    """ETag и Last-Modified страницы товара"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_benchmark_data(products=10, users=5, orders=5)
+
+    def setUp(self):
+        self.product = self.data['product']
+        self.url = reverse('product_detail', args=[self.product.slug])
+        self.client = Client()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.etag = response['ETag']
+        self.last_modified = response['Last-Modified']
+
+    def test_not_modified_uses_single_query(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=self.last_modified)
+        self.assertEqual(response.status_code, 304)
+
+    def test_validator_tracks_variants_and_reviews(self):
+        # Остатки меняются через update(), без updated_at
+        ProductVariant.objects.filter(product=self.product).update(stock_quantity=F('stock_quantity') + 1)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(response.status_code, 200)
+
+        etag = response['ETag']
+        review = Review.objects.filter(product=self.product, is_moderated=False).first() or Review.objects.create(
+            product=self.product, user=self.data['moderator'], rating=5
+        )
+        review.is_moderated = True
+        review.save()
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_authenticated_page_has_no_validators(self):
+        self.client.force_login(self.data['customer'])
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('ETag'))
+
+
+class ProductRecommendationTests(TestCase):
+    """Рекомендации "С этим товаром покупают" (cloth.recommendations)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_benchmark_data(products=30, users=5, orders=0)
+        paid = OrderStatus.objects.get(name='paid')
+        cls.product, cls.companion = Product.objects.order_by('id')[1:3]
+        for i in range(3):
+            order = Order.objects.create(
+                user=cls.data['customer'], total_amount=Decimal('1000'),
+                delivery_address='г. Москва', status=paid,
+            )
+            for product in (cls.product, cls.companion):
+                variant = product.variants.first()
+                order.items.create(variant=variant, quantity=1, price_per_unit=variant.price)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_co_purchase_first_then_category_fallback(self):
+        stats = build_recommendations(k=4)
+        self.assertEqual(stats['products'], Product.objects.count())
+
+        rows = list(ProductRecommendation.objects.filter(product=self.product))
+        self.assertEqual([row.rank for row in rows], [0, 1, 2, 3])
+        self.assertEqual((rows[0].recommended_id, rows[0].source), (self.companion.id, 'co_purchase'))
+        for row in rows[1:]:
+            self.assertEqual(row.source, 'category')
+            self.assertEqual(row.recommended.category_id, self.product.category_id)
+            self.assertNotEqual(row.recommended_id, self.product.id)
+
+    @override_settings(PAGE_CACHE_TIMEOUT=0)
+    def test_product_page_shows_recommendations(self):
+        url = reverse('product_detail', args=[self.product.slug])
+        etag = self.client.get(url)['ETag']
+        self.assertNotContains(self.client.get(url), 'С этим товаром покупают')
+
+        build_recommendations(k=4)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'С этим товаром покупают')
+        self.assertContains(response, reverse('product_detail', args=[self.companion.slug]))
+
+
+class SimilarProductsTests(TestCase):
+    """Похожие товары по описанию (cloth.similarity)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_benchmark_data(products=40, users=5, orders=0)
+        cls.products = list(Product.objects.order_by('id'))
+        Product.objects.filter(pk=cls.products[0].pk).update(
+            name='Льняная рубашка оверсайз', description='Рубашка из льна свободного кроя', material='Лён 100%'
+        )
+        Product.objects.filter(pk=cls.products[5].pk).update(
+            name='Rubashka oversize', description='Рубашки из льна', material='Лён'
+        )
+
+    def setUp(self):
+        cache.clear()
+        index_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, index_dir, ignore_errors=True)
+        path_override = override_settings(SIMILARITY_INDEX_PATH=os.path.join(index_dir, 'products.npy'))
+        path_override.enable()
+        self.addCleanup(path_override.disable)
+
+    def test_tokenize_transliterates(self):
+        self.assertEqual(tokenize('Футболки'), tokenize('futbolka'))
+        self.assertEqual(tokenize('Рубашка и брюки'), ['rubashk', 'bryuk'])
+
+    def test_index_finds_transliterated_twin(self):
+        stats = build_similarity_index(k=4)
+        self.assertEqual(stats['mode'], 'full')
+        self.assertEqual(similar_product_ids(self.products[0].id)[0], self.products[5].id)
+        self.assertNotIn(self.products[0].id, similar_product_ids(self.products[0].id))
+
+    def test_incremental_update_matches_changed_rows(self):
+        build_similarity_index(k=4)
+        twin = self.products[10]
+        Product.objects.filter(pk=twin.pk).update(
+            name='Льняная рубашка', description='Рубашка оверсайз из льна', material='Лён',
+            updated_at=timezone.now() + timedelta(seconds=1),
+        )
+        Product.objects.filter(pk=self.products[20].pk).update(is_active=False)
+
+        stats = build_similarity_index(k=4)
+        self.assertEqual((stats['mode'], stats['changed']), ('incremental', 1))
+        self.assertIn(twin.id, similar_product_ids(self.products[0].id))
+        index = load_index()
+        self.assertNotIn(self.products[20].id, index['id'])
+        self.assertNotIn(self.products[20].id, index['neighbours'])
+
+        incremental = similar_product_ids(twin.id)
+        build_similarity_index(k=4, full=True)
+        self.assertEqual(similar_product_ids(twin.id), incremental)
+
+    @override_settings(PAGE_CACHE_TIMEOUT=0)
+    def test_product_page_falls_back_to_similar(self):
+        build_similarity_index(k=4)
+        response = self.client.get(reverse('product_detail', args=[self.products[0].slug]))
+        self.assertContains(response, reverse('product_detail', args=[self.products[5].slug]))
+
+        build_recommendations(k=4)
+        sources = ProductRecommendation.objects.filter(product=self.products[0]).values_list('source', flat=True)
+        self.assertIn('similar', list(sources))
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class ProductRankingTests(TestCase):
+    """Популярность товаров и подборки главной (cloth.ranking)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.data = seed_benchmark_data(products=20, users=5, orders=0)
+        cls.products = list(Product.objects.order_by('id'))
+        paid = OrderStatus.objects.get(name='paid')
+        customer = cls.data['customer']
+        cls.recent, cls.old = cls.products[3], cls.products[4]
+        for product, quantity, age in ((cls.recent, 2, 1), (cls.old, 10, 60), (cls.products[5], 50, 200)):
+            order = Order.objects.create(
+                user=customer, total_amount=Decimal('1000'), delivery_address='г. Москва', status=paid
+            )
+            Order.objects.filter(pk=order.pk).update(created_at=timezone.now() - timedelta(days=age))
+            variant = product.variants.first()
+            order.items.create(variant=variant, quantity=quantity, price_per_unit=variant.price)
+        # Старые товары не попадают в новинки
+        Product.objects.filter(pk__in=[p.pk for p in cls.products[:10]]).update(
+            created_at=timezone.now() - timedelta(days=90)
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def test_scores_decay_with_age(self):
+        stats = rank_products()
+        self.assertGreater(stats['bestsellers'], 0)
+        bestsellers = list(
+            ProductRanking.objects.filter(list_name='bestsellers').values_list('product_id', flat=True)
+        )
+        self.assertEqual(bestsellers[0], self.recent.id)
+        self.assertIn(self.old.id, bestsellers)
+        # Заказ старше окна не учитывается
+        self.assertNotIn(self.products[5].id, bestsellers)
+
+        self.recent.refresh_from_db()
+        self.assertTrue(self.recent.is_bestseller)
+        self.assertFalse(self.recent.is_new)
+        new = ProductRanking.objects.filter(list_name='new').values_list('product_id', flat=True)
+        self.assertTrue(all(product_id in [p.id for p in self.products[10:]] for product_id in new))
+
+    def test_home_and_popular_sort(self):
+        rank_products()
+        self.client.get(reverse('home'))
+        # Карточки уже в кэше: остаётся только чтение подборок
+        with self.assertNumQueries(1):
+            response = self.client.get(reverse('home'))
+        self.assertContains(response, 'Хиты продаж')
+
+        response = self.client.get(reverse('catalog'), {'sort': 'popular'})
+        self.assertEqual(response.context['products'][0].id, self.recent.id)
+
+
+class SearchSuggestTests(TestCase):
+    """Подсказки поиска (cloth.suggest)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Рубашки', slug='shirts')
+        for i, (name, material, score) in enumerate([
+            ('Льняная рубашка', 'Лён', 5.0),
+            ('Рубашка оверсайз', 'Хлопок', 9.0),
+            ('Джинсы Slim', 'Деним', 1.0),
+        ]):
+            Product.objects.create(name=name, slug=f'product-{i}', description='', price=Decimal(1000),
+                                   category=cls.category, material=material, popularity_score=score)
+
+    def setUp(self):
+        cache.clear()
+
+    def suggest(self, query):
+        response = self.client.get(reverse('search_suggest'), {'q': query})
+        self.assertEqual(response.status_code, 200)
+        return [suggestion['text'] for suggestion in response.json()['suggestions']]
+
+    def test_prefix_of_any_word_by_popularity(self):
+        self.assertEqual(self.suggest('руб')[:3], ['Рубашки', 'Рубашка оверсайз', 'Льняная рубашка'])
+        self.assertEqual(self.suggest('slim'), ['Джинсы Slim'])
+        self.assertEqual(self.suggest('   '), [])
+
+    def test_wrong_keyboard_layout(self):
+        self.assertEqual(query_variants('L;bycs'), ['l bycs', 'джинсы'])
+        self.assertEqual(query_variants('ыдшь'), ['ыдшь', 'slim'])
+        self.assertIn('Джинсы Slim', self.suggest('l;bycs'))
+        self.assertIn('Джинсы Slim', self.suggest('ыдшь'))
+
+    def test_rebuilt_on_catalog_change(self):
+        self.assertEqual(self.suggest('пальто'), [])
+        Product.objects.create(name='Пальто шерстяное', slug='coat', description='', price=Decimal(9000),
+                               category=self.category)
+        self.assertEqual(self.suggest('пальто'), ['Пальто шерстяное'])
+
+
+class SuggestIndexTests(SimpleTestCase):
+    """Индекс подсказок совпадает с полным перебором, в том числе для тяжёлых префиксов"""
+
+    def test_lookup_matches_brute_force(self):
+        entries = synthetic_entries(5000)
+        index = SuggestIndex(entries)
+        self.assertTrue(index.heavy)
+
+        words = [' ' + normalize(text) for text, _, _, _ in entries]
+        rng = random.Random(2)
+        prefixes = ['л', 'ру', 'linen', 'slim', 'ш', 'пальто', 'fa', 'нет такого']
+        for text, _, _, _ in rng.sample(entries, 30):
+            word = rng.choice(text.split())
+            prefixes.append(word[:rng.randint(1, len(word))])
+
+        for prefix in prefixes:
+            expected = sorted((entry_id for entry_id, text in enumerate(words) if ' ' + prefix in text),
+                              key=lambda entry_id: -entries[entry_id][3])[:5]
+            self.assertEqual(index.lookup(prefix, 5), expected, prefix)
+
+    def test_benchmark_command(self):
+        output = StringIO()
+        call_command('benchmark_suggest', entries=2000, queries=50, stdout=output)
+        self.assertIn('Записей: 2000', output.getvalue())
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class CatalogSearchTests(TestCase):
+    """Поиск каталога с опечатками и транслитом (cloth.search)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Брюки', slug='trousers')
+        for i, (name, material) in enumerate([
+            ('Джинсы прямые', 'Деним'),
+            ('Футболка базовая', 'Хлопок'),
+            ('Эко куртка', 'Нейлон'),
+            ('Джинсовая куртка', 'Деним'),
+        ]):
+            Product.objects.create(name=name, slug=f'product-{i}', description='', price=Decimal(1000),
+                                   category=cls.category, material=material)
+
+    def setUp(self):
+        cache.clear()
+
+    def search(self, query, **params):
+        response = self.client.get(reverse('catalog'), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return [product.name for product in response.context['products']]
+
+    def test_latin_transliteration(self):
+        self.assertEqual(to_cyrillic('dzhinsy'), 'джинсы')
+        self.assertEqual(to_cyrillic('djinsy'), 'джинсы')
+        self.assertEqual(to_cyrillic('sinyaya'), 'синяя')
+        self.assertEqual(search_variants('Djinsy')[-1], 'джинсы')
+        for query in ('djinsy', 'dzhinsy', 'jinsy', 'джиннсы'):
+            self.assertEqual(self.search(query)[0], 'Джинсы прямые', query)
+        # "э" обратно не восстанавливается, совпадает транслитерация названия
+        self.assertEqual(self.search('eko'), ['Эко куртка'])
+
+    def test_typos_ranked_by_similarity(self):
+        self.assertEqual(self.search('футбока'), ['Футболка базовая'])
+        self.assertEqual(self.search('куртка'), ['Джинсовая куртка', 'Эко куртка'])
+        self.assertEqual(self.search('джинсовя куртка'), ['Джинсовая куртка'])
+        self.assertEqual(self.search('деним'), ['Джинсовая куртка', 'Джинсы прямые'])
+        self.assertEqual(self.search('пальто'), [])
+
+    def test_index_keeps_best_results_over_limit(self):
+        index = NgramIndex([(1, 'куртки'), (2, 'куртка'), (3, 'курткам')])
+        with self.assertLogs('cloth.search', 'INFO'):
+            self.assertEqual([product_id for product_id, _ in index.search('куртка', limit=2)], [2, 3])
+
+    def test_explicit_sort_and_filters(self):
+        self.assertEqual(self.search('куртка', sort='name'), ['Джинсовая куртка', 'Эко куртка'])
+        self.assertEqual(self.search('деним', sort='-name'), ['Джинсы прямые', 'Джинсовая куртка'])
+        self.assertEqual(self.search('куртка', max_price='500'), [])
+
+    def test_default_sort_in_cache_key(self):
+        self.assertIn('sort=relevance', normalize_query(QueryDict('q=куртка'), defaults={'sort': views.catalog_default_sort}))
+        self.assertIn('sort=-created_at', normalize_query(QueryDict('q='), defaults={'sort': views.catalog_default_sort}))
+
+    def test_rebuilt_on_catalog_change(self):
+        self.assertEqual(self.search('palto'), [])
+        Product.objects.create(name='Пальто шерстяное', slug='coat', description='', price=Decimal(9000),
+                               category=self.category)
+        self.assertEqual(self.search('palto'), ['Пальто шерстяное'])
+
+
+@skipUnless('replica' in settings.DATABASES, 'нужны настройки onlinestore.test_replica_settings')
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class ReplicaRoutingTests(TestCase):
+    """
+    Чтение с реплики (cloth.db_router)
+
+    Реплика в test_replica_settings -- отдельная база, поэтому в ней
+    и в основной базе лежат разные товары, и по ответу видно, откуда он прочитан.
+    """
+
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        for alias, name in (('default', 'Товар основной базы'), ('replica', 'Товар реплики')):
+            category = Category(name='Категория', slug='category')
+            category.save(using=alias)
+            product = Product(name=name, slug='product', description='', price=Decimal(1000), category=category)
+            product.save(using=alias)
+        cls.product = Product.objects.using('default').get()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_catalog_reads_from_replica(self):
+        response = Client().get(reverse('catalog'))
+        self.assertContains(response, 'Товар реплики')
+        self.assertNotContains(response, 'Товар основной базы')
+
+    def test_post_pins_reads_to_primary(self):
+        client = Client()
+        response = client.post(reverse('login'), {'username': 'nobody@example.com', 'password': 'wrong'})
+        self.assertIn(PIN_COOKIE, response.cookies)
+        response = client.get(reverse('catalog'))
+        self.assertContains(response, 'Товар основной базы')
+
+    def test_write_pins_rest_of_request(self):
+        @replica_reads
+        def view(request):
+            # Личные данные читаются только с основной базы
+            cart_db = router.db_for_read(Cart)
+            before = Product.objects.get().name
+            Product.objects.filter(pk=self.product.pk).update(name='Обновлённый товар')
+            return cart_db, before, Product.objects.get().name
+
+        with primary_pinning(False):
+            result = view(RequestFactory().get('/'))
+        self.assertEqual(result, ('default', 'Товар реплики', 'Обновлённый товар'))
+
+
+@override_settings(VIEW_COUNTER_FLUSH_SECONDS=3600)
+class ViewCounterTests(TestCase):
+    """Буферизованные счётчики просмотров (cloth.view_counter)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Категория', slug='category')
+        cls.first, cls.second = [
+            Product.objects.create(name=f'Товар {i}', slug=f'product-{i}', description='', price=Decimal(1000),
+                                   category=category)
+            for i in range(2)
+        ]
+        for product in (cls.first, cls.second):
+            ProductVariant.objects.create(product=product, price=product.price, stock_quantity=5, sku=f'sku-{product.id}')
+
+    def setUp(self):
+        # Остаток буфера от других тестов пишется в транзакцию этого теста
+        view_counter.flush_views()
+
+    def counters(self):
+        views = dict(Product.objects.values_list('id', 'view_count'))
+        daily = dict(ProductViewDaily.objects.values_list('product_id', 'views'))
+        return [(views[product.id], daily.get(product.id, 0)) for product in (self.first, self.second)]
+
+    def test_flush_adds_to_counters_in_batch(self):
+        before = self.counters()
+        for product_id in (self.first.id, self.first.id, self.second.id, 999999):
+            view_counter.record_view(product_id)
+        self.assertEqual(view_counter.pending_views()[self.first.id], 2)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(view_counter.flush_views(), 4)
+        statements = [query['sql'] for query in queries.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 2)
+        # Второй сброс (другой воркер) прибавляет к тем же строкам
+        view_counter.record_view(self.first.id)
+        view_counter.flush_views()
+
+        added = [(views - old_views, daily - old_daily)
+                 for (views, daily), (old_views, old_daily) in zip(self.counters(), before)]
+        self.assertEqual(added, [(3, 3), (1, 1)])
+        self.assertEqual(view_counter.pending_views(), {})
+
+    def test_product_save_keeps_views(self):
+        product = Product.objects.get(pk=self.first.pk)
+        view_counter.record_view(self.first.id)
+        view_counter.flush_views()
+        product.name = 'Новое название'
+        product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.name, 'Новое название')
+        self.assertEqual(product.view_count, self.counters()[0][1])
+
+    def test_product_save_keeps_popularity_and_deferred_fields(self):
+        stale = Product.objects.get(pk=self.first.pk)
+        Product.objects.filter(pk=self.first.pk).update(popularity_score=42)
+        stale.price = Decimal('777')
+        stale.save()
+
+        partial = Product.objects.only('id', 'name').get(pk=self.first.pk)
+        partial.name = 'Только название'
+        partial.save()
+        self.assertIn('description', partial.get_deferred_fields())
+
+        product = Product.objects.get(pk=self.first.pk)
+        self.assertEqual((product.name, product.price, product.popularity_score), ('Только название', 777, 42))
+
+    def test_product_page_records_view(self):
+        url = reverse('product_detail', args=[self.first.slug])
+        response = self.client.get(url)
+        self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(view_counter.pending_views(), {self.first.id: 2})
+
+
+@override_settings(PAGE_CACHE_TIMEOUT=0)
+class CatalogApiTests(TestCase):
+    """JSON API каталога (cloth.api)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Футболки', slug='t-shirts')
+        Category.objects.create(name='Скрытая', slug='hidden', is_active=False)
+        sizes = [Size.objects.create(name=name, order=order) for order, name in enumerate(['S', 'M'])]
+        colors = [Color.objects.create(name=name, hex_code=code) for name, code in [('Белый', '#FFFFFF'), ('Черный', '#000000')]]
+        cls.products = []
+        for i in range(7):
+            product = Product.objects.create(name=f'Футболка {i}', slug=f'product-{i}', description='',
+                                             price=Decimal(1000 + 100 * (i % 3)), category=cls.category)
+            ProductVariant.objects.create(product=product, size=sizes[i % 2], color=colors[0],
+                                          price=product.price, stock_quantity=i)
+            cls.products.append(product)
+        product = cls.products[0]
+        ProductVariant.objects.create(product=product, size=sizes[1], color=colors[1], price=product.price, stock_quantity=3)
+        ProductImage.objects.create(product=product, image='products/0.jpg', is_main=True, width=800, height=600)
+
+    def get(self, name, params=None, *args, **headers):
+        response = self.client.get(reverse(name, args=args), params or {}, **headers)
+        return response, response.json() if response.status_code != 304 else None
+
+    def test_categories_with_fieldset(self):
+        _, body = self.get('api_categories')
+        self.assertEqual(body['data'], [{'id': self.category.id, 'name': 'Футболки', 'slug': 't-shirts', 'products': 7}])
+        _, body = self.get('api_categories', {'fields': 'slug'})
+        self.assertEqual(body['data'], [{'slug': 't-shirts'}])
+
+    def test_cursor_pagination_visits_every_product_once(self):
+        for sort in ('price', '-price', '-created_at', 'name', 'popular'):
+            seen, cursor = [], None
+            while True:
+                params = {'sort': sort, 'limit': 3, 'fields': 'id,price'}
+                if cursor:
+                    params['cursor'] = cursor
+                response, body = self.get('api_products', params)
+                self.assertEqual(response.status_code, 200)
+                seen += [item['id'] for item in body['data']]
+                cursor = body['next_cursor']
+                if not cursor:
+                    break
+            self.assertCountEqual(seen, [product.id for product in self.products], sort)
+            if sort == 'price':
+                self.assertEqual(seen, [p.id for p in sorted(self.products, key=lambda p: (p.price, p.id))])
+
+    def test_sparse_fields_and_catalog_filters(self):
+        _, body = self.get('api_products', {'size': 'S', 'max_price': '1050', 'fields': 'name,image,url'})
+        self.assertEqual(body['data'], [
+            {'name': 'Футболка 6', 'image': None, 'url': 'http://testserver/product/product-6/'},
+            {'name': 'Футболка 0', 'image': 'http://testserver/media/products/0.jpg',
+             'url': 'http://testserver/product/product-0/'},
+        ])
+        _, body = self.get('api_products', {'q': 'futbolka 3', 'fields': 'slug'})
+        self.assertEqual(body['data'][0], {'slug': 'product-3'})
+
+    def test_product_detail_variant_matrix(self):
+        _, body = self.get('api_product_detail', {'fields': 'name,variants'}, 'product-0')
+        variants = body['data']['variants']
+        self.assertEqual(body['data']['name'], 'Футболка 0')
+        self.assertEqual(variants['sizes'], ['S', 'M'])
+        self.assertEqual([color['name'] for color in variants['colors']], ['Белый', 'Черный'])
+        ids = {(variant['size'], variant['color']): variant['id'] for variant in variants['variants']}
+        self.assertEqual(variants['matrix'], [[ids['S', 'Белый'], None], [None, ids['M', 'Черный']]])
+
+        _, body = self.get('api_product_detail', None, 'product-0')
+        self.assertEqual(body['data']['images'][0]['width'], 800)
+        self.assertEqual(self.get('api_product_detail', None, 'missing')[0].status_code, 404)
+
+    def test_variant_availability_net_of_unpaid_orders(self):
+        user = User.objects.create_user('buyer@example.com', 'password')
+        created = OrderStatus.objects.create(name='created')
+        paid = OrderStatus.objects.create(name='paid')
+        variant, other = ProductVariant.objects.filter(product=self.products[0]).order_by('id')
+        sold_out = ProductVariant.objects.get(product=self.products[1])
+        for status, quantity, age in ((created, 2, 0), (created, 5, 120), (paid, 1, 0)):
+            order = Order.objects.create(user=user, total_amount=Decimal('1000'), delivery_address='г. Москва',
+                                         status=status)
+            Order.objects.filter(id=order.id).update(created_at=timezone.now() - timedelta(minutes=age))
+            order.items.create(variant=other, quantity=quantity, price_per_unit=other.price)
+        sold_out.product.is_active = False
+        sold_out.product.save()
+
+        # Старый неоплаченный и оплаченный заказы товар не держат
+        with self.assertNumQueries(1):
+            response, body = self.get('api_variant_availability', {'ids': f'{other.id},{variant.id},{sold_out.id},999'})
+        self.assertEqual(response['Cache-Control'], 'public, max-age=5')
+        self.assertEqual(body['data'], {
+            str(variant.id): {'available': 0, 'price': '1000.00'},
+            str(other.id): {'available': 1, 'price': '1000.00'},
+        })
+
+        for params in ({}, {'ids': 'a,b'}, {'ids': ','.join(map(str, range(1, 302)))}):
+            self.assertEqual(self.get('api_variant_availability', params)[0].status_code, 400, params)
+
+    def test_etag_and_errors(self):
+        response, _ = self.get('api_products')
+        self.assertEqual(response['Cache-Control'], 'public, max-age=60')
+        cached, _ = self.get('api_products', None, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(cached.status_code, 304)
+
+        for params in ({'fields': 'id,secret'}, {'cursor': 'garbage'}, {'min_price': 'abc'}, {'sort': 'random'},
+                       {'sort': 'price', 'cursor': response.json()['next_cursor'] or 'x'}):
+            response, body = self.get('api_products', params)
+            self.assertEqual(response.status_code, 400, params)
+            self.assertIn('error', body)
+        self.assertEqual(self.client.post(reverse('api_products')).status_code, 405)
+
+
+@override_settings(SITE_URL='https://shop.example')
+class FeedsTests(TestCase):
+    """Sitemap и товарный фид (cloth.feeds)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Футболки', slug='t-shirts')
+        size = Size.objects.create(name='M')
+        cls.products = []
+        for i in range(5):
+            product = Product.objects.create(name=f'Футболка {i}', slug=f'product-{i}', description='Хлопок & лён',
+                                             price=Decimal(1000), category=category, material='Хлопок')
+            ProductVariant.objects.create(product=product, size=size, price=Decimal(1000 + i), stock_quantity=i,
+                                          sku=f'sku-{i}')
+            ProductImage.objects.create(product=product, image=f'products/{i}.jpg', is_main=True)
+            cls.products.append(product)
+        cls.chunk_size = 2
+        cls.first_chunk = cls.products[0].id // cls.chunk_size
+
+    def setUp(self):
+        feeds_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, feeds_dir, ignore_errors=True)
+        settings_override = override_settings(FEEDS_DIR=Path(feeds_dir))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.feeds_dir = Path(feeds_dir)
+
+    def build(self, **kwargs):
+        return build_feeds(chunk_size=self.chunk_size, **kwargs)
+
+    def test_files_are_valid_and_complete(self):
+        stats = self.build()
+        chunks = {product.id // self.chunk_size for product in self.products}
+        self.assertEqual((stats['chunks'], stats['urls'], stats['offers']), (len(chunks), 5, 5))
+
+        index = ElementTree.parse(self.feeds_dir / 'sitemap.xml').getroot()
+        locations = [element.text for element in index.iter(f'{{{SITEMAP_NS}}}loc')]
+        self.assertEqual(len(locations), len(chunks) + 1)
+        self.assertTrue(all(location.startswith('https://shop.example/feeds/sitemap-') for location in locations))
+
+        urls = []
+        for chunk in sorted(chunks):
+            urlset = ElementTree.parse(self.feeds_dir / f'sitemap-products-{chunk}.xml').getroot()
+            urls += [element.text for element in urlset.iter(f'{{{SITEMAP_NS}}}loc')]
+        self.assertEqual(urls, [f'https://shop.example/product/product-{i}/' for i in range(5)])
+
+        catalog = ElementTree.parse(self.feeds_dir / 'products.yml').getroot()
+        offers = catalog.findall('shop/offers/offer')
+        self.assertEqual([offer.findtext('price') for offer in offers], [f'{1000 + i}.00' for i in range(5)])
+        first = offers[0]
+        self.assertEqual(first.get('available'), 'false')
+        self.assertEqual(first.findtext('picture'), 'https://shop.example/media/products/0.jpg')
+        self.assertEqual(first.findtext('description'), 'Хлопок & лён')
+        self.assertEqual({param.get('name'): param.text for param in first.findall('param')},
+                         {'Размер': 'M', 'Материал': 'Хлопок'})
+        self.assertEqual(catalog.findtext('shop/categories/category'), 'Футболки')
+
+    def test_incremental_rebuild(self):
+        self.build()
+        unchanged = self.build()
+        self.assertEqual((unchanged['sitemaps_written'], unchanged['parts_written']), (0, 0))
+
+        # Остаток меняется через update() без updated_at -- фрагмент фида всё равно пересобирается
+        ProductVariant.objects.filter(product=self.products[0]).update(stock_quantity=7)
+        stats = self.build()
+        self.assertEqual((stats['sitemaps_written'], stats['parts_written'], stats['offers']), (0, 1, 1))
+        offer = ElementTree.parse(self.feeds_dir / 'products.yml').getroot().find('shop/offers/offer')
+        self.assertEqual(offer.findtext('count'), '7')
+
+        # Диапазон без активных товаров -- его файлы удаляются
+        Product.objects.filter(id__in=[product.id for product in self.products
+                                       if product.id // self.chunk_size == self.first_chunk]).update(is_active=False)
+        stats = self.build()
+        self.assertEqual(stats['removed'], 2)
+        self.assertFalse((self.feeds_dir / f'sitemap-products-{self.first_chunk}.xml').exists())
+        self.assertEqual(self.build(full=True)['sitemaps_written'], stats['chunks'])
+
+    def test_served_with_conditional_get(self):
+        self.assertEqual(self.client.get(reverse('sitemap')).status_code, 404)
+        self.build()
+        response = self.client.get(reverse('sitemap'))
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<sitemapindex', b''.join(response.streaming_content))
+        cached = self.client.get(reverse('sitemap'), HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(cached.status_code, 304)
+        self.assertEqual(self.client.get(reverse('feed_file', args=['products.yml'])).status_code, 200)
+        for name in ('state.json', 'offers-0.xml', '..'):
+            self.assertEqual(self.client.get(reverse('feed_file', args=[name])).status_code, 404)
+
+
+@override_settings(SEARCH_LOG_FLUSH_SECONDS=3600, SEARCH_LOG_MAX_PENDING=1000)
+class SearchLogTests(TestCase):
+    """Журнал поиска каталога (cloth.search_log)"""
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Куртки', slug='jackets')
+        cls.product = Product.objects.create(name='Куртка синяя', slug='jacket', description='', price=Decimal(1000),
+                                             category=category)
+        ProductVariant.objects.create(product=cls.product, price=cls.product.price, stock_quantity=5, sku='sku-jacket')
+
+    def setUp(self):
+        # Остаток буфера от других тестов пишется в транзакцию этого теста
+        search_log.flush_search_log()
+        SearchQuery.objects.all().delete()
+        cache.clear()
+
+    def test_buffered_and_written_in_one_query(self):
+        search_log.record_search('  Куртка ', 3, 12.345)
+        search_log.record_search('пальто', 0, 4.0)
+        search_log.record_search('   ', 0, 1.0)
+        self.assertEqual(SearchQuery.objects.count(), 0)
+        self.assertEqual([event.query for event in search_log.pending_events()], ['куртка', 'пальто'])
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(search_log.flush_search_log(), 2)
+        statements = [query['sql'] for query in queries.captured_queries if 'SAVEPOINT' not in query['sql']]
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(search_log.pending_events(), [])
+        self.assertEqual(
+            sorted(SearchQuery.objects.values_list('query', 'results', 'duration_ms')),
+            [('куртка', 3, 12.35), ('пальто', 0, 4.0)],
+        )
+
+    def test_failed_flush_keeps_events(self):
+        search_log.record_search('куртка', 1, 5.0)
+        with mock.patch.object(SearchQuery.objects, 'bulk_create', side_effect=DatabaseError('deadlock')):
+            self.assertEqual(search_log.flush_search_log(), 0)
+        self.assertEqual(len(search_log.pending_events()), 1)
+        self.assertEqual(search_log.flush_search_log(), 1)
+
+    @override_settings(PAGE_CACHE_TIMEOUT=60)
+    def test_catalog_searches_logged_with_cache_hits(self):
+        catalog = reverse('catalog')
+        self.client.get(catalog, {'q': 'kurtka'})
+        response = self.client.get(catalog, {'q': 'kurtka'})
+        self.assertEqual(response['X-Page-Cache'], 'hit')
+        # Листание выдачи и каталог без поиска не учитываются
+        self.client.get(catalog, {'q': 'kurtka', 'page': '2'})
+        self.client.get(catalog)
+        self.client.get(catalog, {'q': 'пальто'})
+        events = [(event.kind, event.query, event.results) for event in search_log.pending_events()]
+        self.assertEqual(events, [('search', 'kurtka', 1), ('search', 'kurtka', 1), ('search', 'пальто', 0)])
+
+    def test_click_from_search_results(self):
+        url = reverse('product_detail', args=[self.product.slug])
+        self.client.get(url, HTTP_REFERER=f"http://testserver{reverse('catalog')}?q=%D0%BA%D1%83%D1%80%D1%82%D0%BA%D0%B0")
+        self.client.get(url, HTTP_REFERER=f"http://testserver{reverse('catalog')}?category=jackets")
+        self.client.get(url, HTTP_REFERER=f"http://example.com{reverse('catalog')}?q=spam")
+        self.assertEqual(
+            [(event.kind, event.query, event.clicked_product_id) for event in search_log.pending_events()],
+            [('click', 'куртка', self.product.id)],
+        )
+
+        # Товар удалён, пока событие ждало в буфере
+        search_log.record_click('куртка', 999999)
+        search_log.flush_search_log()
+        self.assertCountEqual(SearchQuery.objects.values_list('clicked_product_id', flat=True), [self.product.id, None])
+
+    def test_report(self):
+        rows = [('куртка', 5, 20.0)] * 3 + [('пальто', 0, 15.0)] * 2 + [('шуба', 0, 900.0)]
+        SearchQuery.objects.bulk_create([
+            SearchQuery(query=query, results=results, duration_ms=duration) for query, results, duration in rows
+        ] + [SearchQuery(kind='click', query='куртка', clicked_product=self.product)])
+        SearchQuery.objects.create(query='старый', results=0, duration_ms=1.0,
+                                   created_at=timezone.now() - timedelta(days=30))
+
+        report = search_log.search_report(timezone.now() - timedelta(days=7), slow_ms=500)
+        self.assertEqual((report['searches'], report['clicks'], report['zero_results']), (6, 1, 3))
+        self.assertEqual([(row['query'], row['searches'], row['clicks']) for row in report['top']],
+                         [('куртка', 3, 1), ('пальто', 2, 0), ('шуба', 1, 0)])
+        self.assertEqual([row['query'] for row in report['zero']], ['пальто', 'шуба'])
+        self.assertEqual([row['query'] for row in report['slow']], ['шуба'])
+
+        output = StringIO()
+        call_command('search_report', stdout=output)
+        self.assertIn('шуба', output.getvalue())
+
+
+class GenerateLoadDataTests(TestCase):
+    """Генерация нагрузочных данных (generate_load_data) на маленьком наборе"""
+
+    def test_small_dataset(self):
+        output = StringIO()
+        call_command('generate_load_data', products=12, users=6, orders=10, reviews=8, days=30,
+                     batch_size=5, seed=7, stdout=output)
+        self.assertIn('✅ Всего:', output.getvalue())
+
+        products = Product.objects.filter(slug__startswith='load7-')
+        self.assertEqual(products.count(), 12)
+        self.assertEqual(Order.objects.filter(order_number__startswith='LOAD7-').count(), 10)
+        self.assertTrue(ProductVariant.objects.filter(product__in=products).exists())
+        self.assertTrue(Review.objects.filter(product__in=products).exists())
+        self.assertTrue(ProductImage.objects.filter(product__in=products).exists())
+
+        # Даты из генератора, а не время вставки; created_at и updated_at совпадают
+        dates = list(products.values_list('created_at', 'updated_at'))
+        self.assertGreater(len({created_at for created_at, _ in dates}), 1)
+        self.assertTrue(all(created_at == updated_at for created_at, updated_at in dates))
+        self.assertTrue(all(timezone.now() - created_at < timedelta(days=30) for created_at, _ in dates))
+        for transaction_ in Transaction.objects.select_related('order'):
+            self.assertEqual(transaction_.created_at, transaction_.order.created_at)
+
+        # auto_now снова работает как обычно
+        product = products.first()
+        product.save()
+        product.refresh_from_db()
+        self.assertGreater(product.updated_at, product.created_at)
+
+        with self.assertRaises(CommandError):
+            call_command('generate_load_data', products=1, users=1, orders=0, reviews=0, seed=7, stdout=StringIO())
+
+    def test_auto_now_restored_after_error(self):
+        with mock.patch('cloth.management.commands.generate_load_data.Command.create_users',
+                        side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                call_command('generate_load_data', products=2, users=1, orders=0, reviews=0, stdout=StringIO())
+        self.assertTrue(Product._meta.get_field('created_at').auto_now_add)
+        self.assertTrue(Product._meta.get_field('updated_at').auto_now)
+
+    def test_no_images_without_source_files(self):
+        media_root = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        (media_root / 'products').mkdir()
+        output = StringIO()
+        with override_settings(MEDIA_ROOT=media_root):
+            call_command('generate_load_data', products=3, users=2, orders=2, reviews=1, seed=8, stdout=output)
+        self.assertIn('изображения не создаются', output.getvalue())
+        self.assertEqual(Product.objects.filter(slug__startswith='load8-').count(), 3)
+        self.assertFalse(ProductImage.objects.exists())
+
+
+class ResetProductsTests(TestCase):
+    """reset_products: исправление slug'ов сбрасывает кэш каталога и карточек"""
+
+    def test_fix_all_slugs_invalidates_cache(self):
+        category = Category.objects.create(name='Рубашки', slug='shirts')
+        product = Product.objects.create(name='Рубашка', slug='rubashka oversize!', description='',
+                                         price=Decimal(1000), category=category)
+        catalog_version = get_catalog_version()
+        _, card_versions = get_card_versions([product.id])
+
+        ResetProductsCommand(stdout=StringIO()).fix_all_slugs()
+
+        fixed = Product.objects.get(id=product.id)
+        self.assertEqual(fixed.slug, 'rubashka-oversize')
+        self.assertGreater(fixed.updated_at, product.updated_at)
+        self.assertNotEqual(get_catalog_version(), catalog_version)
+        self.assertNotEqual(get_card_versions([product.id])[1], card_versions)
+
+
+def tearDownModule():
+    # Остаток буфера пишется в тестовую базу, а не при выходе из процесса
+    view_counter.flush_views()
+    search_log.flush_search_log()
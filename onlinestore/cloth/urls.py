@@ -1,10 +1,21 @@
 from django.urls import path
-from . import views
+from . import api, views
 
 urlpatterns = [
     # Главная и каталог
     path('', views.home, name='home'),
     path('catalog/', views.catalog, name='catalog'),
+    path('search/suggest/', views.search_suggest, name='search_suggest'),
+
+    # JSON API каталога (только чтение)
+    path('api/v1/categories/', api.categories, name='api_categories'),
+    path('api/v1/products/', api.products, name='api_products'),
+    path('api/v1/products/<slug:slug>/', api.product_detail, name='api_product_detail'),
+    path('api/v1/variants/availability/', api.availability, name='api_variant_availability'),
+
+    # Sitemap и товарный фид (manage.py build_feeds)
+    path('sitemap.xml', views.feed_file, {'name': 'sitemap.xml'}, name='sitemap'),
+    path('feeds/<str:name>', views.feed_file, name='feed_file'),
     path('product/<slug:slug>/', views.product_detail, name='product_detail'),
     path('product/<int:product_id>/review/', views.add_review, name='add_review'),
 
@@ -51,6 +62,7 @@ path('manage/product/<int:product_id>/delete/', views.delete_product, name='dele
     # Управление заказами
     path('manage/orders/', views.manage_orders, name='manage_orders'),
     path('manage/order/<int:order_id>/update-status/', views.update_order_status, name='update_order_status'),
+    path('manage/order/<int:order_id>/refund/', views.refund_order, name='refund_order'),
 
     # Админ панель (изменено с /admin/dashboard/ на /dashboard/)
     path('dashboard/', views.admin_dashboard, name='admin_dashboard'),
@@ -70,4 +82,10 @@ path('manage/product/<int:product_id>/delete/', views.delete_product, name='dele
     path('export/orders/utf8/', views.export_orders_utf8, name='export_orders_utf8'),
     path('export/orders/excel/', views.export_orders_excel, name='export_orders_excel'),
     path('export/orders/csv-windows/', views.export_orders_csv_windows, name='export_orders_csv_windows'),
+
+    # Метрики Prometheus
+    path('metrics', views.metrics_view, name='metrics'),
+
+    # Изображения нужного размера по запросу
+    path('img/<int:width>x<int:height>/<path:path>', views.resized_image, name='resized_image'),
 ]
@@ -0,0 +1,111 @@
+"""
+Счётчики просмотров товаров
+
+Просмотр страницы товара не пишет в базу сразу: record_view() увеличивает
+счётчик в памяти процесса, а flush_views() раз в VIEW_COUNTER_FLUSH_SECONDS
+(или при VIEW_COUNTER_MAX_PENDING разных товаров в буфере) переносит
+накопленное в базу двумя пакетными запросами в одной транзакции:
+
+  WITH v(id, views) AS (VALUES (...), ...)
+  UPDATE cloth_product SET view_count = view_count + v.views FROM v WHERE ...
+
+и такой же INSERT ... ON CONFLICT DO UPDATE в ProductViewDaily.
+
+У каждого воркера gunicorn свой буфер. Запросы только прибавляют к значению
+в строке, поэтому сбросы разных воркеров не затирают друг друга. Если сброс
+не удался (например, взаимная блокировка с другим воркером), счётчики
+возвращаются в буфер и уходят со следующим сбросом. Перед завершением воркера
+буфер сбрасывается (worker_exit в gunicorn.conf.py и atexit).
+"""
+from collections import Counter
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.utils import timezone
+
+from .models import Product, ProductViewDaily
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_pending = Counter()
+_last_flush = time.monotonic()
+# Буфер, унаследованный при fork, принадлежит родителю
+_pid = os.getpid()
+
+
+def record_view(product_id):
+    """Учесть просмотр товара (сброс в базу -- когда подойдёт срок)"""
+    global _pending, _last_flush, _pid
+    with _lock:
+        if _pid != os.getpid():
+            _pending, _pid, _last_flush = Counter(), os.getpid(), time.monotonic()
+        _pending[product_id] += 1
+        due = (len(_pending) >= settings.VIEW_COUNTER_MAX_PENDING
+               or time.monotonic() - _last_flush >= settings.VIEW_COUNTER_FLUSH_SECONDS)
+    if due:
+        flush_views()
+
+
+def pending_views():
+    """Ещё не сброшенные просмотры этого процесса: {product_id: количество}"""
+    with _lock:
+        return dict(_pending)
+
+
+def flush_views():
+    """
+    Перенести накопленные просмотры в базу
+
+    Returns:
+        int: сколько просмотров записано
+    """
+    global _pending, _last_flush
+    with _lock:
+        pending, _pending = _pending, Counter()
+        _last_flush = time.monotonic()
+    if not pending:
+        return 0
+
+    # Одинаковый порядок строк во всех воркерах снижает риск взаимных блокировок
+    rows = sorted(pending.items())
+    try:
+        _write(rows, timezone.localdate())
+    except DatabaseError as e:
+        logger.warning(f"View counters flush failed, will retry: {e}")
+        with _lock:
+            _pending.update(pending)
+        return 0
+    return sum(pending.values())
+
+
+def _write(rows, day):
+    product_table = Product._meta.db_table
+    daily_table = ProductViewDaily._meta.db_table
+    values = ', '.join(['(%s, %s)'] * len(rows))
+    params = [value for row in rows for value in row]
+
+    connection = connections[DEFAULT_DB_ALIAS]
+    with transaction.atomic(using=DEFAULT_DB_ALIAS), connection.cursor() as cursor:
+        cursor.execute(
+            f'WITH v(id, views) AS (VALUES {values}) '
+            f'UPDATE {product_table} SET view_count = {product_table}.view_count + v.views '
+            f'FROM v WHERE {product_table}.id = v.id',
+            params,
+        )
+        # WHERE нужен и как фильтр удалённых товаров, и для разбора ON CONFLICT в SQLite
+        cursor.execute(
+            f'WITH v(id, views) AS (VALUES {values}) '
+            f'INSERT INTO {daily_table} (product_id, day, views) '
+            f'SELECT v.id, %s, v.views FROM v WHERE v.id IN (SELECT id FROM {product_table}) '
+            f'ON CONFLICT (product_id, day) DO UPDATE SET views = {daily_table}.views + excluded.views',
+            params + [connection.ops.adapt_datefield_value(day)],
+        )
+
+
+atexit.register(flush_views)
@@ -2,22 +2,35 @@ from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.views.decorators.csrf import csrf_exempt  # Добавлен этот импорт
-from django.http import JsonResponse, HttpResponse
-from django.db.models import Q, Count, Avg, Min, Max, Sum
+from django.http import JsonResponse, HttpResponse, FileResponse, Http404
+from django.db.models import Q, Count, Avg, Min, Max, Sum, OuterRef, Subquery
 from django.contrib import messages
 from django.core.paginator import Paginator
 from django.utils import timezone
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from django.core.exceptions import SuspiciousFileOperation
 from django.conf import settings  # Добавлен этот импорт
 from datetime import timedelta
 from .models import (
     Product, ProductVariant, Category, Cart, CartItem,
     Wishlist, Order, OrderStatus, Review, User, Role,
     DeliveryMethod, Transaction, TransactionStatus,
-    Size, Color, Gender, ProductImage, OrderItem
+    Size, Color, Gender, ProductImage, OrderItem, ProductRecommendation, ProductRanking
 )
 from .forms import RegisterForm, LoginForm, CheckoutForm, ReviewForm, UserProfileForm, ChangePasswordForm
 from .payments import PaymentService  # Импорт сервиса платежей
+from . import feeds, metrics, search, search_log, suggest
+from .cache import cache_anonymous_page, template_version
+from .db_router import replica_reads
+from .similarity import index_modified, similar_product_ids
+from .view_counter import record_view
+from .images import delete_renditions, get_resize_cache, RESIZE_EXTENSIONS, RESIZE_FORMATS
+import hashlib
+import hmac
 import logging
+import os
 from decimal import Decimal
 import uuid
 import csv
@@ -42,21 +55,20 @@ def is_admin(user):
 
 
 # --- ГЛАВНАЯ И КАТАЛОГ ---
+@cache_anonymous_page()
+@replica_reads
 def home(request):
-    """Главная страница с новинками"""
-    products = Product.objects.filter(is_active=True).select_related(
-        'category'
-    ).prefetch_related(
-        'variants', 'images'
-    ).order_by('-created_at')[:8]
-
-    new_products = Product.objects.filter(
-        is_active=True, is_new=True
-    ).select_related('category')[:4]
-
-    bestsellers = Product.objects.filter(
-        is_active=True, is_bestseller=True
-    ).select_related('category')[:4]
+    """Главная страница: хиты продаж и новинки"""
+    # Обе подборки одним запросом (manage.py rank_products); изображения
+    # и варианты подгружаются только для карточек, которых нет в кэше
+    rankings = ProductRanking.objects.filter(product__is_active=True).select_related('product')
+    bestsellers, products = [], []
+    for ranking in rankings:
+        (bestsellers if ranking.list_name == 'bestsellers' else products).append(ranking.product)
+
+    # Рейтинг ещё не считался -- последние добавленные товары
+    if not products:
+        products = Product.objects.filter(is_active=True).order_by('-created_at')[:8]
 
     # Получаем список ID товаров в избранном для текущего пользователя
     wishlist_ids = []
@@ -65,61 +77,81 @@ def home(request):
 
     return render(request, "pages/home.html", {
         "products": products,
-        "new_products": new_products,
         "bestsellers": bestsellers,
         "wishlist_ids": wishlist_ids,  # Добавляем в контекст
     })
 
 
-def catalog(request):
-    """Каталог товаров с фильтрацией"""
-    categories = Category.objects.filter(is_active=True)
-    products = Product.objects.filter(is_active=True).select_related(
-        'category', 'gender'
-    ).prefetch_related('variants', 'images')
-
-    # Получаем все размеры и цвета для фильтров
-    sizes = Size.objects.all().order_by('order')
-    colors = Color.objects.all()
-
-    # Получаем выбранные значения из GET параметров
-    selected_sizes = request.GET.getlist('size')
-    selected_colors = request.GET.getlist('color')
+def filter_catalog(products, params):
+    """
+    Фильтры каталога из GET-параметров (общие для страницы каталога и API)
 
+    Returns:
+        tuple: (queryset, выражение сортировки по релевантности или None без поиска)
+    """
     # Фильтрация по категории
-    cat_slug = request.GET.get('category')
+    cat_slug = params.get('category')
     if cat_slug:
         products = products.filter(category__slug=cat_slug)
 
     # Фильтрация по размеру
+    selected_sizes = params.getlist('size')
     if selected_sizes:
         products = products.filter(variants__size__name__in=selected_sizes)
 
     # Фильтрация по цвету
+    selected_colors = params.getlist('color')
     if selected_colors:
         products = products.filter(variants__color__name__in=selected_colors)
 
     # Фильтрация по цене
-    min_price = request.GET.get('min_price')
+    min_price = params.get('min_price')
     if min_price:
         products = products.filter(price__gte=min_price)
 
-    max_price = request.GET.get('max_price')
+    max_price = params.get('max_price')
     if max_price:
         products = products.filter(price__lte=max_price)
 
-    # Поиск
-    q = request.GET.get('q')
+    # Поиск с опечатками и транслитом (cloth.search)
+    q = params.get('q')
+    relevance = None
     if q:
-        products = products.filter(
-            Q(name__icontains=q) |
-            Q(description__icontains=q) |
-            Q(category__name__icontains=q)
-        )
+        products, relevance = search.search_products(products, q)
+    return products, relevance
+
+
+def catalog_default_sort(query):
+    """Сортировка каталога по умолчанию: при поиске -- по релевантности"""
+    return 'relevance' if query.get('q', '').strip() else '-created_at'
+
+
+@search_log.log_search
+@cache_anonymous_page(lists=('size', 'color'), defaults={'sort': catalog_default_sort})
+@replica_reads
+def catalog(request):
+    """Каталог товаров с фильтрацией"""
+    categories = Category.objects.filter(is_active=True)
+    products = Product.objects.filter(is_active=True)
+
+    # Получаем все размеры и цвета для фильтров
+    sizes = Size.objects.all().order_by('order')
+    colors = Color.objects.all()
+
+    # Получаем выбранные значения из GET параметров
+    selected_sizes = request.GET.getlist('size')
+    selected_colors = request.GET.getlist('color')
+    cat_slug = request.GET.get('category')
+    products, relevance = filter_catalog(products, request.GET)
 
     # Сортировка
-    sort = request.GET.get('sort', '-created_at')
-    if sort in ['price', '-price', 'name', '-name', 'created_at', '-created_at']:
+    sort = request.GET.get('sort') or catalog_default_sort(request.GET)
+    if sort == 'relevance':
+        products = products.order_by(relevance, '-id') if relevance is not None else products.order_by('-created_at')
+    elif sort == 'popular':
+        # Индекс (popularity_score, id); id -- для стабильного порядка страниц
+        products = products.order_by('-popularity_score', '-id')
+    elif sort in ['price', '-price', 'name', '-name', 'created_at', '-created_at']:
         products = products.order_by(sort)
 
     # Пагинация
@@ -152,9 +184,113 @@ def catalog(request):
         'wishlist_ids': wishlist_ids,  # Добавляем в контекст
     }
 
-    return render(request, "pages/catalog.html", context)
+    response = render(request, "pages/catalog.html", context)
+    if relevance is not None:
+        # Для журнала поиска (search_log.log_search), сохраняется и в кэше страниц
+        response[search_log.RESULTS_HEADER] = page_obj.paginator.count
+    return response
+
+
+@replica_reads
+def search_suggest(request):
+    """Подсказки для поля поиска каталога (JSON)"""
+    query = request.GET.get('q', '')[:100]
+    try:
+        limit = min(max(int(request.GET.get('limit', suggest.DEFAULT_LIMIT)), 1), suggest.MAX_LIMIT)
+    except ValueError:
+        limit = suggest.DEFAULT_LIMIT
+
+    suggestions = suggest.get_index().suggest(query, limit) if query.strip() else []
+    response = JsonResponse({'query': query, 'suggestions': suggestions})
+    # Ответ не зависит от посетителя: браузер и прокси могут переиспользовать его
+    response['Cache-Control'] = 'public, max-age=60'
+    return response
+
+
+def _product_validators(slug):
+    """
+    Версия и дата изменения страницы товара одним агрегирующим запросом
+
+    Учитываются сам товар, его варианты (включая остатки: они меняются
+    через update() без updated_at), изображения, промодерированные отзывы
+    и блок рекомендаций (пересчёт таблицы, изменения рекомендуемых товаров
+    и перестроение индекса похожих товаров).
+    Количество строк ловит удаления, максимальный updated_at -- изменения.
+
+    Returns:
+        tuple: (product_id, version, last_modified) или None, если товар не найден
+    """
+    def related(model, expression, **filters):
+        rows = model.objects.filter(product=OuterRef('pk'), **filters).order_by().values('product')
+        return Subquery(rows.annotate(value=expression).values('value'))
+
+    row = Product.objects.filter(slug=slug, is_active=True).annotate(
+        variants_updated=related(ProductVariant, Max('updated_at')),
+        variants_count=related(ProductVariant, Count('id')),
+        variants_stock=related(ProductVariant, Sum('stock_quantity')),
+        images_updated=related(ProductImage, Max('updated_at')),
+        images_count=related(ProductImage, Count('id')),
+        reviews_updated=related(Review, Max('updated_at'), is_moderated=True),
+        reviews_count=related(Review, Count('id'), is_moderated=True),
+        recommendations_built=related(ProductRecommendation, Max('created_at')),
+        recommended_updated=related(ProductRecommendation, Max('recommended__updated_at')),
+    ).values(
+        'id', 'updated_at', 'variants_updated', 'variants_count', 'variants_stock',
+        'images_updated', 'images_count', 'reviews_updated', 'reviews_count',
+        'recommendations_built', 'recommended_updated',
+    ).order_by().first()
+    if row is None:
+        return None
+
+    similarity_built = index_modified()
+    last_modified = max(
+        value for value in (
+            row['updated_at'], row['variants_updated'], row['images_updated'], row['reviews_updated'],
+            row['recommendations_built'], row['recommended_updated'], similarity_built,
+        )
+        if value is not None
+    )
+    # Разметка тоже часть версии страницы: после деплоя шаблонов ETag меняется
+    parts = [str(value) for value in row.values()] + [str(similarity_built)]
+    parts += [template_version('pages/product_detail.html'), template_version('base.html')]
+    return row['id'], hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest(), last_modified
+
+
+def _product_etag(request, version):
+    """ETag страницы: токен CSRF в её формах привязан к cookie посетителя"""
+    salt = request.META.get('CSRF_COOKIE', '')
+    return '"%s"' % hashlib.md5(f'{version}|{salt}'.encode('utf-8')).hexdigest()
 
+
+def _record_product_view(request, product_id):
+    """Просмотр товара и, если пришли из выдачи каталога, переход по запросу"""
+    record_view(product_id)
+    query = search_log.referring_query(request)
+    if query:
+        search_log.record_click(query, product_id)
+
+
+@replica_reads
 def product_detail(request, slug):
+    # Условный GET для анонимных посетителей: при совпадении ETag -- 304
+    # без загрузки вариантов и рендеринга. У вошедших на странице личные данные
+    # (избранное, возможность отзыва, корзина), поэтому страница отдаётся целиком.
+    validators = None
+    if (request.method in ('GET', 'HEAD') and not request.user.is_authenticated
+            and not len(messages.get_messages(request))):
+        validators = _product_validators(slug)
+        if validators is None:
+            raise Http404('Товар не найден')
+        product_id, version, last_modified = validators
+        not_modified = get_conditional_response(
+            request, etag=_product_etag(request, version), last_modified=int(last_modified.timestamp())
+        )
+        if not_modified is not None:
+            # Повторный просмотр без изменений -- тоже просмотр
+            if request.method == 'GET':
+                _record_product_view(request, product_id)
+            return not_modified
+
     product = get_object_or_404(
         Product.objects.select_related('category', 'gender').prefetch_related(
             'variants__size', 'variants__color', 'images'  # ✅ Загружаем и размеры, и цвета
@@ -170,21 +306,30 @@ def product_detail(request, slug):
     reviews = product.reviews.filter(is_moderated=True).select_related('user').order_by('-created_at')
     avg_rating = product.get_average_rating()
 
-    # Похожие товары
-    related_products = Product.objects.filter(
-        category=product.category,
-        is_active=True
-    ).exclude(
-        id=product.id
-    ).select_related('category')[:4]
-
-    # Проверка в избранном
-    in_wishlist = False
+    # С этим товаром покупают: готовый top-k из ProductRecommendation
+    # (manage.py build_recommendations), одна выборка по индексу (product, rank)
+    related_products = list(
+        Product.objects.filter(recommended_for__product=product, is_active=True)
+        .order_by('recommended_for__rank')[:4]
+    )
+    # Товар добавлен после пересчёта рекомендаций -- похожие по описанию
+    # из индекса в памяти воркера (cloth.similarity)
+    if len(related_products) < 4:
+        shown = {related.id for related in related_products}
+        similar_ids = [similar for similar in similar_product_ids(product.id) if similar not in shown]
+        similar_ids = similar_ids[:4 - len(related_products)]
+        if similar_ids:
+            similar = Product.objects.filter(is_active=True).in_bulk(similar_ids)
+            related_products += [similar[similar_id] for similar_id in similar_ids if similar_id in similar]
+
+    # Избранное: сам товар и рекомендации одним запросом
+    wishlist_ids = set()
     if request.user.is_authenticated:
-        in_wishlist = Wishlist.objects.filter(
+        wishlist_ids = set(Wishlist.objects.filter(
             user=request.user,
-            product=product
-        ).exists()
+            product_id__in=[product.id] + [related.id for related in related_products]
+        ).values_list('product_id', flat=True))
+    in_wishlist = product.id in wishlist_ids
 
     # Форма отзыва
     review_form = ReviewForm()
@@ -211,11 +356,20 @@ def product_detail(request, slug):
         'avg_rating': avg_rating,
         'related_products': related_products,
         'in_wishlist': in_wishlist,
+        'wishlist_ids': wishlist_ids,
         'review_form': review_form,
         'can_review': can_review,
     }
 
-    return render(request, "pages/product_detail.html", context)
+    response = render(request, "pages/product_detail.html", context)
+    if validators is not None:
+        # Если рендеринг выдал новый токен CSRF, ETag считается уже с ним
+        response['ETag'] = _product_etag(request, version)
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+        response['Cache-Control'] = 'private, no-cache'
+    if request.method == 'GET':
+        _record_product_view(request, product.id)
+    return response
 
 
 @login_required
@@ -411,13 +565,14 @@ def clear_cart(request):
 @login_required
 def wishlist_view(request):
     """Просмотр избранного"""
-    items = Wishlist.objects.filter(user=request.user).select_related(
-        'product', 'product__category'
-    ).prefetch_related(
-        'product__images', 'product__variants'
-    ).order_by('-added_at')
+    items = Wishlist.objects.filter(user=request.user).select_related('product').order_by('-added_at')
+    products = [item.product for item in items]
 
-    return render(request, "pages/wishlist.html", {"wishlist_items": items})
+    return render(request, "pages/wishlist.html", {
+        "wishlist_items": items,
+        "products": products,
+        "wishlist_ids": [product.id for product in products],
+    })
 
 
 # --- ЗАКАЗЫ ---
@@ -427,6 +582,8 @@ def checkout(request):
     cart = get_object_or_404(Cart, user=request.user)
 
     if cart.get_total_items() == 0:
+        if request.method == "POST":
+            metrics.record_checkout('failure')
         messages.error(request, 'Корзина пуста')
         return redirect('cart')
 
@@ -461,6 +618,8 @@ def checkout(request):
             order.payment_method = payment_method
             order.save()
 
+            metrics.record_checkout('success', payment_method)
+
             if payment_method == 'yookassa':
                 # Онлайн-оплата через ЮKassa
                 # Не очищаем корзину и не уменьшаем склад - это произойдет после оплаты
@@ -493,6 +652,8 @@ def checkout(request):
 
                 messages.success(request, 'Заказ оформлен! Оплата наличными при получении.')
                 return redirect('order_detail', order_id=order.id)
+        else:
+            metrics.record_checkout('failure')
     else:
         initial = {}
         if request.user.orders.exists():
@@ -590,6 +751,75 @@ def payment_result(request, order_id):
     return redirect('order_detail', order_id=order.id)
 
 
+def _metrics_authorized(request):
+    """
+    Доступ к /metrics
+
+    С METRICS_TOKEN -- только с заголовком Authorization: Bearer <токен>.
+    Без него -- только прямые подключения с METRICS_ALLOWED_IPS: за nginx
+    REMOTE_ADDR -- адрес прокси, поэтому запросы с X-Forwarded-For/X-Real-IP
+    отклоняются, иначе разрешение адреса прокси открыло бы метрики всем.
+    """
+    if settings.METRICS_TOKEN:
+        expected = f'Bearer {settings.METRICS_TOKEN}'.encode()
+        return hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', '').encode(), expected)
+    if 'HTTP_X_FORWARDED_FOR' in request.META or 'HTTP_X_REAL_IP' in request.META:
+        return False
+    return request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+
+
+def metrics_view(request):
+    """Метрики в формате Prometheus (доступ -- см. _metrics_authorized)"""
+    if not _metrics_authorized(request):
+        return HttpResponse(status=403)
+
+    if not metrics.is_available():
+        return HttpResponse('prometheus_client не установлен', status=503, content_type='text/plain; charset=utf-8')
+
+    return HttpResponse(metrics.render_latest(), content_type=metrics.CONTENT_TYPE_LATEST)
+
+
+def resized_image(request, width, height, path):
+    """
+    Изображение из MEDIA_ROOT, вписанное в width x height
+
+    Копия строится при первом запросе и кэшируется на диске
+    (cloth.images.ResizeCache). Браузерам, принимающим WebP, отдаётся WebP.
+    Размер -- только из IMAGE_RESIZE_SIZES.
+    """
+    if (width, height) not in settings.IMAGE_RESIZE_SIZES:
+        raise Http404('Недопустимый размер')
+
+    source_format = RESIZE_EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    try:
+        source_path = safe_join(settings.MEDIA_ROOT, path)
+    except SuspiciousFileOperation:
+        raise Http404('Изображение не найдено')
+    if source_format is None or not os.path.isfile(source_path):
+        raise Http404('Изображение не найдено')
+
+    accepts_webp = 'image/webp' in request.META.get('HTTP_ACCEPT', '')
+    fmt = 'WEBP' if accepts_webp else source_format
+    cache = get_resize_cache()
+    key = cache.key(source_path, width, height, fmt)
+    etag = f'"{key}"'
+
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        try:
+            cached_path, hit = cache.get_or_create(source_path, width, height, fmt, key=key)
+        except Exception as e:
+            logger.warning(f"Failed to resize {path} to {width}x{height}: {e}")
+            raise Http404('Не удалось обработать изображение')
+        metrics.record_cache('image_resize', hit)
+        response = FileResponse(open(cached_path, 'rb'), content_type=RESIZE_FORMATS[fmt][1])
+
+    response['ETag'] = etag
+    response['Cache-Control'] = f'public, max-age={settings.IMAGE_CACHE_MAX_AGE}'
+    patch_vary_headers(response, ('Accept',))
+    return response
+
+
 @csrf_exempt
 def yookassa_webhook(request):
     """Webhook для получения уведомлений от ЮKassa"""
@@ -1117,6 +1347,59 @@ def update_order_status(request, order_id):
     return redirect('manage_orders')
 
 
+@user_passes_test(is_admin)
+def refund_order(request, order_id):
+    """Частичный возврат по позициям заказа"""
+    order = get_object_or_404(Order.objects.select_related('status', 'user'), id=order_id)
+    refund_service = payment_service.refunds
+
+    transaction = order.transactions.filter(
+        status__name__in=['succeeded', 'refunded']
+    ).select_related('status').order_by('-created_at').first()
+
+    if request.method == 'POST':
+        if transaction is None or transaction.status.name != 'succeeded':
+            messages.error(request, 'По заказу нет оплаченной транзакции для возврата')
+            return redirect('refund_order', order_id=order.id)
+
+        quantities = {}
+        for key, value in request.POST.items():
+            if key.startswith('quantity_'):
+                try:
+                    quantities[int(key[len('quantity_'):])] = int(value or 0)
+                except ValueError:
+                    continue
+
+        try:
+            refund = refund_service.create_refund(
+                transaction,
+                quantities,
+                user=request.user,
+                reason=request.POST.get('reason', '')
+            )
+        except ValueError as e:
+            messages.error(request, str(e))
+            return redirect('refund_order', order_id=order.id)
+
+        refund_service.submit_refund(refund)
+
+        if refund.status == 'succeeded':
+            messages.success(request, f'Возврат на сумму {refund.amount} ₽ выполнен, товар возвращён на склад')
+        elif refund.status == 'pending':
+            messages.info(request, f'Возврат на сумму {refund.amount} ₽ отправлен, ожидаем подтверждение ЮKassa')
+        else:
+            messages.error(request, 'ЮKassa отклонила возврат')
+
+        return redirect('refund_order', order_id=order.id)
+
+    return render(request, "pages/refund_order.html", {
+        'order': order,
+        'transaction': transaction,
+        'items': refund_service.get_refundable_items(order),
+        'refunds': transaction.refunds.select_related('created_by') if transaction else [],
+    })
+
+
 @user_passes_test(is_moderator)
 def delete_product(request, product_id):
     """Удаление товара (только если нет связанных заказов)"""
@@ -1136,6 +1419,7 @@ def delete_product(request, product_id):
             # Сначала удаляем связанные изображения из файловой системы
             for image in product.images.all():
                 if image.image:
+                    delete_renditions(image.renditions)  # Удаляем миниатюры
                     image.image.delete()  # Удаляем файл
             # Удаляем варианты товара
             product.variants.all().delete()
@@ -1150,6 +1434,7 @@ def delete_product(request, product_id):
 
 # --- АДМИН ПАНЕЛЬ ---
 @user_passes_test(is_admin)
+@replica_reads
 def admin_dashboard(request):
     """Панель администратора с аналитикой"""
     try:
@@ -1337,4 +1622,23 @@ def export_orders_csv_windows(request):
             order.delivery_address
         ])
 
-    return response
\ No newline at end of file
+    return response
+
+
+def feed_file(request, name):
+    """Sitemap и товарный фид, построенные командой build_feeds (в продакшене их отдаёт nginx)"""
+    if not feeds.is_public_file(name):
+        raise Http404('Файл не найден')
+    path = os.path.join(settings.FEEDS_DIR, name)
+    try:
+        modified = os.stat(path).st_mtime
+    except FileNotFoundError:
+        raise Http404('Файл ещё не построен')
+
+    not_modified = get_conditional_response(request, last_modified=int(modified))
+    if not_modified is not None:
+        return not_modified
+    response = FileResponse(open(path, 'rb'), content_type='application/xml; charset=utf-8')
+    response['Last-Modified'] = http_date(modified)
+    response['Cache-Control'] = 'public, max-age=3600'
+    return response
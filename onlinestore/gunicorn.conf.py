@@ -0,0 +1,34 @@
+import os
+import shutil
+
+# Каталог метрик Prometheus, общий для всех воркеров (см. cloth/metrics.py)
+PROMETHEUS_MULTIPROC_DIR = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prometheus_metrics')
+)
+
+wsgi_app = 'onlinestore.wsgi:application'
+workers = int(os.environ.get('GUNICORN_WORKERS', '4'))
+
+
+def on_starting(server):
+    """Очистка метрик прошлого запуска"""
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Удаление живых gauge-значений завершившегося воркера"""
+    try:
+        from prometheus_client import multiprocess
+    except ImportError:
+        return
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    """Сброс буферов просмотров товаров и журнала поиска завершающегося воркера"""
+    from cloth.search_log import flush_search_log
+    from cloth.view_counter import flush_views
+    flush_views()
+    flush_search_log()
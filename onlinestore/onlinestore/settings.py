@@ -44,10 +44,13 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'cloth.middleware.ResponseCompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'cloth.middleware.ReplicaPinningMiddleware',
+    'cloth.middleware.RequestTimingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -86,6 +89,49 @@ DATABASES = {
     }
 }
 
+# Реплики только для чтения (cloth.db_router): DB_REPLICA_HOSTS=host1,host2:5433
+# Остальные параметры подключения -- как у основной базы. В тестах реплика
+# указывает на тестовую основную базу (MIRROR)
+for number, address in enumerate(filter(None, os.environ.get('DB_REPLICA_HOSTS', '').split(',')), start=1):
+    host, _, port = address.strip().partition(':')
+    DATABASES[f'replica{number}'] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'TEST': {'MIRROR': 'default'},
+    }
+REPLICA_DATABASES = [alias for alias in DATABASES if alias != 'default']
+DATABASE_ROUTERS = ['cloth.db_router.ReplicaRouter']
+# Сколько секунд после POST посетитель читает только с основной базы
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', '5'))
+
+# Кэш (фрагменты карточек товаров, cloth.cache)
+# Redis общий для всех процессов gunicorn; без REDIS_URL кэш живёт в памяти процесса,
+# и сброс версии карточки виден только в том процессе, где товар сохранили
+REDIS_URL = os.environ.get('REDIS_URL', '')
+if REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'cloth',
+        }
+    }
+# Время жизни HTML карточки товара; при изменении товара ключ меняется сразу
+PRODUCT_CARD_CACHE_TIMEOUT = 24 * 60 * 60
+# Кэш страниц главной и каталога для анонимных посетителей (секунды):
+# свежая страница, сколько ещё отдавать устаревшую, пока её перестраивают,
+# и сколько держать блокировку перестроения (PAGE_CACHE_TIMEOUT=0 -- кэш отключён)
+PAGE_CACHE_TIMEOUT = int(os.environ.get('PAGE_CACHE_TIMEOUT', '60'))
+PAGE_CACHE_STALE_TIMEOUT = int(os.environ.get('PAGE_CACHE_STALE_TIMEOUT', '600'))
+PAGE_CACHE_LOCK_TIMEOUT = 30
+
 # Настройки SMTP для Mail.ru (вариант с портом 587)
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.mail.ru'
@@ -105,6 +151,26 @@ EMAIL_TIMEOUT = 30
 YOOKASSA_SHOP_ID = os.environ.get('YOOKASSA_SHOP_ID', '')
 YOOKASSA_SECRET_KEY = os.environ.get('YOOKASSA_SECRET_KEY', '')
 
+# Инструментирование запросов (cloth.middleware.RequestTimingMiddleware)
+# Запросы к БД дольше порога (мс) логируются вместе с местом вызова
+PERF_SLOW_QUERY_MS = float(os.environ.get('PERF_SLOW_QUERY_MS', '100'))
+# Заголовок, по которому сотрудник получает профиль cProfile вместо страницы
+PERF_PROFILE_HEADER = 'X-Profile'
+
+# Метрики Prometheus (cloth.metrics, /metrics)
+# Каталог для агрегации метрик между процессами gunicorn (пусто -- один процесс)
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR', '')
+# Токен для Prometheus (bearer_token в scrape_config); без него /metrics доступен
+# только напрямую (не через прокси) с адресов METRICS_ALLOWED_IPS
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = os.environ.get('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',')
+
+# Минификация HTML и сжатие ответов (cloth.middleware.ResponseCompressionMiddleware)
+HTML_MINIFY = True
+# Ответы меньше порога (байт) не сжимаются: выигрыш меньше накладных расходов
+RESPONSE_COMPRESS_MIN_SIZE = 1024
+RESPONSE_BROTLI_QUALITY = 5
+
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
 
@@ -144,10 +210,61 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = [BASE_DIR / 'static']
 STATIC_ROOT = BASE_DIR / 'staticfiles'
 
+# collectstatic: отпечатки в именах, минификация CSS/JS, файлы .gz/.br рядом
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {'BACKEND': 'cloth.staticfiles.CompressedManifestStaticFilesStorage'},
+}
+# Раздавать STATIC_ROOT самим приложением (если перед ним нет nginx)
+SERVE_STATIC = os.environ.get('SERVE_STATIC', 'False').lower() in ('true', '1', 'yes')
+# Кэширование статики без отпечатка в имени (с отпечатком -- год, immutable)
+STATIC_MAX_AGE = 60 * 60
+
 # Media files
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Строить миниатюры прямо при загрузке изображения (в запросе админки/edit_product).
+# False -- загрузка быстрее, миниатюры строит manage.py generate_renditions по расписанию
+IMAGE_RENDITIONS_ON_SAVE = os.environ.get('IMAGE_RENDITIONS_ON_SAVE', 'True').lower() in ('true', '1', 'yes')
+
+# Ресайз изображений по запросу (/img/<w>x<h>/<path>)
+IMAGE_CACHE_DIR = Path(os.environ.get('IMAGE_CACHE_DIR') or BASE_DIR / 'image_cache')
+# Размер дискового кэша; при превышении удаляются давно не запрошенные файлы
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+IMAGE_CACHE_MAX_AGE = 30 * 24 * 60 * 60
+# Разрешённые размеры WxH (0 -- без ограничения по стороне): произвольные размеры
+# позволили бы заставить сервер ресайзить и хранить сколько угодно копий
+IMAGE_RESIZE_SIZES = {
+    tuple(int(side) for side in size.split('x'))
+    for size in os.environ.get('IMAGE_RESIZE_SIZES', '160x0,400x0,800x0,1600x0').split(',')
+    if size.strip()
+}
+
+# Индекс похожих товаров (manage.py build_similar_products), воркеры читают его через mmap
+SIMILARITY_INDEX_PATH = str(os.environ.get('SIMILARITY_INDEX_PATH') or BASE_DIR / 'similarity' / 'products.npy')
+
+# Sitemap и товарный фид (manage.py build_feeds, cloth.feeds)
+# SITE_URL -- адрес сайта для абсолютных ссылок в файлах
+SITE_URL = os.environ.get('SITE_URL', 'http://localhost:8000')
+FEEDS_DIR = Path(os.environ.get('FEEDS_DIR') or BASE_DIR / 'feeds')
+FEED_SHOP_NAME = os.environ.get('FEED_SHOP_NAME', 'CLOTH')
+FEED_COMPANY_NAME = os.environ.get('FEED_COMPANY_NAME', 'CLOTH')
+
+# Буфер просмотров товаров (cloth.view_counter): сброс в базу раз в N секунд
+# или когда в буфере накопилось столько разных товаров
+VIEW_COUNTER_FLUSH_SECONDS = int(os.environ.get('VIEW_COUNTER_FLUSH_SECONDS', '10'))
+VIEW_COUNTER_MAX_PENDING = int(os.environ.get('VIEW_COUNTER_MAX_PENDING', '1000'))
+
+# Журнал поиска каталога (cloth.search_log): сброс в базу раз в N секунд
+# или когда в буфере накопилось столько событий
+SEARCH_LOG_FLUSH_SECONDS = int(os.environ.get('SEARCH_LOG_FLUSH_SECONDS', '30'))
+SEARCH_LOG_MAX_PENDING = int(os.environ.get('SEARCH_LOG_MAX_PENDING', '500'))
+
+# Сколько минут неоплаченный заказ держит товар: в остатках API
+# (/api/v1/variants/availability/) его количества вычитаются из склада
+STOCK_RESERVATION_MINUTES = int(os.environ.get('STOCK_RESERVATION_MINUTES', '30'))
+
 # Custom user model
 AUTH_USER_MODEL = 'cloth.User'
 
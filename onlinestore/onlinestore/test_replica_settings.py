@@ -0,0 +1,19 @@
+"""
+Настройки для проверки чтения с реплики (cloth.db_router)
+
+Две локальные базы: default и replica. Реплика -- отдельная база без
+репликации и без MIRROR, поэтому по данным видно, из какой базы прочитан ответ.
+
+    python manage.py test cloth.tests.ReplicaRoutingTests --settings=onlinestore.test_replica_settings
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES, os
+
+DATABASES = {
+    'default': DATABASES['default'],
+    'replica': {
+        **DATABASES['default'],
+        'NAME': os.environ.get('DB_REPLICA_NAME', f"{DATABASES['default']['NAME']}_replica"),
+    },
+}
+REPLICA_DATABASES = ['replica']
@@ -113,6 +113,61 @@ function updateWishlistCounter(count) {
     }
 }
 
+// --- Wishlist state for cached product cards ---
+// Карточки одинаковы для всех пользователей; избранное берётся из #wishlist-state
+function applyWishlistState() {
+    const stateElement = document.getElementById('wishlist-state');
+    if (!stateElement) return;
+
+    const state = JSON.parse(stateElement.textContent);
+    const ids = new Set(state.ids.map(String));
+    document.querySelectorAll('.product-card .wishlist-btn[data-product-id]').forEach(button => {
+        if (!state.authenticated) {
+            button.href = state.login_url;
+            button.removeAttribute('onclick');
+            return;
+        }
+        const active = ids.has(button.dataset.productId);
+        const icon = button.querySelector('i');
+        button.classList.toggle('active', active);
+        icon.classList.toggle('bi-heart-fill', active);
+        icon.classList.toggle('bi-heart', !active);
+    });
+}
+
+// --- Variant availability (one request per page, cached for a few seconds) ---
+const AVAILABILITY_BATCH = 300;
+
+function fetchAvailability(variantIds) {
+    // Sorted ids give the same URL for the same set, so HTTP caches can share it
+    const ids = [...new Set(variantIds.map(String).filter(Boolean))].sort((a, b) => a - b);
+    const batches = [];
+    for (let i = 0; i < ids.length; i += AVAILABILITY_BATCH) {
+        const query = encodeURIComponent(ids.slice(i, i + AVAILABILITY_BATCH).join(','));
+        batches.push(
+            fetch(`/api/v1/variants/availability/?ids=${query}`)
+                .then(response => response.ok ? response.json() : {data: {}})
+                .then(body => body.data)
+        );
+    }
+    return Promise.all(batches).then(parts => Object.assign({}, ...parts));
+}
+
+function markSoldOutCards() {
+    const buttons = document.querySelectorAll('.product-card .quick-add-btn[data-variant-id]');
+    if (buttons.length === 0) return;
+
+    fetchAvailability([...buttons].map(button => button.dataset.variantId))
+        .then(availability => {
+            buttons.forEach(button => {
+                const item = availability[button.dataset.variantId];
+                button.disabled = !item || item.available < 1;
+                button.title = button.disabled ? 'Нет в наличии' : '';
+            });
+        })
+        .catch(() => {});
+}
+
 // --- Quick add to cart (global, used from product cards) ---
 function quickAddToCart(variantId) {
     if (!variantId) {
@@ -120,6 +175,19 @@ function quickAddToCart(variantId) {
         return;
     }
 
+    fetchAvailability([variantId])
+        .then(availability => {
+            const item = availability[String(variantId)];
+            if (item && item.available < 1) {
+                showNotification('Товара нет в наличии', 'warning');
+                return;
+            }
+            postToCart(variantId);
+        })
+        .catch(() => postToCart(variantId));
+}
+
+function postToCart(variantId) {
     const csrfToken = document.querySelector('[name=csrfmiddlewaretoken]')?.value
         || getCookie('csrftoken');
 
@@ -164,6 +232,10 @@ function getCookie(name) {
 
 // --- DOMContentLoaded: single listener ---
 document.addEventListener('DOMContentLoaded', function () {
+    // 0. Mark wishlist items and sold-out variants on cached product cards
+    applyWishlistState();
+    markSoldOutCards();
+
     // 1. Animate product cards on scroll
     const cards = document.querySelectorAll('.product-card');
     if (cards.length > 0) {
@@ -274,4 +346,49 @@ document.addEventListener('DOMContentLoaded', function () {
         `;
         document.head.appendChild(style);
     }
-});
\ No newline at end of file
+
+    // 7. Search suggestions (typeahead)
+    document.querySelectorAll('input[data-suggest-url]').forEach(setupSearchSuggestions);
+});
+
+// --- Search suggestions: fills the input's <datalist>, picking a product opens its page ---
+function setupSearchSuggestions(input) {
+    const list = document.getElementById(input.getAttribute('list'));
+    if (!list) return;
+    let timer = null;
+    let controller = null;
+    const urls = new Map();
+
+    input.addEventListener('input', () => {
+        // Option chosen from the list
+        if (urls.has(input.value)) {
+            window.location.href = urls.get(input.value);
+            return;
+        }
+        clearTimeout(timer);
+        const query = input.value.trim();
+        if (!query) {
+            list.innerHTML = '';
+            return;
+        }
+        timer = setTimeout(async () => {
+            if (controller) controller.abort();
+            controller = new AbortController();
+            try {
+                const url = `${input.dataset.suggestUrl}?q=${encodeURIComponent(query)}`;
+                const response = await fetch(url, { signal: controller.signal });
+                const data = await response.json();
+                urls.clear();
+                list.innerHTML = '';
+                data.suggestions.forEach(suggestion => {
+                    const option = document.createElement('option');
+                    option.value = suggestion.text;
+                    list.appendChild(option);
+                    urls.set(suggestion.text, suggestion.url);
+                });
+            } catch {
+                // Aborted by a newer keystroke or network error: keep the previous list
+            }
+        }, 150);
+    });
+}
\ No newline at end of file